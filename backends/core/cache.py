@@ -1,10 +1,24 @@
 from google.appengine.api import memcache
 
+from core import metrics
+
 MEMCACHE_DEFAULT_EXPIRATION_TIME_SECONDS = 24 * 60 * 60
 MEMCACHE_DEFAULT_MAX_RETRIES = 10
 
 shared_memcache_client = None
 
+memcache_gets = metrics.counter(
+    'crmint_memcache_gets_total', 'Memcache get calls by result.', ['result'])
+
+
+class _Client(memcache.Client):
+  """Memcache client counting hits and misses."""
+
+  def get(self, key, *args, **kwargs):
+    value = super(_Client, self).get(key, *args, **kwargs)
+    memcache_gets.inc(result='miss' if value is None else 'hit')
+    return value
+
 
 def get_memcache_client():
   """Returns a singleton for the memcache client instance."""
@@ -14,7 +28,7 @@ def get_memcache_client():
   if shared_memcache_client is not None:
     return shared_memcache_client
 
-  client = memcache.Client()
+  client = _Client()
   shared_memcache_client = client
   return client
 
@@ -12,16 +12,153 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from google.cloud.logging import Client
+from datetime import datetime
+import logging
+import threading
+import time
 
 from core.app_data import SA_DATA, SA_FILE
+from core.lazy import LazyObject
 
 
-if SA_DATA.get('private_key', ''):
-  client = Client.from_service_account_json(SA_FILE)
-else:
-  client = Client()
+def _create_client():
+  from google.cloud.logging import Client
+  if SA_DATA.get('private_key', ''):
+    return Client.from_service_account_json(SA_FILE)
+  return Client()
 
 
+# The client is created on first use, as creating it means importing the
+# client library and looking up credentials.
+client = LazyObject(_create_client)
+
 logger_name = 'crmintapplogger'
-logger = client.logger(logger_name)
+logger = LazyObject(lambda: client.logger(logger_name))
+
+
+class LogBuffer(object):
+  """Collects log entries and writes them in batches.
+
+  Buffered entries are written by a background thread once MAX_ENTRIES are
+  buffered or, by a timer, FLUSH_INTERVAL seconds after the oldest one was
+  buffered. The rest are written on flush(), which stops the timer. One batch
+  at most is written at a time, so entries are written in order. Logging
+  never waits for a write: while a batch is being written, entries are
+  buffered for the next one, up to MAX_BUFFERED_ENTRIES, and dropped over it.
+  """
+
+  MAX_ENTRIES = 100
+  MAX_BUFFERED_ENTRIES = 1000
+  FLUSH_INTERVAL = 10
+
+  def __init__(self, logger_, retry=None):
+    """Initializes the buffer.
+
+    Args:
+        logger_: Logger to write the entries with.
+        retry: Optional decorator retrying a failed batch write.
+    """
+    self._logger = logger_
+    self._retry = retry or (lambda func: func)
+    self._lock = threading.Lock()
+    self._entries = []
+    self._oldest_entry_time = None
+    self._timer = None
+    self._writer = None
+    self._write_error = None
+    self._dropped_entries = 0
+
+  def log_struct(self, info):
+    with self._lock:
+      if len(self._entries) >= self.MAX_BUFFERED_ENTRIES:
+        self._dropped_entries += 1
+        return
+      if not self._entries:
+        self._oldest_entry_time = time.time()
+        self._timer = threading.Timer(self.FLUSH_INTERVAL, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+      # NB: entries are timestamped now as they are written later.
+      self._entries.append((info, datetime.utcnow()))
+      if self._is_due():
+        self._start_writer()
+
+  def _is_due(self):
+    return self._entries and (
+        len(self._entries) >= self.MAX_ENTRIES or
+        time.time() - self._oldest_entry_time >= self.FLUSH_INTERVAL)
+
+  def _on_timer(self):
+    with self._lock:
+      if self._entries:
+        self._start_writer()
+
+  def _cancel_timer(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+  def _take_entries(self):
+    self._cancel_timer()
+    entries = self._entries
+    self._entries = []
+    return entries
+
+  def _start_writer(self):
+    """Writes the buffered entries in background, to be called locked.
+
+    A writer still running writes them once it's done instead.
+    """
+    if self._writer is not None:
+      return
+    self._writer = threading.Thread(target=self._write_batches,
+                                    args=(self._take_entries(),))
+    self._writer.daemon = True
+    self._writer.start()
+
+  def _write_batches(self, entries):
+    while True:
+      self._write(entries)
+      with self._lock:
+        if not self._is_due():
+          self._writer = None
+          return
+        entries = self._take_entries()
+
+  def _join_writer(self):
+    """Waits for the background writes, to be called unlocked."""
+    while True:
+      with self._lock:
+        writer = self._writer
+      if writer is None:
+        return
+      writer.join()
+
+  def _write(self, entries):
+    try:
+      for i in xrange(0, len(entries), self.MAX_ENTRIES):
+        batch = self._logger.batch()
+        for info, timestamp in entries[i:i + self.MAX_ENTRIES]:
+          batch.log_struct(info, timestamp=timestamp)
+        def _commit(batch=batch):
+          batch.commit()
+        self._retry(_commit)()
+    except Exception as e:  # pylint: disable=broad-except
+      self._write_error = e
+
+  def flush(self):
+    """Writes the buffered entries, raises the error of a failed write."""
+    with self._lock:
+      self._cancel_timer()
+    self._join_writer()
+    with self._lock:
+      entries = self._take_entries()
+      dropped_entries, self._dropped_entries = self._dropped_entries, 0
+    if entries:
+      self._write(entries)
+    if dropped_entries:
+      logging.warning('%i log entries dropped while writing was too slow.',
+                      dropped_entries)
+    error, self._write_error = self._write_error, None
+    if error is not None:
+      raise error
@@ -0,0 +1,113 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Minimal thread pool to run I/O-bound calls concurrently.
+
+NB: App Engine standard environment doesn't support `multiprocessing`, so
+    `multiprocessing.pool.ThreadPool` can't be used. Threads started here are
+    bound to the request and are joined before the pool is closed.
+"""
+
+import Queue
+import threading
+
+
+class Future(object):
+  """Result of a call submitted to a thread pool."""
+
+  def __init__(self):
+    self._done = threading.Event()
+    self._result = None
+    self._exception = None
+
+  def _set_result(self, result):
+    self._result = result
+    self._done.set()
+
+  def _set_exception(self, exception):
+    self._exception = exception
+    self._done.set()
+
+  def done(self):
+    return self._done.is_set()
+
+  def wait(self, timeout=None):
+    """Waits for the call to finish, returns False if it timed out."""
+    return self._done.wait(timeout)
+
+  def result(self):
+    """Waits for the call to finish, returns its result or raises its error."""
+    self._done.wait()
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+
+class ThreadPool(object):
+  """Runs calls in a bounded number of threads.
+
+  Submitting blocks while `max_pending` calls are waiting for a free thread,
+  so a producer can't get ahead of the consumers by more than that.
+  """
+
+  def __init__(self, size, max_pending=None):
+    self._calls = Queue.Queue(maxsize=max_pending or size)
+    self._threads = []
+    for _ in xrange(max(size, 1)):
+      thread = threading.Thread(target=self._work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _work(self):
+    while True:
+      call = self._calls.get()
+      if call is None:
+        return
+      future, func, args, kwargs = call
+      try:
+        result = func(*args, **kwargs)
+      except Exception as e:  # pylint: disable=broad-except
+        future._set_exception(e)  # pylint: disable=protected-access
+      else:
+        future._set_result(result)  # pylint: disable=protected-access
+
+  def submit(self, func, *args, **kwargs):
+    future = Future()
+    self._calls.put((future, func, args, kwargs))
+    return future
+
+  def map(self, func, items):
+    """Calls func on every item and returns results in items order.
+
+    Raises the error of the first failed call (in items order) once all calls
+    are finished.
+    """
+    futures = [self.submit(func, item) for item in items]
+    for future in futures:
+      future.wait()
+    return [future.result() for future in futures]
+
+  def close(self):
+    """Waits for all submitted calls to finish and stops the threads."""
+    for _ in self._threads:
+      self._calls.put(None)
+    for thread in self._threads:
+      thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
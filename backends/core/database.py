@@ -12,11 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from contextlib import contextmanager
+import time
+
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy_mixins import AllFeaturesMixin, ReprMixin
 
+from core import metrics
 from core.mixins import TimestampsMixin
 
 engine = None
@@ -29,10 +34,26 @@ class BaseModel(Base, AllFeaturesMixin, TimestampsMixin):
   __repr__ = ReprMixin.__repr__
 
 
+db_queries = metrics.histogram(
+    'crmint_db_query_duration_seconds', 'Duration of database queries.')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+  context.query_started_at = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+  db_queries.observe(time.time() - context.query_started_at)
+
+
 def init_engine(uri, **kwargs):
   """Initialization db engine"""
   global engine
   engine = create_engine(uri, **kwargs)
+  event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+  event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
   session = scoped_session(sessionmaker(bind=engine, autocommit=True))
   BaseModel.set_session(session)
   return engine
@@ -49,13 +70,31 @@ def init_db():
   Base.metadata.create_all(bind=engine)
 
 
+@contextmanager
+def keep_loaded():
+  """Keeps loaded objects from expiring when changes are flushed.
+
+  The session commits on every flush, which expires all loaded objects and
+  reloads them on next access. Objects are expired at the end of the block
+  instead, so that later requests served by the thread load them again.
+  """
+  session = BaseModel.session()
+  session.expire_on_commit = False
+  try:
+    yield
+  finally:
+    session.expire_on_commit = True
+    session.expire_all()
+
+
 def load_fixtures(logger_func=None):
   """Load initial data into the database
 
   :param: Logger function to display the loading state
   """
   from core import models
-  general_settings = ['emails_for_notifications']
+  general_settings = ['emails_for_notifications', 'profiled_job_ids',
+                      'profiled_worker_classes']
   for setting in general_settings:
     general_setting = models.GeneralSetting.where(name=setting).first()
     if not general_setting:
@@ -0,0 +1,54 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lazy imports of client libraries.
+
+Client libraries take most of the time needed to import the modules using
+them, so they are imported on first use instead, e.g. ibackend only imports
+`core.workers` to list worker params and never calls a client.
+"""
+
+import importlib
+import threading
+
+
+class LazyObject(object):
+  """Proxy to the object returned by a factory, called on first use."""
+
+  def __init__(self, factory):
+    self.__dict__['_factory'] = factory
+    self.__dict__['_lock'] = threading.Lock()
+    self.__dict__['_object'] = None
+
+  def resolve(self):
+    """Returns the proxied object, created by the factory on first call."""
+    if self._object is None:
+      with self._lock:
+        if self._object is None:
+          self.__dict__['_object'] = self._factory()
+    return self._object
+
+  def __getattr__(self, name):
+    return getattr(self.resolve(), name)
+
+
+class LazyModule(LazyObject):
+  """Proxy to a module, imported on first attribute access.
+
+  Attributes are looked up on the module every time, so patching them in
+  tests works as with a module imported the usual way.
+  """
+
+  def __init__(self, name):
+    super(LazyModule, self).__init__(lambda: importlib.import_module(name))
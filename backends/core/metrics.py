@@ -0,0 +1,185 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process metrics registry, rendered in the Prometheus text format.
+
+NB: App Engine runs several instances of a service and each instance has its
+    own registry, so /metrics shows metrics of the instance serving it.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+  return (unicode(value).replace('\\', '\\\\').replace('\n', '\\n')
+          .replace('"', '\\"'))
+
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                           for name, value in labels)
+
+
+def _format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value))
+
+
+class _Metric(object):
+  """Abstract metric, holding a value per set of label values."""
+
+  TYPE = None
+
+  def __init__(self, name, documentation, labelnames=()):
+    self.name = name
+    self.documentation = documentation
+    self.labelnames = tuple(labelnames)
+    self._lock = threading.Lock()
+    self._values = {}
+
+  def _key(self, labels):
+    if set(labels) != set(self.labelnames):
+      raise ValueError('Labels of %s must be: %s' % (
+          self.name, ', '.join(self.labelnames)))
+    return tuple(str(labels[name]) for name in self.labelnames)
+
+  def _samples(self, key, value):
+    """Returns (suffix, extra labels, value) samples of a value."""
+    raise NotImplementedError
+
+  def render(self):
+    lines = ['# HELP %s %s' % (self.name, self.documentation),
+             '# TYPE %s %s' % (self.name, self.TYPE)]
+    with self._lock:
+      items = sorted(self._values.items())
+      items = [(key, self._copy(value)) for key, value in items]
+    for key, value in items:
+      labels = zip(self.labelnames, key)
+      for suffix, extra_labels, sample in self._samples(key, value):
+        lines.append('%s%s%s %s' % (self.name, suffix,
+                                    _format_labels(labels + extra_labels),
+                                    _format_value(sample)))
+    return '\n'.join(lines)
+
+  def _copy(self, value):
+    return value
+
+
+class Counter(_Metric):
+  """Value that only goes up, e.g. a number of executed tasks."""
+
+  TYPE = 'counter'
+
+  def inc(self, value=1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + value
+
+  def _samples(self, key, value):
+    return [('', [], value)]
+
+
+class Histogram(_Metric):
+  """Distribution of observed values in buckets, e.g. of durations."""
+
+  TYPE = 'histogram'
+
+  DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                     300, 600)
+
+  def __init__(self, name, documentation, labelnames=(), buckets=None):
+    super(Histogram, self).__init__(name, documentation, labelnames)
+    self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS)) + (
+        float('inf'),)
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          counts[i] += 1
+          break
+      self._values[key] = (counts, total + value)
+
+  @contextmanager
+  def time(self, **labels):
+    """Observes the duration of the with block, even if it raises."""
+    started = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time() - started, **labels)
+
+  def _copy(self, value):
+    counts, total = value
+    return list(counts), total
+
+  def _samples(self, key, value):
+    counts, total = value
+    samples = []
+    cumulative_count = 0
+    for bound, count in zip(self.buckets, counts):
+      cumulative_count += count
+      samples.append(('_bucket', [('le', _format_value(bound))],
+                      cumulative_count))
+    samples.append(('_sum', [], total))
+    samples.append(('_count', [], cumulative_count))
+    return samples
+
+
+class Registry(object):
+  """Holds the metrics of the process, by name."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._metrics = {}
+
+  def _get_or_create(self, metric_class, name, *args, **kwargs):
+    with self._lock:
+      metric = self._metrics.get(name)
+      if metric is None:
+        metric = metric_class(name, *args, **kwargs)
+        self._metrics[name] = metric
+      elif not isinstance(metric, metric_class):
+        raise ValueError('%s is already registered as a %s' % (
+            name, metric.TYPE))
+      return metric
+
+  def counter(self, name, documentation, labelnames=()):
+    return self._get_or_create(Counter, name, documentation, labelnames)
+
+  def histogram(self, name, documentation, labelnames=(), buckets=None):
+    return self._get_or_create(Histogram, name, documentation, labelnames,
+                               buckets=buckets)
+
+  def render(self):
+    """Returns all metrics in the Prometheus text exposition format."""
+    with self._lock:
+      metrics = sorted(self._metrics.items())
+    return ''.join('%s\n' % metric.render() for _, metric in metrics)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+render = REGISTRY.render
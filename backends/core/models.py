@@ -12,25 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 from datetime import datetime
 import logging
 import json
 import re
+import time
 import uuid
 from google.appengine.api import taskqueue
 from simpleeval import simple_eval
 from simpleeval import InvalidExpression
+from sqlalchemy import BigInteger
 from sqlalchemy import Column
+from sqlalchemy import Float
 from sqlalchemy import Integer
+from sqlalchemy import LargeBinary
 from sqlalchemy import String
 from sqlalchemy import DateTime
 from sqlalchemy import Text
 from sqlalchemy import Boolean
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import case
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import relationship
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import load_only
 from core import cache
 from core import inline
+from core import metrics
+from core import tracing
 from core.database import BaseModel
 from core.mailers import NotificationMailer
 
@@ -39,6 +51,10 @@ from core.mailers import NotificationMailer
 CACHE_KEY_STATUS = 'status'
 CACHE_KEY_LIST_OF_TASKS_ENQUEUED = 'enqueued_tasks'
 
+tasks_enqueued = metrics.counter(
+    'crmint_tasks_enqueued_total', 'Tasks enqueued by worker class.',
+    ['worker_class'])
+
 
 def _parse_num(s):
   try:
@@ -158,9 +174,12 @@ class Pipeline(BaseModel):
 
     if not self.get_ready():
       return False
+    TaskMetric.prune([job.id for job in jobs])
 
-    for job in jobs:
-      job.start()
+    # Tasks of the run are enqueued under this span to share its trace.
+    with tracing.span('pipeline.start', pipeline_id=self.id):
+      for job in jobs:
+        job.start()
     return True
 
   def _cancel_all_tasks(self):
@@ -184,14 +203,17 @@ class Pipeline(BaseModel):
     if not job.get_ready():
       return False
     self.update(status=Pipeline.STATUS.RUNNING, status_changed_at=datetime.now())
-    job.start()
+    with tracing.span('pipeline.start_single_job', pipeline_id=self.id,
+                      job_id=job.id):
+      job.start()
     return True
 
   def job_finished(self):
-    for job in self.jobs:
+    jobs = self.jobs.all()
+    for job in jobs:
       if job.get_status() == Job.STATUS.STOPPING:
         job.set_status(Job.STATUS.FAILED)
-    for job in self.jobs:
+    for job in jobs:
       if job.get_status() not in Job.STATUS.INACTIVE_STATUSES:
         return False
     self._finish()
@@ -258,6 +280,7 @@ class Job(BaseModel):
   status_changed_at = Column(DateTime)
   worker_class = Column(String(255))
   pipeline_id = Column(Integer, ForeignKey('pipelines.id'))
+  run_id = Column(String(36))
   params = relationship('Param', backref='job', lazy='dynamic')
   start_conditions = relationship(
       'StartCondition',
@@ -286,6 +309,22 @@ class Job(BaseModel):
   def _get_prefixed_cache_key(self, key):
     return 'pipeline=%s_job=%s_%s' % (str(self.pipeline_id), str(self.id), key)
 
+  @classmethod
+  def find_with_task_context(cls, job_id):
+    """Returns the job with everything task bookkeeping needs, in one query.
+
+    The pipeline, start conditions with their preceding jobs and dependent
+    jobs with their start conditions are loaded along with the job, loaded
+    objects are refreshed.
+    """
+    preceding_jobs = joinedload(cls.start_conditions).joinedload(
+        StartCondition.preceding_job)
+    dependent_jobs = joinedload(cls.dependent_jobs).joinedload(
+        cls.start_conditions).joinedload(StartCondition.preceding_job)
+    query = cls.query.options(joinedload(cls.pipeline), preceding_jobs,
+                              dependent_jobs)
+    return query.populate_existing().filter(cls.id == job_id).one_or_none()
+
   def _initialize_cache_values(self, max_retries=cache.MEMCACHE_DEFAULT_MAX_RETRIES):
     retries = 0
     while retries < max_retries:
@@ -311,6 +350,9 @@ class Job(BaseModel):
     param_ids = [p.id for p in self.params.all()]
     if param_ids:
       Param.destroy(*param_ids)
+    TaskMetric.where(job_id=self.id).delete()
+    TaskProfile.where(job_id=self.id).delete()
+    TaskCheckpoint.where(job_id=self.id).delete()
     self.delete()
 
   def get_status(self):
@@ -420,8 +462,10 @@ class Job(BaseModel):
         return None
       elif cache.get_memcache_client().cas(key, Job.STATUS.RUNNING,
           time=cache.MEMCACHE_DEFAULT_EXPIRATION_TIME_SECONDS):
-        # Update the database status.
-        self.update(status=Job.STATUS.RUNNING, status_changed_at=datetime.now())
+        # Update the database status, tasks of this run get the new run ID.
+        self.update(status=Job.STATUS.RUNNING,
+                    status_changed_at=datetime.now(),
+                    run_id=str(uuid.uuid4()))
         return self.run()
       else:
         retries += 1
@@ -465,8 +509,15 @@ class Job(BaseModel):
         'job_id': self.id,
         'worker_class': worker_class,
         'worker_params': json.dumps(worker_params),
-        'task_name': unique_task_name
+        'task_name': unique_task_name,
+        'run_id': self.run_id or '',
+        # Queue delay is measured from the time the task is due to run.
+        'eta': time.time() + delay,
     }
+    span = tracing.current_span()
+    if span is not None:
+      task_params['trace_id'] = span.trace_id
+      task_params['parent_span_id'] = span.span_id
     task = taskqueue.add(
         target='job-service',
         name=unique_task_name,
@@ -474,6 +525,8 @@ class Job(BaseModel):
         params=task_params,
         countdown=delay)
 
+    tasks_enqueued.inc(worker_class=worker_class)
+
     # Keep track of the running task name.
     self._add_task_name_cache(unique_task_name)
     self.save()
@@ -768,3 +821,221 @@ class TaskEnqueued(BaseModel):
   def count_in_namespace(cls, namespace):
     count_query = cls.where(task_namespace=namespace)
     return count_query.count()
+
+
+class AudienceFingerprint(BaseModel):
+  __tablename__ = 'audience_fingerprints'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  property_id = Column(String(50), index=True)
+  name = Column(String(255))
+  audience_id = Column(String(50))
+  fingerprint = Column(String(40))
+
+  __table_args__ = (
+      Index('ix_audience_fingerprints_property_id_name', 'property_id',
+            'name', unique=True),
+  )
+
+  @classmethod
+  def save_all(cls, property_id, values):
+    """Upserts audience IDs and fingerprints mapped to audience names.
+
+    The whole batch is written in one transaction. If another task inserted
+    some of the audiences meanwhile, the batch is written again to update
+    them instead.
+    """
+    try:
+      cls._save_all(property_id, values)
+    except IntegrityError:
+      cls._save_all(property_id, values)
+
+  @classmethod
+  def _save_all(cls, property_id, values):
+    with cls.session.begin():
+      fingerprints = cls.where(property_id=property_id,
+                               name__in=values.keys()).all()
+      fingerprints = dict((f.name, f) for f in fingerprints)
+      for name, (audience_id, fingerprint) in values.iteritems():
+        if name in fingerprints:
+          fingerprints[name].audience_id = audience_id
+          fingerprints[name].fingerprint = fingerprint
+        else:
+          cls.session.add(cls(property_id=property_id, name=name,
+                              audience_id=audience_id,
+                              fingerprint=fingerprint))
+
+
+class TaskMetric(BaseModel):
+  __tablename__ = 'task_metrics'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  job_id = Column(Integer, ForeignKey('jobs.id'), index=True)
+  run_id = Column(String(36), index=True)
+  trace_id = Column(String(32))
+  task_name = Column(String(100))
+  worker_class = Column(String(255))
+  status = Column(String(50))
+  started_at = Column(DateTime)
+  attempts = Column(Integer)
+  queue_delay = Column(Float)
+  wall_time = Column(Float)
+  rows = Column(Integer, default=0)
+  bytes = Column(BigInteger, default=0)
+  api_calls = Column(Integer, default=0)
+
+  class STATUS:
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    CANCELED = 'canceled'
+    ERROR = 'error'
+
+  # Number of latest runs of a job whose task metrics are kept.
+  RUNS_KEPT = 20
+
+  @classmethod
+  def prune(cls, job_ids):
+    """Deletes metrics and spans of all but the latest runs of each job."""
+    if not job_ids:
+      return
+    query = cls.session.query(cls.job_id, cls.run_id, func.max(cls.trace_id))
+    query = query.filter(cls.job_id.in_(job_ids))
+    query = query.group_by(cls.job_id, cls.run_id)
+    query = query.order_by(func.min(cls.started_at).desc())
+    kept_runs = collections.defaultdict(int)
+    stale_run_ids = []
+    stale_trace_ids = []
+    for job_id, run_id, trace_id in query:
+      kept_runs[job_id] += 1
+      if kept_runs[job_id] > cls.RUNS_KEPT:
+        stale_run_ids.append(run_id)
+        if trace_id is not None:
+          stale_trace_ids.append(trace_id)
+    if stale_run_ids:
+      cls.where(job_id__in=job_ids).filter(
+          cls.run_id.in_(stale_run_ids)).delete(synchronize_session=False)
+    if stale_trace_ids:
+      # Spans of the run are recorded under the trace of its tasks.
+      TraceSpan.where(trace_id__in=stale_trace_ids).delete(
+          synchronize_session=False)
+
+  @classmethod
+  def runs(cls, job_ids):
+    """Returns metrics of tasks summed up per job run, latest runs first."""
+    if not job_ids:
+      return []
+    failed = case([(cls.status != cls.STATUS.SUCCEEDED, 1)], else_=0)
+    query = cls.session.query(
+        cls.job_id,
+        cls.run_id,
+        func.count(cls.id).label('tasks'),
+        func.sum(failed).label('failed_tasks'),
+        func.sum(cls.attempts).label('attempts'),
+        func.min(cls.started_at).label('started_at'),
+        func.max(cls.created_at).label('finished_at'),
+        func.sum(cls.wall_time).label('wall_time'),
+        func.max(cls.wall_time).label('max_wall_time'),
+        func.avg(cls.queue_delay).label('avg_queue_delay'),
+        func.max(cls.queue_delay).label('max_queue_delay'),
+        func.sum(cls.rows).label('rows'),
+        func.sum(cls.bytes).label('bytes'),
+        func.sum(cls.api_calls).label('api_calls'),
+        func.max(cls.trace_id).label('trace_id'))
+    query = query.filter(cls.job_id.in_(job_ids))
+    query = query.group_by(cls.job_id, cls.run_id)
+    return query.order_by(func.min(cls.started_at).desc()).all()
+
+
+class TaskProfile(BaseModel):
+  __tablename__ = 'task_profiles'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  job_id = Column(Integer, ForeignKey('jobs.id'), index=True)
+  run_id = Column(String(36), index=True)
+  task_name = Column(String(100))
+  worker_class = Column(String(255))
+  # Profile in the marshal format of `pstats.Stats.dump_stats`.
+  stats = Column(LargeBinary(length=2**24 - 1))
+
+  SETTINGS = ('profiled_job_ids', 'profiled_worker_classes')
+
+  @classmethod
+  def enabled_for(cls, job_id, worker_class):
+    """Tells whether tasks of the job are to be profiled.
+
+    Profiling is switched on by listing job IDs or worker class names in the
+    profiled_job_ids and profiled_worker_classes general settings.
+    """
+    settings = GeneralSetting.where(name__in=cls.SETTINGS).all()
+    values = dict((s.name, (s.value or '').replace(',', ' ').split())
+                  for s in settings)
+    return (str(job_id) in values.get('profiled_job_ids', [])
+            or worker_class in values.get('profiled_worker_classes', []))
+
+
+class TaskCheckpoint(BaseModel):
+  __tablename__ = 'task_checkpoints'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  job_id = Column(Integer, ForeignKey('jobs.id'), index=True)
+  # Task names are unique per job run, so are the checkpoints.
+  task_name = Column(String(100), index=True)
+  # JSON encoded state saved by the worker.
+  state = Column(Text)
+
+  @classmethod
+  def save_state(cls, job_id, task_name, state):
+    checkpoint = cls.where(job_id=job_id, task_name=task_name).first()
+    if checkpoint is None:
+      cls.create(job_id=job_id, task_name=task_name, state=json.dumps(state))
+    else:
+      checkpoint.update(state=json.dumps(state))
+
+  @classmethod
+  def load_state(cls, job_id, task_name):
+    """Returns the state last saved by the task, None if there is none."""
+    checkpoint = cls.where(job_id=job_id, task_name=task_name).first()
+    if checkpoint is None:
+      return None
+    return json.loads(checkpoint.state)
+
+  @classmethod
+  def clear(cls, job_id, task_name):
+    cls.where(job_id=job_id, task_name=task_name).delete()
+
+
+class TraceSpan(BaseModel):
+  __tablename__ = 'trace_spans'
+  id = Column(Integer, primary_key=True, autoincrement=True)
+  trace_id = Column(String(32), index=True)
+  span_id = Column(String(16))
+  parent_id = Column(String(16))
+  name = Column(String(255))
+  # JSON encoded span attributes.
+  attributes = Column(Text)
+  # Seconds since the epoch need double precision.
+  start_time = Column(Float(precision=53))
+  end_time = Column(Float(precision=53))
+
+  @classmethod
+  def export(cls, span):
+    """Saves a finished span, the model is used as the tracing exporter."""
+    cls.create(trace_id=span.trace_id,
+               span_id=span.span_id,
+               parent_id=span.parent_id,
+               name=span.name,
+               attributes=json.dumps(span.attributes, sort_keys=True),
+               start_time=span.start_time,
+               end_time=span.end_time)
+
+  @classmethod
+  def load(cls, trace_id):
+    """Returns spans of the trace as dicts for `tracing.render_timeline`."""
+    spans = []
+    for span in cls.where(trace_id=trace_id).order_by(cls.start_time):
+      spans.append({
+          'name': span.name,
+          'trace_id': span.trace_id,
+          'span_id': span.span_id,
+          'parent_id': span.parent_id,
+          'attributes': json.loads(span.attributes),
+          'start_time': span.start_time,
+          'end_time': span.end_time,
+      })
+    return spans
@@ -0,0 +1,131 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trace propagation from API calls to workers.
+
+A trace ID is minted when a pipeline starts and follows the work through task
+params: tasks and spans recorded while a span is active belong to its trace.
+Spans are handed to the exporter set with `set_exporter` once finished. The
+apps export them to the trace_spans table (`core.models.TraceSpan`) if the
+TRACE_SPANS environment variable is set. `render_timeline` turns exported
+spans into the Chrome trace event format (chrome://tracing) to see a run as a
+timeline.
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import uuid
+
+
+_context = threading.local()
+_exporter = None
+
+
+class Span(object):
+  """Named and timed unit of work of a trace."""
+
+  def __init__(self, name, trace_id, parent_id=None, attributes=None):
+    self.name = name
+    self.trace_id = trace_id
+    self.span_id = uuid.uuid4().hex[:16]
+    self.parent_id = parent_id
+    self.attributes = attributes or {}
+    self.start_time = time.time()
+    self.end_time = None
+
+  def to_dict(self):
+    return {
+        'name': self.name,
+        'trace_id': self.trace_id,
+        'span_id': self.span_id,
+        'parent_id': self.parent_id,
+        'attributes': self.attributes,
+        'start_time': self.start_time,
+        'end_time': self.end_time,
+    }
+
+
+def current_span():
+  """Returns the span active in this thread, None if there's none."""
+  return getattr(_context, 'span', None)
+
+
+def current_trace_id():
+  span_ = current_span()
+  return span_.trace_id if span_ is not None else None
+
+
+@contextmanager
+def span(name, trace_id=None, parent_id=None, **attributes):
+  """Records a span of the with block.
+
+  The span is a child of the active span, unless a trace ID is given to
+  continue a trace from another request. A new trace is started if there's
+  neither.
+  """
+  parent = current_span()
+  if trace_id is None:
+    if parent is not None:
+      trace_id, parent_id = parent.trace_id, parent.span_id
+    else:
+      trace_id = uuid.uuid4().hex
+  span_ = Span(name, trace_id, parent_id, attributes)
+  _context.span = span_
+  try:
+    yield span_
+  finally:
+    span_.end_time = time.time()
+    _context.span = parent
+    _export(span_)
+
+
+def set_exporter(exporter):
+  global _exporter
+  _exporter = exporter
+
+
+def _export(span_):
+  if _exporter is None:
+    return
+  try:
+    _exporter.export(span_)
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Failed to export span %s', span_.name)
+
+
+def render_timeline(spans, trace_id=None):
+  """Returns spans of a trace in the Chrome trace event format.
+
+  Every trace gets its own process row and spans are nested by time. The
+  result can be saved as JSON and loaded in chrome://tracing.
+  """
+  events = []
+  for span_ in spans:
+    if trace_id is not None and span_['trace_id'] != trace_id:
+      continue
+    args = dict(span_['attributes'])
+    args.update(span_id=span_['span_id'], parent_id=span_['parent_id'])
+    events.append({
+        'name': span_['name'],
+        'ph': 'X',
+        'ts': int(span_['start_time'] * 1e6),
+        'dur': int((span_['end_time'] - span_['start_time']) * 1e6),
+        'pid': span_['trace_id'],
+        'tid': span_['attributes'].get('job_id', 0),
+        'args': args,
+    })
+  events.sort(key=lambda event: event['ts'])
+  return {'traceEvents': events}
@@ -0,0 +1,95 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Media uploads for Google API clients."""
+
+from cStringIO import StringIO
+import csv
+
+from apiclient.http import MediaUpload
+
+
+class CSVRowsUpload(MediaUpload):
+  """Resumable upload of rows encoded to CSV on the fly.
+
+  Only the bytes from the last requested offset are kept in memory, as the
+  upload never asks for bytes it has already committed. Rows are read again
+  from the start if an earlier offset is requested.
+  """
+
+  def __init__(self, header, get_rows, chunksize):
+    super(CSVRowsUpload, self).__init__()
+    self._header = header
+    self._get_rows = get_rows
+    self._chunksize = chunksize
+    self._rows = None
+    self._buffer = ''
+    self._buffer_start = 0
+    self._line = StringIO()
+    self._writer = csv.writer(self._line, lineterminator='\n')
+
+  def chunksize(self):
+    return self._chunksize
+
+  def mimetype(self):
+    return 'application/octet-stream'
+
+  def size(self):
+    return None
+
+  def resumable(self):
+    return True
+
+  def has_stream(self):
+    return False
+
+  def _encode(self, row):
+    values = []
+    for value in row:
+      if value is None:
+        value = ''
+      elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+      elif isinstance(value, float):
+        value = repr(value)
+      values.append(value)
+    self._line.seek(0)
+    self._line.truncate()
+    self._writer.writerow(values)
+    return self._line.getvalue()
+
+  def getbytes(self, begin, length):
+    if self._rows is None or begin < self._buffer_start:
+      self._rows = iter(self._get_rows())
+      self._buffer = self._encode(self._header)
+      self._buffer_start = 0
+    offset = begin - self._buffer_start
+    parts = [self._buffer]
+    size = len(self._buffer)
+    while size < offset + length:
+      row = next(self._rows, None)
+      if row is None:
+        break
+      line = self._encode(row)
+      if size + len(line) <= offset:
+        # Skips rows committed by a previous attempt.
+        offset -= size + len(line)
+        parts = []
+        size = 0
+      else:
+        parts.append(line)
+        size += len(line)
+    self._buffer = ''.join(parts)[offset:]
+    self._buffer_start = begin
+    return self._buffer[:length]
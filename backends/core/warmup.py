@@ -0,0 +1,55 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Warm-up of new instances, before they serve their first request.
+
+Every step is best effort: a failed step is logged and the instance starts
+anyway, as the request that needed it would just pay for it again.
+"""
+
+import logging
+
+from core import database
+
+
+def _run_step(name, func):
+  try:
+    func()
+  except Exception:  # pylint: disable=broad-except
+    logging.exception('Warm-up step failed: %s', name)
+
+
+def _open_db_connection():
+  # Checked in connections stay in the engine pool for the next requests.
+  with database.engine.connect() as connection:
+    connection.execute('SELECT 1')
+
+
+def _load_worker_clients():
+  from core import workers
+  for module in workers.CLIENT_MODULES:
+    module.resolve()
+  credentials = workers.get_credentials()
+  credentials.get_access_token()
+  # Fills the discovery document cache used by the API client library.
+  for version in ('v3', 'v4'):
+    workers.discovery.build('analytics', version, credentials=credentials)
+
+
+def warm_up_database():
+  _run_step('database', _open_db_connection)
+
+
+def warm_up_workers():
+  _run_step('workers', _load_worker_clients)
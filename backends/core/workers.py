@@ -19,27 +19,44 @@ from datetime import datetime
 from datetime import timedelta
 from fnmatch import fnmatch
 from functools import wraps
+import hashlib
+import itertools
 import json
+import logging
+import math
 import os
 from random import random
+import re
+import threading
 import time
 import urllib
 import uuid
 
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-from apiclient.http import MediaIoBaseUpload
-import cloudstorage as gcs
-from oauth2client.service_account import ServiceAccountCredentials
-import requests
-from google.cloud import bigquery
-from google.cloud.exceptions import ClientError
-
+from core import tracing
+from core.concurrency import ThreadPool
+from core.lazy import LazyModule
+
+# Client libraries are imported on first use to keep importing this module
+# cheap, as ibackend only needs worker params.
+avro_datafile = LazyModule('avro.datafile')
+avro_io = LazyModule('avro.io')
+bigquery = LazyModule('google.cloud.bigquery')
+cloud_exceptions = LazyModule('google.cloud.exceptions')
+discovery = LazyModule('apiclient.discovery')
+gcs = LazyModule('cloudstorage')
+http = LazyModule('apiclient.http')
+http_errors = LazyModule('apiclient.errors')
+requests = LazyModule('requests')
+service_account = LazyModule('oauth2client.service_account')
+CLIENT_MODULES = (avro_datafile, avro_io, bigquery, cloud_exceptions,
+                  discovery, gcs, http, http_errors, requests,
+                  service_account)
 
 _KEY_FILE = os.path.join(os.path.dirname(__file__), '..', 'data',
                          'service-account.json')
 AVAILABLE = (
     'BQQueryLauncher',
+    'BQToGADataImporter',
     'BQToMeasurementProtocol',
     'BQToStorageExporter',
     'Commenter',
@@ -47,6 +64,7 @@ AVAILABLE = (
     'GADataImporter',
     'GAToBQImporter',
     'MLPredictor',
+    'MeasurementProtocolReplayer',
     'StorageCleaner',
     'StorageToBQImporter',
 )
@@ -58,6 +76,74 @@ DEFAULT_MAX_RETRIES = os.environ.get('MAX_RETRIES', 5)
 # pylint: disable=too-few-public-methods
 
 
+_credentials = None
+_credentials_lock = threading.Lock()
+
+
+def get_credentials():
+  """Returns service account credentials shared by workers of the instance.
+
+  Sharing them saves parsing the key file for every client and lets clients
+  reuse the OAuth access token until it expires.
+  """
+  global _credentials
+  with _credentials_lock:
+    if _credentials is None:
+      _credentials = (service_account.ServiceAccountCredentials
+                      .from_json_keyfile_name(_KEY_FILE))
+  return _credentials
+
+
+def _split_date_range(start_date, end_date, parts):
+  """Splits date range into consecutive sub-ranges of nearly equal length."""
+  days = (end_date - start_date).days + 1
+  parts = min(parts, days)
+  date_ranges = []
+  for i in xrange(parts):
+    part_days = days / parts + (1 if i < days % parts else 0)
+    part_end_date = start_date + timedelta(part_days - 1)
+    date_ranges.append((start_date, part_end_date))
+    start_date = part_end_date + timedelta(1)
+  return date_ranges
+
+
+def _parse_date(date_str):
+  """Returns date of a YYYY-MM-DD string, None for other GA dates."""
+  try:
+    return datetime.strptime(date_str, '%Y-%m-%d').date()
+  except ValueError:
+    return None
+
+
+def _merge_date_ranges(date_ranges):
+  """Merges GA date ranges overlapping or following one another.
+
+  Ranges are pairs of date strings, those which aren't YYYY-MM-DD dates are
+  kept as they are.
+  """
+  merged = []
+  for start_date, end_date in sorted(date_ranges):
+    if merged:
+      last_end = _parse_date(merged[-1][1])
+      start = _parse_date(start_date)
+      if (last_end is not None and start is not None
+          and start <= last_end + timedelta(1)):
+        merged[-1][1] = max(merged[-1][1], end_date)
+        continue
+    merged.append([start_date, end_date])
+  return merged
+
+
+def _covers(date_range, start_date, end_date):
+  """Tells whether a GA date range includes another one."""
+  if date_range[0] == start_date and date_range[1] == end_date:
+    return True
+  dates = [_parse_date(d) for d in list(date_range) + [start_date, end_date]]
+  if None in dates:
+    return False
+  return dates[0] <= dates[2] and dates[3] <= dates[1]
+
+
 class WorkerException(Exception):
   """Worker execution exceptions expected in task handler."""
 
@@ -75,9 +161,25 @@ class Worker(object):
   # Maximum number of execution attempts.
   MAX_ATTEMPTS = 3
 
-  def __init__(self, params, pipeline_id, job_id):
+  # Seconds a task may run before handing the rest of its work over to a
+  # continuation task, see `should_yield`.
+  TIME_BUDGET = 9 * 60
+
+  # Seconds left to the budget when workers should yield, to finish the step
+  # in progress and the bookkeeping of the task.
+  YIELD_MARGIN = 60
+
+  # Worker parameter carrying the state a continuation task starts from.
+  CONTINUATION_PARAM = 'continuation'
+
+  def __init__(self, params, pipeline_id, job_id, task_name=None):
+    self._started_at = time.time()
     self._pipeline_id = pipeline_id
     self._job_id = job_id
+    self._task_name = task_name
+    # A continuation starts from the state it was given as if it was saved
+    # by a previous attempt of the task.
+    self._checkpoint = params.pop(self.CONTINUATION_PARAM, None)
     self._params = params
     for p in self.PARAMS:
       try:
@@ -85,15 +187,28 @@ class Worker(object):
       except KeyError:
         self._params[p[0]] = p[3]
     self._workers_to_enqueue = []
+    self._log_buffer = None
+    self._counters = {'rows': 0, 'bytes': 0, 'api_calls': 0}
+    self._counters_lock = threading.Lock()
+    self._trace_id = tracing.current_trace_id()
+    self._checkpoint_lock = threading.Lock()
 
   def _log(self, level, message, *substs):
-    from core import cloud_logging
-    self.retry(cloud_logging.logger.log_struct)({
-        'labels': {
-            'pipeline_id': self._pipeline_id,
-            'job_id': self._job_id,
-            'worker_class': self.__class__.__name__,
-        },
+    if self._log_buffer is None:
+      from core import cloud_logging
+      # Log writes aren't calls made by the worker, they aren't counted.
+      self._log_buffer = cloud_logging.LogBuffer(
+          cloud_logging.logger,
+          lambda func: self.retry(func, count_calls=False))
+    labels = {
+        'pipeline_id': self._pipeline_id,
+        'job_id': self._job_id,
+        'worker_class': self.__class__.__name__,
+    }
+    if self._trace_id is not None:
+      labels['trace_id'] = self._trace_id
+    self._log_buffer.log_struct({
+        'labels': labels,
         'log_level': level,
         'message': message % substs,
     })
@@ -107,13 +222,73 @@ class Worker(object):
   def log_error(self, message, *substs):
     self._log('ERROR', message, *substs)
 
+  def count(self, name, value=1):
+    """Adds value to a counter of the task metrics (rows, bytes, api_calls)."""
+    with self._counters_lock:
+      self._counters[name] += value
+
+  @property
+  def counters(self):
+    with self._counters_lock:
+      return dict(self._counters)
+
+  def restore_checkpoint(self, state):
+    """Sets the state saved by a previous attempt of the task."""
+    self._checkpoint = state
+
+  def load_checkpoint(self):
+    """Returns the last saved state of the task, None if there is none."""
+    return self._checkpoint
+
+  def save_checkpoint(self, state):
+    """Saves a small JSON serializable state to resume from if retried.
+
+    Workers save the state once their progress is committed, e.g. when rows
+    are written to the destination, and the task handler restores it before
+    executing the task again, so that the retry skips the work already done.
+    The state is only kept until the task is finished. It's to be called
+    from the task thread, as database sessions are bound to threads.
+    """
+    with self._checkpoint_lock:
+      self._checkpoint = state
+      if self._task_name is not None:
+        from core.models import TaskCheckpoint
+        TaskCheckpoint.save_state(self._job_id, self._task_name, state)
+
+  def time_left(self):
+    """Returns seconds left to the time budget of the task."""
+    return self.TIME_BUDGET - (time.time() - self._started_at)
+
+  def should_yield(self):
+    """Tells whether the worker should stop and continue in a new task.
+
+    Workers processing inputs of any size check it between steps and call
+    `_enqueue_continuation` with the state to resume from when it's True,
+    so that each task runs for a bounded time.
+    """
+    return self.time_left() < self.YIELD_MARGIN
+
+  def flush_logs(self):
+    """Writes buffered log entries, to be called once the task is over.
+
+    A failed write is reported to the App Engine log only, so that the task
+    isn't executed again because of its log.
+    """
+    if self._log_buffer is not None:
+      try:
+        self._log_buffer.flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.error('Failed to write log entries of job %s: %s',
+                      self._job_id, e)
+
   def execute(self):
     self.log_info('Started with params: %s',
                   json.dumps(self._params, sort_keys=True, indent=2,
                              separators=(', ', ': ')))
     try:
-      self._execute()
-    except ClientError as e:
+      with tracing.span('worker.execute'):
+        self._execute()
+    except cloud_exceptions.ClientError as e:
       raise WorkerException(e)
     self.log_info('Finished successfully')
     return self._workers_to_enqueue
@@ -125,23 +300,44 @@ class Worker(object):
   def _enqueue(self, worker_class, worker_params, delay=0):
     self._workers_to_enqueue.append((worker_class, worker_params, delay))
 
-  def retry(self, func, max_retries=DEFAULT_MAX_RETRIES):
-    """Decorator implementing retries with exponentially increasing delays."""
+  def _enqueue_continuation(self, state, delay=0):
+    """Enqueues the same worker with the same params to resume from state.
+
+    The continuation gets state as its checkpoint, see `load_checkpoint`.
+    """
+    params = self._params.copy()
+    params[self.CONTINUATION_PARAM] = state
+    self._enqueue(self.__class__.__name__, params, delay)
+    self.log_info('Time budget spent, the work continues in a new task.')
+
+  def retry(self, func, max_retries=DEFAULT_MAX_RETRIES, count_calls=True):
+    """Decorator implementing retries with exponentially increasing delays.
+
+    Calls are counted in the api_calls task metric, unless count_calls is
+    False.
+    """
     @wraps(func)
     def func_with_retries(*args, **kwargs):
       """Retriable version of function being decorated."""
       tries = 0
       while tries < max_retries:
+        if count_calls:
+          self.count('api_calls')
         try:
           return func(*args, **kwargs)
-        except HttpError as e:
-          # If it is a client side error, then there's no reason to retry.
+        except http_errors.HttpError as e:
+          # If it is a client side error, then there's no reason to retry,
+          # unless the request was rejected because of a rate limit.
           if e.resp.status > 399 and e.resp.status < 500:
-            raise e
+            if e.resp.status != 429:
+              raise e
         except Exception as e:  # pylint: disable=broad-except
-          tries += 1
-          delay = 5 * 2 ** (tries + random())
-          time.sleep(delay)
+          pass
+        tries += 1
+        delay = 5 * 2 ** (tries + random())
+        time.sleep(delay)
+      if count_calls:
+        self.count('api_calls')
       return func(*args, **kwargs)
     return func_with_retries
 
@@ -186,7 +382,9 @@ class BQWorker(Worker):
     all_jobs_done = False
     while not all_jobs_done:
       wait_time += delay
-      if wait_time > 300:  # If 5 minutes passed, then spawn BQWaiter.
+      # If 5 minutes passed or the task is running out of time, then spawn
+      # BQWaiter.
+      if wait_time > 300 or self.should_yield():
         worker_params = {
             'job_names': [job.name for job in jobs],
             'bq_project_id': self._params['bq_project_id']
@@ -387,9 +585,11 @@ class BQToStorageExporter(BQWorker):
 class GAWorker(Worker):
   """Abstract class with GA-specific methods."""
 
+  def _get_ga_client(self, v='v4'):
+    return discovery.build('analytics', v, credentials=get_credentials())
+
   def _ga_setup(self, v='v4'):
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(_KEY_FILE)
-    self._ga_client = build('analytics', v, credentials=credentials)
+    self._ga_client = self._get_ga_client(v)
 
 
 class GAToBQImporter(BQWorker, GAWorker):
@@ -400,16 +600,30 @@ class GAToBQImporter(BQWorker, GAWorker):
       ('start_date', 'string', True, '', 'Start date (e.g. 2015-12-31)'),
       ('end_date', 'string', True, '', 'End date (e.g. 2016-12-31)'),
       ('day_by_day', 'boolean', True, False, 'Fetch data day by day'),
+      ('parallel_days', 'number', False, 1,
+       'Days to fetch in parallel when fetching day by day'),
+      ('days_per_task', 'number', False, 1,
+       'Days to fetch in a single task when fetching day by day'),
       ('metrics', 'string_list', True, '', 'Metrics (e.g. ga:users)'),
       ('dimensions', 'string_list', False, '', 'Dimensions (e.g. ga:source)'),
       ('filters', 'string', False, '',
        'Filters (e.g. ga:deviceCategory==mobile)'),
       ('include_empty_rows', 'boolean', True, False, 'Include empty rows'),
+      ('split_sampled_ranges', 'boolean', True, True,
+       'Split date ranges returning sampled data'),
       ('bq_project_id', 'string', False, '', 'BQ Project ID'),
       ('bq_dataset_id', 'string', True, '', 'BQ Dataset ID'),
       ('bq_table_id', 'string', True, '', 'BQ Table ID'),
   ]
 
+  # Maximum number of views fetched at the same time. Reporting API v4 allows
+  # 10 concurrent requests per view and limits requests per user, so keep it
+  # modest and let `retry` back off when a request is throttled.
+  MAX_CONCURRENT_VIEWS = 5
+
+  # Seconds between checkpoints of the reports progress while fetching.
+  CHECKPOINT_INTERVAL = 30
+
   def _compose_report(self):
     dimensions = [{'name': d} for d in self._params['dimensions']]
     metrics = [{'expression': m} for m in self._params['metrics']]
@@ -426,87 +640,236 @@ class GAToBQImporter(BQWorker, GAWorker):
         'pageSize': 10000,
     }
 
-  def _get_report(self, view_id, start_date, end_date):
-    # TODO(dulacp): refactor this method, too complex branching logic
+  def _get_thread_ga_client(self):
+    """Returns GA client of the current thread, httplib2 isn't thread-safe."""
+    try:
+      return self._thread_data.ga_client
+    except AttributeError:
+      self._thread_data.ga_client = self._get_ga_client()
+      return self._thread_data.ga_client
+
+  def _add_rows(self, report, view_id, start_date, end_date):
+    dimensions = [d.replace(':', '_') for d in
+                  report['columnHeader'].get('dimensions', [])]
+    metrics = [m['name'].replace(':', '_') for m in
+               report['columnHeader']['metricHeader']['metricHeaderEntries']]
+    ga_row = {
+        'view_id': view_id,
+        'start_date': start_date,
+        'end_date': end_date,
+    }
+    bq_rows = []
+    for row in report['data'].get('rows', []):
+      for dimension, value in zip(dimensions, row.get('dimensions', [])):
+        ga_row[dimension] = value
+      for metric, value in zip(metrics, row['metrics'][0]['values']):
+        ga_row[metric] = value
+      bq_rows.append(tuple(ga_row.get(f.name) for f in self._table.schema))
+    self.count('rows', len(bq_rows))
+    with self._bq_rows_lock:
+      self._bq_rows += bq_rows
+      # The report is fetched up to here once these rows are inserted.
+      self._pending_reports[(view_id, start_date, end_date)] = report.get(
+          'nextPageToken', True)
+      self._flush()
+    return len(bq_rows)
+
+  def _split_sampled_range(self, report, start_date, end_date):
+    """Returns date sub-ranges to fetch instead of a sampled date range.
+
+    The range is split in as many parts as the sampling ratio suggests, so
+    each part is likely to be unsampled and only parts that still come back
+    sampled get split again. Returns an empty list if the range is a single
+    day or isn't a pair of YYYY-MM-DD dates.
+    """
+    samples_read = int(report['data']['samplesReadCounts'][0])
+    sampling_space = int(report['data']['samplingSpaceSizes'][0])
+    try:
+      start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+      end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
+    except ValueError:
+      return []
+    if start_date == end_date:
+      return []
+    parts = max(2, int(math.ceil(float(sampling_space) / samples_read)))
+    return [(s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')) for s, e in
+            _split_date_range(start_date, end_date, parts)]
+
+  def _report_key(self, view_id, start_date, end_date):
+    return '%s_%s_%s' % (view_id, start_date, end_date)
 
+  def _get_report(self, view_id, start_date, end_date):
     log_str = 'View ID %s from %s till %s' % (view_id, start_date, end_date)
-    self.log_info('Fetch for %s started', log_str)
+    if any(_covers(r, start_date, end_date)
+           for r in self._fetched.get(view_id, [])):
+      self.log_info('Fetch for %s skipped, it was done by a previous attempt',
+                    log_str)
+      return
+    progress = self._reports.get(self._report_key(view_id, start_date,
+                                                  end_date))
+    if self.should_yield():
+      self._yielded = True
+      return
     rows_fetched = 0
-    self._request['view_id'] = view_id
-    self._request['dateRanges'] = [{
+    request = self._request.copy()
+    request['viewId'] = view_id
+    request['dateRanges'] = [{
         'startDate': start_date,
         'endDate': end_date,
     }]
-    body = {'reportRequests': [self._request]}
+    if progress is not None:
+      self.log_info('Fetch for %s resumed', log_str)
+      request['pageToken'] = progress
+    else:
+      self.log_info('Fetch for %s started', log_str)
+    body = {'reportRequests': [request]}
+    ga_client = self._get_thread_ga_client()
     while True:
-      request = self._ga_client.reports().batchGet(body=body)
-      response = self.retry(request.execute)()
+      response = self.retry(ga_client.reports().batchGet(body=body).execute)()
       report = response['reports'][0]
-      dimensions = [d.replace(':', '_') for d in
-                    report['columnHeader']['dimensions']]
-      metrics = [m['name'].replace(':', '_') for m in
-                 report['columnHeader']['metricHeader']['metricHeaderEntries']]
-      ga_row = {
-          'view_id': view_id,
-          'start_date': start_date,
-          'end_date': end_date,
-      }
-      for row in report['data']['rows']:
-        for dimension, value in zip(dimensions, row['dimensions']):
-          ga_row[dimension] = value
-        for metric, value in zip(metrics, row['metrics'][0]['values']):
-          ga_row[metric] = value
-        bq_row = []
-        for field in self._table.schema:
-          try:
-            bq_row.append(ga_row[field.name])
-          except KeyError:
-            bq_row.append(None)
-        self._bq_rows.append(tuple(bq_row))
-      self._flush()
-      rows_fetched += len(report['data']['rows'])
-      try:
-        self._request['pageToken'] = report['nextPageToken']
-      except KeyError:
-        try:
-          del self._request['pageToken']
-        except KeyError:
-          pass
+      if ('pageToken' not in request
+          and report['data'].get('samplesReadCounts')):
+        date_ranges = []
+        if self._params['split_sampled_ranges']:
+          date_ranges = self._split_sampled_range(report, start_date, end_date)
+        if date_ranges:
+          self.log_info('Data is sampled for %s, fetching it in %i parts',
+                        log_str, len(date_ranges))
+          for sub_start_date, sub_end_date in date_ranges:
+            self._get_report(view_id, sub_start_date, sub_end_date)
+          return
+        self.log_warn('Data is sampled for %s', log_str)
+      rows_fetched += self._add_rows(report, view_id, start_date, end_date)
+      if 'nextPageToken' not in report:
+        break
+      request['pageToken'] = report['nextPageToken']
+      if self.should_yield():
+        # Next pages are fetched by the continuation.
+        self._yielded = True
         break
     self.log_info('%i rows of data fetched for %s', rows_fetched, log_str)
 
+  def _get_reports(self, start_date, end_date):
+    """Fetches reports for all views, several views at a time.
+
+    NB: Reporting API v4 requires all report requests of a batchGet call to
+        have the same view and date ranges, so views can't share a call.
+    """
+    view_ids = self._params['view_ids']
+    pool_size = min(self.MAX_CONCURRENT_VIEWS, len(view_ids))
+    with ThreadPool(pool_size, max_pending=len(view_ids)) as pool:
+      futures = [pool.submit(self._get_report, v, start_date, end_date)
+                 for v in view_ids]
+      # Progress is checkpointed from the task thread only, as database
+      # sessions are bound to threads.
+      for future in futures:
+        while not future.wait(self.CHECKPOINT_INTERVAL):
+          self._save_progress()
+    # Progress of the views fetched is kept even if another view failed.
+    self._save_progress()
+    for future in futures:
+      future.result()
+    self._flush(forced=True)
+    self._save_progress()
+
+  def _fan_out(self, start_date, end_date):
+    """Splits date range between importers fetching their days in parallel.
+
+    Each importer fetches its own consecutive days one after another, so no
+    more than `parallel_days` tasks are running at the same time. The job
+    succeeds once all of them are finished.
+    """
+    date_ranges = _split_date_range(
+        start_date, end_date, int(self._params['parallel_days']))
+    for shard_start_date, shard_end_date in date_ranges:
+      params = self._params.copy()
+      params['start_date'] = shard_start_date.strftime('%Y-%m-%d')
+      params['end_date'] = shard_end_date.strftime('%Y-%m-%d')
+      params['parallel_days'] = 1
+      self._enqueue(self.__class__.__name__, params)
+    self.log_info('Date range split between %i parallel importers.',
+                  len(date_ranges))
+
   def _flush(self, forced=False):
-    if self._bq_rows:
-      if forced or len(self._bq_rows) > 9999:
-        for i in xrange(0, len(self._bq_rows), 10000):
-          self._table.insert_data(self._bq_rows[i:i + 10000])
-        self._bq_rows = []
+    """Inserts buffered rows into BQ and commits the reports progress."""
+    if forced or len(self._bq_rows) > 9999:
+      for i in xrange(0, len(self._bq_rows), 10000):
+        self._table.insert_data(self._bq_rows[i:i + 10000])
+      self._bq_rows = []
+      for report, progress in self._pending_reports.iteritems():
+        view_id, start_date, end_date = report
+        key = self._report_key(view_id, start_date, end_date)
+        if progress is True:
+          # Views are fetched in date order, so their finished reports merge
+          # into a date range or a few.
+          self._reports.pop(key, None)
+          self._fetched[view_id] = _merge_date_ranges(
+              self._fetched.get(view_id, []) + [[start_date, end_date]])
+        else:
+          self._reports[key] = progress
+      self._pending_reports = {}
+
+  def _progress(self):
+    return {'reports': dict(self._reports), 'fetched': dict(self._fetched)}
+
+  def _save_progress(self):
+    """Checkpoints the reports progress if it has changed since last time."""
+    with self._bq_rows_lock:
+      progress = self._progress()
+    if progress != self._saved_progress:
+      self.save_checkpoint(progress)
+      self._saved_progress = progress
+
+  def _fetch_days(self, start_date, end_date):
+    """Fetches first days of the range and enqueues importer for the rest."""
+    days_per_task = max(int(self._params['days_per_task']), 1)
+    last_date = min(start_date + timedelta(days_per_task - 1), end_date)
+    day = start_date
+    while day <= last_date:
+      date_str = day.strftime('%Y-%m-%d')
+      self._get_reports(date_str, date_str)
+      if self._yielded:
+        self._enqueue_continuation(self.load_checkpoint())
+        return
+      day += timedelta(1)
+    if last_date != end_date:
+      params = self._params.copy()
+      params['start_date'] = day.strftime('%Y-%m-%d')
+      self._enqueue(self.__class__.__name__, params)
 
-  def _execute(self):
+  def _setup(self):
     self._bq_setup()
     self._table.reload()
-    self._ga_setup()
     self._compose_report()
+    self._thread_data = threading.local()
     self._bq_rows = []
+    self._bq_rows_lock = threading.Lock()
+    checkpoint = self.load_checkpoint() or {}
+    # Reports partly fetched by previous attempts, mapped to the token of
+    # their next page to fetch.
+    self._reports = dict(checkpoint.get('reports', {}))
+    # Date ranges fetched by previous attempts, merged per view.
+    self._fetched = dict(checkpoint.get('fetched', {}))
+    self._saved_progress = self._progress()
+    self._pending_reports = {}
+    self._yielded = False
+
+  def _execute(self):
     if self._params['day_by_day']:
       start_date = datetime.strptime(
           self._params['start_date'], '%Y-%m-%d').date()
       end_date = datetime.strptime(
           self._params['end_date'], '%Y-%m-%d').date()
-      date_str = start_date.strftime('%Y-%m-%d')
-      for view_id in self._params['view_ids']:
-        self._get_report(view_id, date_str, date_str)
-      self._flush(forced=True)
-      if start_date != end_date:
-        start_date += timedelta(1)
-        params = self._params.copy()
-        params['start_date'] = start_date.strftime('%Y-%m-%d')
-        self._enqueue(self.__class__.__name__, params)
+      if self._params['parallel_days'] > 1 and start_date != end_date:
+        self._fan_out(start_date, end_date)
+      else:
+        self._setup()
+        self._fetch_days(start_date, end_date)
     else:
-      for view_id in self._params['view_ids']:
-        self._get_report(
-            view_id, self._params['start_date'], self._params['end_date'])
-      self._flush(forced=True)
+      self._setup()
+      self._get_reports(self._params['start_date'], self._params['end_date'])
+      if self._yielded:
+        self._enqueue_continuation(self.load_checkpoint())
 
 
 class GADataImporter(GAWorker):
@@ -526,38 +889,103 @@ class GADataImporter(GAWorker):
   ]
 
   _BUFFER_SIZE = 256 * 1024
+  # Chunks of a resumable upload must be multiples of 256KB.
+  _MIN_CHUNK_SIZE = 256 * 1024
+  _MAX_CHUNK_SIZE = 32 * _MIN_CHUNK_SIZE
+  _SECONDS_PER_CHUNK = 10
+
+  def _resume_upload(self, request, etag):
+    """Resumes the upload session left by a previous attempt of this task."""
+    session = (self.load_checkpoint() or {}).get('upload')
+    if session is None or session['etag'] != etag:
+      return
+    request.resumable_uri = session['uri']
+    request.resumable_progress = session['progress']
+    # Makes the next call ask GA how many bytes it has actually received.
+    request._in_error_state = True  # pylint: disable=protected-access
+    self.log_info('Resuming upload from byte %i.', session['progress'])
+
+  def _save_upload_session(self, request, etag):
+    if request.resumable_uri is None:
+      return
+    self.save_checkpoint({
+        'upload': {
+            'uri': request.resumable_uri,
+            'progress': request.resumable_progress,
+            'etag': etag,
+        },
+    })
+
+  def _adapt_chunk_size(self, media, uploaded_bytes, elapsed):
+    """Sizes next chunks to take about _SECONDS_PER_CHUNK to upload."""
+    if uploaded_bytes <= 0:
+      return
+    bytes_per_second = uploaded_bytes / max(elapsed, 0.001)
+    chunks = int(bytes_per_second * self._SECONDS_PER_CHUNK
+                 / self._MIN_CHUNK_SIZE)
+    media._chunksize = min(  # pylint: disable=protected-access
+        max(chunks, 1) * self._MIN_CHUNK_SIZE, self._MAX_CHUNK_SIZE)
 
   def _upload(self):
-    with gcs.open(self._file_name, read_buffer_size=self._BUFFER_SIZE) as f:
-      media = MediaIoBaseUpload(f, mimetype='application/octet-stream',
-                                chunksize=self._BUFFER_SIZE, resumable=True)
-      request = self._ga_client.management().uploads().uploadData(
-          accountId=self._account_id,
-          webPropertyId=self._params['property_id'],
-          customDataSourceId=self._params['dataset_id'],
-          media_body=media)
-      response = None
-      tries = 0
-      milestone = 0
-      while response is None and tries < 5:
-        try:
-          status, response = request.next_chunk()
-        except HttpError, e:
-          if e.resp.status in [404, 500, 502, 503, 504]:
-            tries += 1
-            delay = 5 * 2 ** (tries + random())
-            self.log_warn('%s, Retrying in %.1f seconds...', e, delay)
-            time.sleep(delay)
-          else:
-            raise WorkerException(e)
+    file_name = self._params['csv_uri'].replace('gs:/', '')
+    etag = gcs.stat(file_name).etag
+    with gcs.open(file_name, read_buffer_size=self._BUFFER_SIZE) as f:
+      media = http.MediaIoBaseUpload(f, mimetype='application/octet-stream',
+                                     chunksize=self._MIN_CHUNK_SIZE,
+                                     resumable=True)
+      self._upload_media(media, etag)
+
+  def _upload_media(self, media, etag):
+    """Uploads media to the GA dataset, etag identifies the media content."""
+    request = self._ga_client.management().uploads().uploadData(
+        accountId=self._account_id,
+        webPropertyId=self._params['property_id'],
+        customDataSourceId=self._params['dataset_id'],
+        media_body=media)
+    self._resume_upload(request, etag)
+    response = None
+    error = None
+    tries = 0
+    milestone = 0
+    while response is None and tries < 5:
+      progress_before = request.resumable_progress
+      started_at = time.time()
+      status = None
+      try:
+        status, response = request.next_chunk()
+      except http_errors.HttpError, e:
+        error = e
+        if e.resp.status in [404, 410] and request.resumable_uri is not None:
+          # The upload session has expired, start over.
+          self.log_warn('Upload session is gone, restarting upload.')
+          request.resumable_uri = None
+          request.resumable_progress = 0
+          request._in_error_state = False  # pylint: disable=protected-access
+          self.save_checkpoint({})
+          tries += 1
+        elif e.resp.status in [404, 500, 502, 503, 504]:
+          tries += 1
+          delay = 5 * 2 ** (tries + random())
+          self.log_warn('%s, Retrying in %.1f seconds...', e, delay)
+          time.sleep(delay)
         else:
-          tries = 0
-        if status:
-          progress = int(status.progress() * 100)
-          if progress >= milestone:
-            self.log_info('Uploaded %d%%.', int(status.progress() * 100))
-            milestone += 20
-      self.log_info('Upload Complete.')
+          raise WorkerException(e)
+      else:
+        tries = 0
+        self.count('bytes', request.resumable_progress - progress_before)
+        self._adapt_chunk_size(
+            media, request.resumable_progress - progress_before,
+            time.time() - started_at)
+        self._save_upload_session(request, etag)
+      if status:
+        progress = int(status.progress() * 100)
+        if progress >= milestone:
+          self.log_info('Uploaded %d%%.', int(status.progress() * 100))
+          milestone += 20
+    if response is None:
+      # Lets the task be retried, the retry resumes the upload session.
+      raise error
+    self.log_info('Upload Complete.')
 
   def _delete_older(self, uploads_to_keep):
     request = self._ga_client.management().uploads().list(
@@ -582,7 +1010,6 @@ class GADataImporter(GAWorker):
   def _execute(self):
     self._ga_setup('v3')
     self._account_id = self._params['property_id'].split('-')[1]
-    self._file_name = self._params['csv_uri'].replace('gs:/', '')
     if self._params['max_uploads'] > 0 and self._params['delete_before']:
       self._delete_older(self._params['max_uploads'] - 1)
     self._upload()
@@ -590,11 +1017,152 @@ class GADataImporter(GAWorker):
       self._delete_older(self._params['max_uploads'])
 
 
+class BQToGADataImporter(BQWorker, GADataImporter):
+  """Imports data from a BQ table to GA using Data Import.
+
+  Columns are uploaded in the table order and column names starting with
+  "ga_" are uploaded as "ga:" headers (e.g. ga_dimension1 as ga:dimension1).
+  The table is read page by page and encoded to CSV while uploading, so no
+  intermediate file is needed."""
+
+  PARAMS = [
+      ('bq_project_id', 'string', False, '', 'BQ Project ID'),
+      ('bq_dataset_id', 'string', True, '', 'BQ Dataset ID'),
+      ('bq_table_id', 'string', True, '', 'BQ Table ID'),
+      ('property_id', 'string', True, '',
+       'GA Property Tracking ID (e.g. UA-12345-3)'),
+      ('dataset_id', 'string', True, '',
+       'GA Dataset ID (e.g. sLj2CuBTDFy6CedBJw)'),
+      ('max_uploads', 'number', False, '',
+       'Maximum uploads to keep in GA Dataset (leave empty to keep all)'),
+      ('delete_before', 'boolean', True, False,
+       'Delete older uploads before upload'),
+  ]
+
+  def _upload(self):
+    header = []
+    for field in self._table.schema:
+      if field.name.startswith('ga_'):
+        header.append('ga:%s' % field.name[3:])
+      else:
+        header.append(field.name)
+    from core.uploads import CSVRowsUpload
+    media = CSVRowsUpload(header, self._table.fetch_data,
+                          self._MIN_CHUNK_SIZE)
+    self._upload_media(media, self._table.etag)
+
+  def _execute(self):
+    self._bq_setup()
+    self._table.reload()
+    super(BQToGADataImporter, self)._execute()
+
+
+class _AudienceTemplate(object):
+  """GA audience JSON template compiled to render table rows.
+
+  The template is parsed once, with placeholders replaced by slots bound to
+  column indexes, and compiled to nested functions building the audience
+  from a row, so rendering never parses JSON again. Placeholders inside JSON
+  strings are substituted as text, those outside of strings are parsed as
+  JSON values (e.g. numbers). Templates that can't be compiled this way are
+  rendered with the % operator and parsed row by row.
+  """
+
+  _PLACEHOLDER_REGEX = re.compile(
+      r'%(?:\((\w+)\))?([#0 +\-]*\d*(?:\.\d+)?[diouxXeEfFgGcrs%])')
+  _SLOT_REGEX = re.compile(u'\x00(\\d+)\x00')
+
+  def __init__(self, template, fields):
+    self._template = template
+    self._fields = fields
+    try:
+      self._render = self._compile()
+    except ValueError:
+      self._render = self._render_legacy
+
+  def render(self, row):
+    try:
+      return self._render(row)
+    except ValueError as e:
+      raise WorkerException(e)
+
+  def _render_legacy(self, row):
+    return json.loads(self._template % dict(zip(self._fields, row)))
+
+  def _compile(self):
+    """Returns a function rendering a row, raises ValueError if impossible."""
+    self._slots = []
+    parts = []
+    position = 0
+    in_string = False
+    for match in self._PLACEHOLDER_REGEX.finditer(self._template):
+      text = self._template[position:match.start()]
+      i = 0
+      while i < len(text):
+        if text[i] == '\\' and in_string:
+          i += 1
+        elif text[i] == '"':
+          in_string = not in_string
+        i += 1
+      parts.append(text)
+      position = match.end()
+      name, conversion = match.groups()
+      if conversion == '%':
+        parts.append('%')
+        continue
+      if name not in self._fields:
+        raise WorkerException('Unknown field in template: %s' % name)
+      slot = u'\x00%i\x00' % len(self._slots)
+      self._slots.append(
+          (self._fields.index(name), u'%' + conversion, not in_string))
+      parts.append(slot if in_string else u'"%s"' % slot)
+    parts.append(self._template[position:])
+    return self._compile_value(json.loads(u''.join(parts), strict=False))
+
+  def _compile_value(self, value):
+    """Returns a function building value from a row."""
+    if isinstance(value, dict):
+      items = [(self._compile_value(k), self._compile_value(v))
+               for k, v in value.iteritems()]
+      return lambda row: dict((k(row), v(row)) for k, v in items)
+    if isinstance(value, list):
+      items = [self._compile_value(v) for v in value]
+      return lambda row: [item(row) for item in items]
+    if not isinstance(value, unicode) or u'\x00' not in value:
+      return lambda row: value
+    pieces = self._SLOT_REGEX.split(value)
+    # Odd pieces are slot numbers, even ones are the text around them.
+    slots = [self._slots[int(i)] for i in pieces[1::2]]
+    if len(slots) == 1 and not pieces[0] and not pieces[2]:
+      column, conversion, is_json = slots[0]
+      if is_json:
+        return lambda row: self._render_json(conversion, row[column])
+      return lambda row: conversion % row[column]
+    if any(is_json for _, _, is_json in slots):
+      raise ValueError('Placeholder outside of a JSON string')
+    text_format = pieces[0].replace(u'%', u'%%')
+    for i, (_, conversion, _) in enumerate(slots):
+      text_format += conversion + pieces[2 * i + 2].replace(u'%', u'%%')
+    columns = [column for column, _, _ in slots]
+    return lambda row: text_format % tuple(row[c] for c in columns)
+
+  def _render_json(self, conversion, value):
+    if conversion == u'%s' and isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool):
+      return value
+    return json.loads(conversion % value)
+
+
 class GAAudiencesUpdater(BQWorker, GAWorker):
   """Worker to update GA audiences using values from a BQ table.
   
   See: https://developers.google.com/analytics/devguides/config/mgmt/v3/mgmtReference/management/remarketingAudience#resource
-  for more details on the required GA Audience JSON template format."""
+  for more details on the required GA Audience JSON template format.
+
+  Table rows are processed in batches of 500. Audiences that haven't changed
+  in the BQ table since they were last pushed to GA are skipped without being
+  compared with GA. Changed ones are fetched by the GA ids stored with their
+  fingerprints, GA audiences are listed only to find the others."""
 
   PARAMS = [
       ('property_id', 'string', True, '',
@@ -605,19 +1173,52 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
       ('template', 'text', True, '', 'GA audience JSON template'),
   ]
 
-  def _infer_audiences(self):
-    self._inferred_audiences = {}
-    fields = [f.name for f in self._table.schema]
-    for row in self._table.fetch_data():
-      try:
-        template_rendered = self._params['template'] % dict(zip(fields, row))
-        audience = json.loads(template_rendered)
-      except ValueError as e:
-        raise WorkerException(e)
-      self._inferred_audiences[audience['name']] = audience
-
-  def _get_audiences(self):
-    audiences = []
+  # Requests per HTTP batch, GA Management API counts each of them in quota.
+  BATCH_SIZE = 50
+  # Table rows rendered, compared and written to GA at once.
+  SYNC_SIZE = 500
+
+  def _iter_audience_batches(self, skipped_rows=0):
+    """Renders table rows to audiences, yielding dicts of up to SYNC_SIZE.
+
+    Yields pairs of the number of rows rendered and the audiences dict. The
+    first skipped_rows rows of the table are left out.
+    """
+    template = _AudienceTemplate(self._params['template'],
+                                 [f.name for f in self._table.schema])
+    rows = itertools.islice(self._table.fetch_data(), skipped_rows, None)
+    while True:
+      audiences = {}
+      rows_count = 0
+      for row in itertools.islice(rows, self.SYNC_SIZE):
+        audience = template.render(row)
+        audiences[audience['name']] = audience
+        rows_count += 1
+      if not audiences:
+        return
+      yield rows_count, audiences
+
+  def _fingerprint(self, audience):
+    return hashlib.sha1(json.dumps(audience, sort_keys=True)).hexdigest()
+
+  def _load_fingerprints(self, names):
+    from core.models import AudienceFingerprint
+    fingerprints = AudienceFingerprint.where(
+        property_id=self._params['property_id'], name__in=names).all()
+    return dict((f.name, f) for f in fingerprints)
+
+  def _save_fingerprints(self, audiences, audience_ids):
+    """Stores fingerprints of audiences now identical in GA and BQ table."""
+    from core.models import AudienceFingerprint
+    values = dict((name, (audience_id, self._fingerprint(audiences[name])))
+                  for name, audience_id in audience_ids.iteritems())
+    AudienceFingerprint.save_all(self._params['property_id'], values)
+
+  def _get_audience_ids(self):
+    """Returns names of GA audiences mapped to their ids, listing GA once."""
+    if self._audience_ids is not None:
+      return self._audience_ids
+    self._audience_ids = {}
     start_index = 1
     max_results = 100
     total_results = 100
@@ -630,12 +1231,23 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
       response = self.retry(request.execute)()
       total_results = response['totalResults']
       start_index += max_results
-      audiences += response['items']
-    self._current_audiences = {}
-    names = self._inferred_audiences.keys()
-    for audience in audiences:
-      if audience['name'] in names:
-        self._current_audiences[audience['name']] = audience
+      for audience in response['items']:
+        self._audience_ids[audience['name']] = audience['id']
+    return self._audience_ids
+
+  def _get_audiences(self, audience_ids):
+    """Returns GA audiences mapped to ids, fetched in HTTP batches.
+
+    Audiences not found in GA are left out.
+    """
+    remarketing_audience = self._ga_client.management().remarketingAudience()
+    pending = {}
+    for audience_id in audience_ids:
+      pending[audience_id] = remarketing_audience.get(
+          accountId=self._account_id,
+          webPropertyId=self._params['property_id'],
+          remarketingAudienceId=audience_id)
+    return self._execute_in_batches(pending, missing_ok=True)
 
   def _equal(self, patch, audience):
     """Checks whether applying a patch would not change an audience.
@@ -670,52 +1282,185 @@ class GAAudiencesUpdater(BQWorker, GAWorker):
           return False
     return True
 
-  def _get_diff(self):
-    """Composes lists of audiences to be created and updated in GA."""
-    self._audiences_to_insert = []
-    self._audiences_to_patch = {}
-    for name in self._inferred_audiences:
-      inferred_audience = self._inferred_audiences[name]
-      if name in self._current_audiences:
-        current_audience = self._current_audiences[name]
-        if not self._equal(inferred_audience, current_audience):
-          self._audiences_to_patch[current_audience['id']] = inferred_audience
-      else:
-        self._audiences_to_insert.append(inferred_audience)
+  def _execute_in_batches(self, pending, missing_ok=False):
+    """Executes requests in HTTP batches, retrying only the failed ones.
+
+    Args:
+        pending: A dict of request ids to API requests.
+        missing_ok: Whether requests failing with 404 Not Found are left out
+            of the responses instead of failing the worker.
+
+    Returns:
+        A dict of request ids to responses.
+    """
+    responses = {}
+    tries = 0
+    while pending:
+      errors = {}
+      def _callback(request_id, response, exception):
+        if exception is not None:
+          errors[request_id] = exception
+        else:
+          responses[request_id] = response
+      request_ids = sorted(pending)
+      for i in xrange(0, len(request_ids), self.BATCH_SIZE):
+        batch = self._ga_client.new_batch_http_request(callback=_callback)
+        for request_id in request_ids[i:i + self.BATCH_SIZE]:
+          batch.add(pending[request_id], request_id=request_id)
+        self.retry(batch.execute)()
+      for request_id, e in errors.items():
+        if (missing_ok and isinstance(e, http_errors.HttpError) and
+            e.resp.status == 404):
+          del errors[request_id]
+          continue
+        # Same as in retry, client side errors other than a rate limit
+        # won't succeed if retried.
+        if (not isinstance(e, http_errors.HttpError) or
+            (399 < e.resp.status < 500 and e.resp.status != 429)):
+          raise WorkerException(e)
+      pending = dict((i, pending[i]) for i in errors)
+      if pending:
+        tries += 1
+        if tries > DEFAULT_MAX_RETRIES:
+          raise WorkerException(errors.values()[0])
+        delay = 5 * 2 ** (tries + random())
+        self.log_warn('%i request(s) failed, retrying in %.1f seconds...',
+                      len(pending), delay)
+        time.sleep(delay)
+    return responses
 
   def _update_ga_audiences(self):
     """Updates and/or creates audiences in GA."""
-    for audience in self._audiences_to_insert:
-      request = self._ga_client.management().remarketingAudience().insert(
+    remarketing_audience = self._ga_client.management().remarketingAudience()
+    pending = {}
+    for i, audience in enumerate(self._audiences_to_insert):
+      pending['insert-%i' % i] = remarketing_audience.insert(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           body=audience)
-      self.retry(request.execute)()
     for audience_id in self._audiences_to_patch:
       audience = self._audiences_to_patch[audience_id]
-      request = self._ga_client.management().remarketingAudience().patch(
+      pending['patch-%s' % audience_id] = remarketing_audience.patch(
           accountId=self._account_id,
           webPropertyId=self._params['property_id'],
           remarketingAudienceId=audience_id,
           body=audience)
-      self.retry(request.execute)()
+    responses = self._execute_in_batches(pending)
+    self._inserted_audience_ids = {}
+    for i, audience in enumerate(self._audiences_to_insert):
+      self._inserted_audience_ids[audience['name']] = \
+          responses['insert-%i' % i]['id']
+    self._inserted_count += len(self._audiences_to_insert)
+    self._patched_count += len(self._audiences_to_patch)
+
+  def _sync(self, audiences):
+    """Syncs a batch of audiences rendered from the BQ table to GA."""
+    self.count('rows', len(audiences))
+    fingerprints = self._load_fingerprints(audiences.keys())
+    changed_audiences = {}
+    for name, audience in audiences.iteritems():
+      fingerprint = fingerprints.get(name)
+      if fingerprint is None or \
+          fingerprint.fingerprint != self._fingerprint(audience):
+        changed_audiences[name] = audience
+    self._unchanged_count += len(audiences) - len(changed_audiences)
+    if not changed_audiences:
+      return
+    self._audiences_to_insert = []
+    self._audiences_to_patch = {}
+    self._synced_audience_ids = {}
+    # Audiences are fetched by the ids stored with their fingerprints. GA is
+    # only listed for audiences without one, or deleted from GA since.
+    stored_ids = dict((n, fingerprints[n].audience_id)
+                      for n in changed_audiences
+                      if n in fingerprints and fingerprints[n].audience_id)
+    unknown_names = [n for n in changed_audiences if n not in stored_ids]
+    unknown_names += self._compare(changed_audiences, stored_ids)
+    if unknown_names:
+      audience_ids = self._get_audience_ids()
+      listed_ids = dict((n, audience_ids[n]) for n in unknown_names
+                        if n in audience_ids)
+      missing_names = self._compare(changed_audiences, listed_ids)
+      for name in unknown_names:
+        if name not in listed_ids or name in missing_names:
+          self._audiences_to_insert.append(changed_audiences[name])
+    self._update_ga_audiences()
+    if self._audience_ids is not None:
+      self._audience_ids.update(self._inserted_audience_ids)
+    self._synced_audience_ids.update(self._inserted_audience_ids)
+    self._save_fingerprints(changed_audiences, self._synced_audience_ids)
+
+  def _compare(self, audiences, audience_ids):
+    """Compares audiences with the GA audiences of the given ids.
+
+    GA audiences are fetched one HTTP batch at a time and compared right away,
+    so that at most BATCH_SIZE of them are held. Those that differ are to be
+    patched.
+
+    Returns:
+        Names of the audiences not found in GA.
+    """
+    missing_names = []
+    names = sorted(audience_ids)
+    for i in xrange(0, len(names), self.BATCH_SIZE):
+      batch_names = names[i:i + self.BATCH_SIZE]
+      current_audiences = self._get_audiences(
+          [audience_ids[n] for n in batch_names])
+      for name in batch_names:
+        audience_id = audience_ids[name]
+        if audience_id not in current_audiences:
+          missing_names.append(name)
+          continue
+        if self._equal(audiences[name], current_audiences[audience_id]):
+          self._unchanged_count += 1
+        else:
+          self._audiences_to_patch[audience_id] = audiences[name]
+        self._synced_audience_ids[name] = audience_id
+    return missing_names
 
   def _execute(self):
     self._account_id = self._params['property_id'].split('-')[1]
     self._bq_setup()
     self._table.reload()
     self._ga_setup('v3')
-    self._infer_audiences()
-    self._get_audiences()
-    self._get_diff()
-    self._update_ga_audiences()
+    self._audience_ids = None
+    # Rows synced by previous attempts are skipped, as their audiences are
+    # already in GA, unless the table has changed since.
+    checkpoint = self.load_checkpoint() or {}
+    if checkpoint.get('table_etag', self._table.etag) != self._table.etag:
+      self.log_warn('Table has changed since the previous attempt, syncing '
+                    'it from the start.')
+      checkpoint = {}
+    synced_rows = checkpoint.get('synced_rows', 0)
+    self._inserted_count = checkpoint.get('inserted', 0)
+    self._patched_count = checkpoint.get('patched', 0)
+    self._unchanged_count = checkpoint.get('unchanged', 0)
+    if synced_rows:
+      self.log_info('Resuming after %i row(s) synced.', synced_rows)
+    for rows_count, audiences in self._iter_audience_batches(synced_rows):
+      self._sync(audiences)
+      synced_rows += rows_count
+      checkpoint = {
+          'table_etag': self._table.etag,
+          'synced_rows': synced_rows,
+          'inserted': self._inserted_count,
+          'patched': self._patched_count,
+          'unchanged': self._unchanged_count,
+      }
+      self.save_checkpoint(checkpoint)
+      if self.should_yield():
+        self._enqueue_continuation(checkpoint)
+        return
+    self.log_info('%i audience(s) inserted, %i patched, %i unchanged.',
+                  self._inserted_count, self._patched_count,
+                  self._unchanged_count)
 
 
 class MLWorker(Worker):
   """Abstract ML Engine worker."""
 
   def _get_ml_client(self):
-    self._ml_client = build('ml', 'v1')
+    self._ml_client = discovery.build('ml', 'v1')
 
   def _get_ml_job_id(self):
     self._ml_job_id = '%s_%i_%i_%s' % (self.__class__.__name__,
@@ -775,52 +1520,136 @@ class MLPredictor(MLWorker):
 
 class MeasurementProtocolException(WorkerException):
   """Measurement Protocol execution exception."""
-  pass
+
+  def __init__(self, message, status_code=None, hits=None):
+    super(MeasurementProtocolException, self).__init__(message)
+    self.status_code = status_code
+    self.hits = hits
+
+
+class _HitEncoder(object):
+  """Encodes BQ rows to Measurement Protocol hits, compiled from the schema.
+
+  Record fields are flattened by concatenating the names (e.g. "id" of a "pr"
+  record becomes "prid") and items of repeated fields get their 1-based index
+  appended (e.g. "pr1id"). Null values are skipped. Parameters of a hit are
+  sorted by name and url-encoded, with the protocol version set to 1 unless
+  the row has a non-null "v" value.
+  """
+
+  def __init__(self, schema):
+    # NB: BQ field names are ASCII letters, digits and underscores, they don't
+    #     need to be url-encoded.
+    self._fields = [(i, str(f.name), self._compile(f))
+                    for i, f in enumerate(schema)]
+    names = [f.name for f in schema]
+    self._version_index = names.index('v') if 'v' in names else None
+
+  def _compile(self, field):
+    """Returns a function appending params of a field value to a list."""
+    if field.field_type == 'RECORD':
+      fields = [(str(f.name), self._compile(f)) for f in field.fields]
+      def _encode(value, name, params):
+        for field_name, encode_field in fields:
+          field_value = value.get(field_name)
+          if field_value is not None:
+            encode_field(field_value, name + field_name, params)
+    else:
+      def _encode(value, name, params):
+        if isinstance(value, unicode):
+          value = value.encode('utf-8')
+        elif not isinstance(value, str):
+          value = str(value)
+        params.append((name, urllib.quote_plus(value)))
+    if field.mode != 'REPEATED':
+      return _encode
+    def _encode_items(value, name, params):
+      for i, item in enumerate(value):
+        if item is not None:
+          _encode(item, '%s%i' % (name, i + 1), params)
+    return _encode_items
+
+  def encode(self, row):
+    params = []
+    if self._version_index is None or row[self._version_index] is None:
+      params.append(('v', '1'))
+    for i, name, encode in self._fields:
+      if row[i] is not None:
+        encode(row[i], name, params)
+    params.sort()
+    return '&'.join(['%s=%s' % param for param in params])
+
+
+_mp_session = None
+_mp_session_lock = threading.Lock()
+
+
+def _get_mp_session():
+  """Returns a shared keep-alive session to Measurement Protocol endpoint."""
+  global _mp_session
+  with _mp_session_lock:
+    if _mp_session is None:
+      session = requests.Session()
+      adapter = requests.adapters.HTTPAdapter(
+          pool_connections=1,
+          pool_maxsize=MeasurementProtocolWorker.MAX_CONCURRENT_BATCHES)
+      session.mount('https://', adapter)
+      _mp_session = session
+  return _mp_session
 
 
 class MeasurementProtocolWorker(Worker):
   """Abstract Measurement Protocol worker."""
-  
-  def _flatten(self, data):
-    flat = False
-    while not flat:
-      flat = True
-      for k in data.keys():
-        if data[k] is None:
-          del data[k]
-        elif isinstance(data[k], list):
-          for i, v in enumerate(data[k]):
-            data['%s%i' % (k, i + 1)] = v
-          del data[k]
-          flat = False
-        elif isinstance(data[k], dict):
-          for l in data[k]:
-            data['%s%s' % (k, l)] = data[k][l]
-          del data[k]
-          flat = False
-
-  def _get_payload_from_data(self, data):
-    self._flatten(data)
-    payload = {'v': 1}  # Use version 1
-    payload.update(data)
-    return payload
-
-  def _prepare_payloads_for_batch_request(self, payloads):
-    """Merges payloads to send them in a batch request.
 
-    Arguments:
-      payloads list of payload, each payload being a dictionary.
+  # Maximum number of batch requests sent at the same time.
+  MAX_CONCURRENT_BATCHES = 10
+
+  # Limits of the batch endpoint, see https://goo.gl/7VeWuB
+  MAX_HITS_PER_BATCH = 20
+  MAX_BATCH_BYTES = 16 * 1024
+  MAX_HIT_BYTES = 8 * 1024
+
+  def _pack_hits(self, hits, max_hits=MAX_HITS_PER_BATCH):
+    """Groups hits into batches filled up to the batch endpoint limits.
 
-    Returns: concatenated url-encoded payloads.
-        For example:
+    Hits over the hit size limit are left out and reported as an error.
+    Sizes of yielded batches are added to self._packed_batches_bytes.
 
-          param1=value10&param2=value20
-          param1=value11&param2=value21
+    Args:
+        hits: An iterable of url-encoded hits.
+        max_hits: Maximum number of hits per batch.
+
+    Yields:
+        Lists of hits.
     """
-    assert isinstance(payloads, list) or isinstance(payloads, tuple)
-    payloads_utf8 = [sorted([(k, unicode(p[k]).encode('utf-8')) for k in p],
-                            key=lambda t: t[0]) for p in payloads]
-    return '\n'.join(map(lambda p: urllib.urlencode(p), payloads_utf8))
+    max_hits = min(max_hits, self.MAX_HITS_PER_BATCH)
+    self._packed_batches_bytes = []
+    oversize_hits = []
+    batch = []
+    batch_bytes = 0
+    for hit in hits:
+      if len(hit) > self.MAX_HIT_BYTES:
+        oversize_hits.append(hit)
+        continue
+      if batch:
+        # Hits are separated by a line break in a batch.
+        new_batch_bytes = batch_bytes + 1 + len(hit)
+        if len(batch) >= max_hits or new_batch_bytes > self.MAX_BATCH_BYTES:
+          self._packed_batches_bytes.append(batch_bytes)
+          yield batch
+          batch = []
+          new_batch_bytes = len(hit)
+      else:
+        new_batch_bytes = len(hit)
+      batch.append(hit)
+      batch_bytes = new_batch_bytes
+    if batch:
+      self._packed_batches_bytes.append(batch_bytes)
+      yield batch
+    if oversize_hits:
+      self.log_error('%i hit(s) over %i bytes not sent, first one: %s',
+                     len(oversize_hits), self.MAX_HIT_BYTES,
+                     oversize_hits[0])
 
   def _send_batch_hits(self, batch_payload, user_agent='CRMint / 0.1'):
     """Sends a batch request to the Measurement Protocol endpoint.
@@ -838,17 +1667,41 @@ class MeasurementProtocolWorker(Worker):
     Raises: MeasurementProtocolException if the HTTP request fails.
     """
     headers = {'user-agent': user_agent}
-    req = requests.post('https://www.google-analytics.com/batch',
-                        headers=headers,
-                        data=batch_payload)
+    req = _get_mp_session().post('https://www.google-analytics.com/batch',
+                                 headers=headers,
+                                 data=batch_payload)
 
     if req.status_code != requests.codes.ok:
-      raise MeasurementProtocolException('Failed to send event hit with status '
-                                         'code (%s) and parameters: %s'
-                                         % (req.status_code, batch_payload))
-
-
-class BQToMeasurementProtocol(BQWorker):
+      raise MeasurementProtocolException(
+          'Failed to send event hit with status code (%s) and parameters: %s'
+          % (req.status_code, batch_payload),
+          status_code=req.status_code,
+          hits=batch_payload.split('\n'))
+
+  def _spool_failed_batches(self, errors, uri_prefix=None):
+    """Writes hits of failed batches to a JSON lines file on GCS.
+
+    Every line holds the status code and the hits of a failed batch, to be
+    resent by MeasurementProtocolReplayer. The file URI starts with
+    uri_prefix, the spool_uri_prefix param by default. Does nothing if there
+    is no prefix.
+    """
+    uri_prefix = uri_prefix or self._params.get('spool_uri_prefix')
+    if not uri_prefix or not errors:
+      return
+    uri = '%s%i_%i_%s.json' % (uri_prefix, self._pipeline_id, self._job_id,
+                               uuid.uuid4())
+    with gcs.open(uri[len('gs:/'):], 'w',
+                  content_type='application/json') as spool_file:
+      for error in errors:
+        spool_file.write(json.dumps({
+            'status_code': error.status_code,
+            'hits': error.hits,
+        }) + '\n')
+    self.log_info('%i failed batch(es) spooled to %s', len(errors), uri)
+
+
+class BQToMeasurementProtocol(StorageWorker, BQWorker):
   """Worker to push data through Measurement Protocol"""
 
   PARAMS = [
@@ -857,6 +1710,12 @@ class BQToMeasurementProtocol(BQWorker):
       ('bq_table_id', 'string', True, '', 'BQ Table ID'),
       ('mp_batch_size', 'number', True, 20, ('Measurement Protocol batch size '
                                              '(https://goo.gl/7VeWuB)')),
+      ('avro_uri_prefix', 'string', False, '',
+       ('Extract the table to Avro files with this URI prefix before sending '
+        '(e.g. gs://bucket/hits/)')),
+      ('spool_uri_prefix', 'string', False, '',
+       ('Write hits of failed batches to files with this URI prefix '
+        '(e.g. gs://bucket/failed-hits/)')),
   ]
 
   # BigQuery batch size for querying results. Default to 1000.
@@ -865,69 +1724,306 @@ class BQToMeasurementProtocol(BQWorker):
   # Maximum number of jobs to enqueued before spawning a new scheduler.
   MAX_ENQUEUED_JOBS = 50
 
-  def _execute(self):
-    self._bq_setup()
-    self._table.reload()
-    page_token = self._params.get('bq_page_token', None)
-    batch_size = self.BQ_BATCH_SIZE
-    query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
-        max_results=batch_size,
-        page_token=page_token)
+  # Seconds to wait before checking the extract job status again.
+  EXTRACT_CHECK_DELAY = 30
+
+  def _schedule_row_ranges(self):
+    # Processors are given row offset ranges computed from the table size, so
+    # no rows are read here. The table metadata is fetched once and handed
+    # down to processors and to the follow-up schedulers.
+    num_rows = self._params.get('bq_num_rows')
+    schema = self._params.get('bq_schema')
+    if num_rows is None or schema is None:
+      self._bq_setup()
+      self._table.reload()
+      num_rows = self._table.num_rows or 0
+      schema = [field.to_api_repr() for field in self._table.schema]
+    start_index = self._params.get('bq_start_index') or 0
 
     enqueued_jobs_count = 0
-    for query_page in query_iterator.pages:  # pylint: disable=unused-variable
-      # Enqueue job for this page
+    while start_index < num_rows:
+      # Spawns a new job to schedule the remaining ranges.
+      if enqueued_jobs_count >= self.MAX_ENQUEUED_JOBS:
+        worker_params = self._params.copy()
+        worker_params['bq_start_index'] = start_index
+        worker_params['bq_num_rows'] = num_rows
+        worker_params['bq_schema'] = schema
+        self._enqueue(self.__class__.__name__, worker_params, 0)
+        return
+
+      # Enqueue job for this range of rows
       worker_params = self._params.copy()
-      worker_params['bq_page_token'] = page_token
+      worker_params.pop('bq_num_rows', None)
+      worker_params['bq_start_index'] = start_index
       worker_params['bq_batch_size'] = self.BQ_BATCH_SIZE
+      worker_params['bq_schema'] = schema
       self._enqueue('BQToMeasurementProtocolProcessor', worker_params, 0)
       enqueued_jobs_count += 1
+      start_index += self.BQ_BATCH_SIZE
 
-      # Updates the page token reference for the next iteration.
-      page_token = query_iterator.next_page_token
+  def _extract_to_avro(self):
+    """Extracts the table to Avro files, returns their names once it's done.
 
-      # Spawns a new job to schedule the remaining pages.
-      if (enqueued_jobs_count >= self.MAX_ENQUEUED_JOBS
-          and page_token is not None):
+    The extract job is started on the first run, then the worker respawns
+    itself until the job is done. Returns None while the job is running.
+    """
+    self._bq_setup()
+    job_name = self._params.get('bq_extract_job_name')
+    if job_name is None:
+      self._table.reload()
+      job_name = self._job_name
+      schema = [field.to_api_repr() for field in self._table.schema]
+      job = self._client.extract_table_to_storage(
+          job_name, self._table,
+          '%s%s-*.avro' % (self._params['avro_uri_prefix'], job_name))
+      job.destination_format = 'AVRO'
+      job.begin()
+    else:
+      schema = self._params['bq_schema']
+      # pylint: disable=protected-access
+      job = bigquery.job._AsyncJob(job_name, self._client)
+      # pylint: enable=protected-access
+      job.reload()
+    if job.error_result is not None:
+      raise WorkerException(job.error_result['message'])
+    if job.state != 'DONE':
+      worker_params = self._params.copy()
+      worker_params['bq_extract_job_name'] = job_name
+      worker_params['bq_schema'] = schema
+      self._enqueue(self.__class__.__name__, worker_params,
+                    self.EXTRACT_CHECK_DELAY)
+      return None
+    self._params['bq_schema'] = schema
+    stats = self._get_matching_stats(
+        ['%s%s-*.avro' % (self._params['avro_uri_prefix'], job_name)])
+    return sorted(stat.filename for stat in stats)
+
+  def _schedule_avro_files(self):
+    # Each processor gets a whole file of the extract, which is a slice of
+    # the table independent of the others.
+    avro_files = self._params.get('avro_files')
+    if avro_files is None:
+      avro_files = self._extract_to_avro()
+      if avro_files is None:
+        return
+    for i, avro_file in enumerate(avro_files):
+      # Spawns a new job to schedule the remaining files.
+      if i >= self.MAX_ENQUEUED_JOBS:
         worker_params = self._params.copy()
-        worker_params['bq_page_token'] = page_token
+        worker_params['avro_files'] = avro_files[i:]
         self._enqueue(self.__class__.__name__, worker_params, 0)
         return
+      worker_params = self._params.copy()
+      worker_params.pop('avro_files', None)
+      worker_params.pop('bq_extract_job_name', None)
+      worker_params['avro_file'] = avro_file
+      self._enqueue('BQToMeasurementProtocolProcessor', worker_params, 0)
+
+  def _execute(self):
+    if self._params.get('avro_uri_prefix'):
+      self._schedule_avro_files()
+    else:
+      self._schedule_row_ranges()
 
 
 class BQToMeasurementProtocolProcessor(BQWorker, MeasurementProtocolWorker):
-  """Worker pushing to Measurement Protocol the first page only of a query"""
+  """Worker pushing to Measurement Protocol a slice of a table"""
 
-  def _send_payload_list(self, payload_list):
-    batch_payload = self._prepare_payloads_for_batch_request(payload_list)
-    try:
-      self.retry(self._send_batch_hits, max_retries=1)(batch_payload)
-    except MeasurementProtocolException as e:
-      escaped_message = e.message.replace('%', '%%')
-      self.log_error(escaped_message)
+  # Avro records sent between checkpoints and checks of the time budget.
+  AVRO_CHUNK_SIZE = 10000
+
+  def _send_hits(self, hits):
+    self.retry(self._send_batch_hits, max_retries=1)('\n'.join(hits))
 
   def _process_query_results(self, query_data, query_schema):
-    """Sends event hits from query data."""
-    fields = [f.name for f in query_schema]
-    payload_list = []
-    for row in query_data:
-      data = dict(zip(fields, row))
-      payload = self._get_payload_from_data(data)
-      payload_list.append(payload)
-      if len(payload_list) >= self._params['mp_batch_size']:
-        self._send_payload_list(payload_list)
-        payload_list = []
-    if payload_list:
-      # Sends remaining payloads.
-      self._send_payload_list(payload_list)
+    """Sends event hits from query data.
+
+    Batches are sent concurrently, reading of the query data waits while
+    MAX_CONCURRENT_BATCHES batches are waiting to be sent. Failed batches are
+    logged in the query data order.
+    """
+    encoder = _HitEncoder(query_schema)
+    hits = (encoder.encode(row) for row in query_data)
+    sent_batches = []
+    with ThreadPool(self.MAX_CONCURRENT_BATCHES) as pool:
+      for batch in self._pack_hits(hits, self._params['mp_batch_size']):
+        sent_batches.append(pool.submit(self._send_hits, batch))
+        self.count('rows', len(batch))
+    self.count('bytes', sum(self._packed_batches_bytes))
+    if self._packed_batches_bytes:
+      self.log_info(
+          '%i batch(es) sent, filled at %.1f%% of %i bytes on average.',
+          len(self._packed_batches_bytes),
+          100.0 * sum(self._packed_batches_bytes) /
+          len(self._packed_batches_bytes) / self.MAX_BATCH_BYTES,
+          self.MAX_BATCH_BYTES)
+    errors = []
+    for sent_batch in sent_batches:
+      try:
+        sent_batch.result()
+      except MeasurementProtocolException as e:
+        escaped_message = e.message.replace('%', '%%')
+        self.log_error(escaped_message)
+        errors.append(e)
+    self._spool_failed_batches(errors)
+
+  def _iter_rows(self, start_index, count):
+    """Yields `count` table rows starting at the `start_index` offset.
+
+    NB: `fetch_data` has neither a start index nor a total rows limit in this
+        client version (max_results is the page size), so every page is
+        requested by its own offset.
+    """
+    while count > 0:
+      query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
+          max_results=count)
+      query_iterator.extra_params['startIndex'] = start_index
+      rows = list(next(query_iterator.pages))
+      if not rows:
+        return
+      for row in rows[:count]:
+        yield row
+      start_index += len(rows)
+      count -= len(rows)
+
+  def _iter_avro_rows(self, filename, schema):
+    """Yields rows of an Avro file extracted from the table."""
+    names = [field.name for field in schema]
+    with gcs.open(filename) as avro_file:
+      reader = avro_datafile.DataFileReader(avro_file, avro_io.DatumReader())
+      for record in reader:
+        yield tuple(record.get(name) for name in names)
+
+  def _process_avro_file(self):
+    """Sends hits of an Avro file chunk by chunk, then deletes the file.
+
+    The number of records sent is saved after each chunk, so that a retry or
+    a continuation skips them instead of sending their hits again.
+    """
+    filename = self._params['avro_file']
+    schema = [bigquery.SchemaField.from_api_repr(field)
+              for field in self._params['bq_schema']]
+    checkpoint = self.load_checkpoint() or {}
+    sent_rows = 0
+    if checkpoint.get('avro_file') == filename:
+      sent_rows = checkpoint['sent_rows']
+      self.log_info('Resuming after %i record(s) sent.', sent_rows)
+    rows = itertools.islice(self._iter_avro_rows(filename, schema), sent_rows,
+                            None)
+    while True:
+      chunk = list(itertools.islice(rows, self.AVRO_CHUNK_SIZE))
+      if not chunk:
+        break
+      self._process_query_results(chunk, schema)
+      sent_rows += len(chunk)
+      state = {'avro_file': filename, 'sent_rows': sent_rows}
+      self.save_checkpoint(state)
+      if self.should_yield():
+        self._enqueue_continuation(state)
+        return
+    gcs.delete(filename)
 
   def _execute(self):
+    if self._params.get('avro_file'):
+      self._process_avro_file()
+      return
     self._bq_setup()
-    self._table.reload()
-    page_token = self._params['bq_page_token'] or None
+    if self._params.get('bq_schema'):
+      self._table.schema = [bigquery.SchemaField.from_api_repr(field)
+                            for field in self._params['bq_schema']]
+    else:
+      self._table.reload()
     batch_size = self._params['bq_batch_size']
-    query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
-        max_results=batch_size,
-        page_token=page_token)
-    query_first_page = next(query_iterator.pages)
-    self._process_query_results(query_first_page, query_iterator.schema)
+    start_index = self._params.get('bq_start_index')
+    if start_index is None:
+      # Scheduled by page token before row ranges were used, only the first
+      # page belongs to this processor.
+      query_iterator = self.retry(self._table.fetch_data, max_retries=1)(
+          max_results=batch_size,
+          page_token=self._params.get('bq_page_token') or None)
+      rows = next(query_iterator.pages)
+    else:
+      rows = self._iter_rows(start_index, batch_size)
+    self._process_query_results(rows, self._table.schema)
+
+
+class MeasurementProtocolReplayer(StorageWorker, MeasurementProtocolWorker):
+  """Worker to resend hits spooled by failed Measurement Protocol batches.
+
+  Hits of the spool files are sent again at the given rate, then the files
+  are deleted. Hits failing again are spooled to new files, next to the
+  replayed ones unless a spool URI prefix is set.
+  """
+
+  PARAMS = [
+      ('spool_uris', 'string_list', True, '',
+       ('List of spool file URIs and URI patterns '
+        '(e.g. gs://bucket/failed-hits/*.json)')),
+      ('max_hits_per_second', 'number', True, 100,
+       'Maximum number of hits sent per second'),
+      ('mp_batch_size', 'number', True, 20, ('Measurement Protocol batch size '
+                                             '(https://goo.gl/7VeWuB)')),
+      ('spool_uri_prefix', 'string', False, '',
+       ('Write hits failing again to files with this URI prefix, defaults to '
+        'the folder of the replayed file (e.g. gs://bucket/failed-hits/)')),
+  ]
+
+  def _iter_spooled_hits(self, filename):
+    with gcs.open(filename) as spool_file:
+      for line in spool_file:
+        if line.strip():
+          for hit in json.loads(line)['hits']:
+            yield hit.encode('utf-8')
+
+  def _replay(self, filename, skipped_hits=0):
+    """Sends hits of a spool file but the first skipped_hits ones.
+
+    Returns errors of failed batches and the number of hits of the file sent
+    if the worker yields before the end of the file, None otherwise.
+    """
+    errors = []
+    hits = itertools.islice(self._iter_spooled_hits(filename), skipped_hits,
+                            None)
+    sent_hits = skipped_hits
+    for batch in self._pack_hits(hits, self._params['mp_batch_size']):
+      if self.should_yield():
+        return errors, sent_hits
+      self.count('rows', len(batch))
+      min_duration = float(len(batch)) / self._params['max_hits_per_second']
+      started = time.time()
+      try:
+        self.retry(self._send_batch_hits, max_retries=1)('\n'.join(batch))
+      except MeasurementProtocolException as e:
+        escaped_message = e.message.replace('%', '%%')
+        self.log_error(escaped_message)
+        errors.append(e)
+      elapsed = time.time() - started
+      if elapsed < min_duration:
+        time.sleep(min_duration - elapsed)
+      sent_hits += len(batch)
+    return errors, None
+
+  def _execute(self):
+    # Files replayed by previous tasks are deleted, a continuation only skips
+    # the hits already sent from the file it was given.
+    continuation = self.load_checkpoint() or {}
+    stats = self._get_matching_stats(self._params['spool_uris'])
+    for stat in stats:
+      skipped_hits = 0
+      if stat.filename == continuation.get('filename'):
+        skipped_hits = continuation['sent_hits']
+      errors, sent_hits = self._replay(stat.filename, skipped_hits)
+      # Hits failing again must outlive the replayed file, so they are
+      # spooled next to it if no spool URI prefix is set.
+      self._spool_failed_batches(
+          errors, (self._params['spool_uri_prefix'] or
+                   'gs:/%s/' % stat.filename.rsplit('/', 1)[0]))
+      if sent_hits is not None:
+        self._enqueue_continuation({
+            'filename': stat.filename,
+            'sent_hits': sent_hits,
+        })
+        return
+      gcs.delete(stat.filename)
+      self.log_info('gs:/%s replayed, %i batch(es) failed again.',
+                    stat.filename, len(errors))
@@ -18,8 +18,10 @@ import os.path
 
 from flask import Flask
 
+from core import tracing
 from core.database import init_engine
 from core.extensions import db, cors, migrate
+from core.models import TraceSpan
 from ibackend.config import ProdConfig
 from ibackend.extensions import set_global_api_blueprint
 
@@ -43,6 +45,8 @@ def register_extensions(app):
   cors.init_app(app)
   db.init_app(app)
   init_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+  if app.config.get('TRACE_SPANS'):
+    tracing.set_exporter(TraceSpan)
   migrate.init_app(app, db)
   return None
 
@@ -59,6 +63,7 @@ def register_blueprints(app):
   """Register Flask blueprints."""
   from ibackend import pipeline, job, views, worker, stage
   app.register_blueprint(views.blueprint, url_prefix='/api')
+  app.register_blueprint(views.warmup_blueprint)
   app.register_blueprint(pipeline.views.blueprint, url_prefix='/api')
   app.register_blueprint(job.views.blueprint, url_prefix='/api')
   app.register_blueprint(worker.views.blueprint, url_prefix='/api')
@@ -19,6 +19,8 @@ import os
 class Config(object):
   """Base configuration."""
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+  # Finished spans are saved to the database to be rendered as timelines.
+  TRACE_SPANS = bool(os.getenv('TRACE_SPANS'))
 
 
 class ProdConfig(Config):
@@ -14,10 +14,11 @@
 
 """Job section."""
 from flask import Blueprint
+from flask import Response
 from flask_restful import Resource, reqparse, marshal_with, fields, abort
 
 from ibackend.extensions import api
-from core.models import Job, Pipeline
+from core.models import Job, Pipeline, TaskProfile
 
 blueprint = Blueprint('job', __name__)
 
@@ -52,6 +53,14 @@ job_fields = {
     'params': fields.List(fields.Nested(param_fields)),
     'message': fields.String
 }
+task_profile_fields = {
+    'id': fields.Integer,
+    'job_id': fields.Integer,
+    'run_id': fields.String,
+    'task_name': fields.String,
+    'worker_class': fields.String,
+    'created_at': fields.String,
+}
 
 
 def abort_if_job_doesnt_exist(job, job_id):
@@ -132,6 +141,32 @@ class JobStart(Resource):
     return job
 
 
+class JobProfileList(Resource):
+  """Lists profiles of the job tasks, latest first"""
+  @marshal_with(task_profile_fields)
+  def get(self, job_id):
+    job = Job.find(job_id)
+    abort_if_job_doesnt_exist(job, job_id)
+    query = TaskProfile.where(job_id=job.id)
+    return query.order_by(TaskProfile.id.desc()).all()
+
+
+class JobProfile(Resource):
+  """Downloads a task profile, it can be loaded with pstats or snakeviz"""
+  def get(self, job_id, profile_id):
+    profile = TaskProfile.where(id=profile_id, job_id=job_id).first()
+    if profile is None:
+      abort(404, message="Profile {} doesn't exist".format(profile_id))
+    filename = profile.task_name + '.prof'
+    return Response(profile.stats, mimetype='application/octet-stream',
+                    headers={
+                        'Content-Disposition': 'attachment; filename=' +
+                                               filename,
+                    })
+
+
 api.add_resource(JobList, '/jobs')
 api.add_resource(JobSingle, '/jobs/<job_id>')
 api.add_resource(JobStart, '/jobs/<job_id>/start')
+api.add_resource(JobProfileList, '/jobs/<job_id>/profiles')
+api.add_resource(JobProfile, '/jobs/<job_id>/profiles/<profile_id>')
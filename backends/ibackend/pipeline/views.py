@@ -19,7 +19,6 @@ import uuid
 
 from google.appengine.api import app_identity
 from google.appengine.api import urlfetch
-from google.cloud.logging import DESCENDING
 
 import werkzeug
 from flask import Blueprint, json
@@ -31,8 +30,11 @@ from flask_restful import reqparse
 
 from core import cache
 from core import cloud_logging
+from core import tracing
 from core.models import Job
 from core.models import Pipeline
+from core.models import TaskMetric
+from core.models import TraceSpan
 
 from ibackend.extensions import api
 
@@ -293,6 +295,7 @@ class PipelineLogs(Resource):
 
     next_page_token = args.get('next_page_token')
     page_size = 20
+    from google.cloud.logging import DESCENDING
     from core import cloud_logging
 
     project_id = app_identity.get_application_id()
@@ -346,6 +349,54 @@ class PipelineLogs(Resource):
     }
 
 
+job_run_fields = {
+    'job_id': fields.Integer,
+    'job_name': fields.String,
+    'run_id': fields.String,
+    'tasks': fields.Integer,
+    'failed_tasks': fields.Integer,
+    'attempts': fields.Integer,
+    'started_at': fields.String,
+    'finished_at': fields.String,
+    'wall_time': fields.Float,
+    'max_wall_time': fields.Float,
+    'avg_queue_delay': fields.Float,
+    'max_queue_delay': fields.Float,
+    'rows': fields.Integer,
+    'bytes': fields.Integer,
+    'api_calls': fields.Integer,
+    'trace_id': fields.String,
+}
+
+
+class PipelineMetrics(Resource):
+  """Shows task metrics of the pipeline jobs summed up per job run."""
+
+  @marshal_with(job_run_fields)
+  def get(self, pipeline_id):
+    pipeline = Pipeline.find(pipeline_id)
+    abort_if_pipeline_doesnt_exist(pipeline, pipeline_id)
+    job_names = dict((job.id, job.name) for job in pipeline.jobs)
+    job_runs = []
+    for job_run in TaskMetric.runs(job_names.keys()):
+      job_run = job_run._asdict()  # pylint: disable=protected-access
+      job_run['job_name'] = job_names[job_run['job_id']]
+      job_runs.append(job_run)
+    return job_runs
+
+
+class PipelineTrace(Resource):
+  """Shows spans of a pipeline run trace in the Chrome trace event format."""
+
+  def get(self, pipeline_id, trace_id):
+    pipeline = Pipeline.find(pipeline_id)
+    abort_if_pipeline_doesnt_exist(pipeline, pipeline_id)
+    spans = TraceSpan.load(trace_id)
+    if not spans:
+      abort(404, message="Trace {} doesn't exist".format(trace_id))
+    return tracing.render_timeline(spans)
+
+
 api.add_resource(PipelineList, '/pipelines')
 api.add_resource(PipelineSingle, '/pipelines/<pipeline_id>')
 api.add_resource(PipelineStart, '/pipelines/<pipeline_id>/start')
@@ -357,3 +408,5 @@ api.add_resource(
     '/pipelines/<pipeline_id>/run_on_schedule'
 )
 api.add_resource(PipelineLogs, '/pipelines/<pipeline_id>/logs')
+api.add_resource(PipelineMetrics, '/pipelines/<pipeline_id>/metrics')
+api.add_resource(PipelineTrace, '/pipelines/<pipeline_id>/traces/<trace_id>')
@@ -15,13 +15,18 @@
 """General section."""
 
 from flask import Blueprint
+from flask import Response
 from flask_restful import Resource, fields, marshal_with, reqparse
 
+from core import metrics
+from core import warmup
 from core.models import Param, GeneralSetting
 from core.app_data import SA_DATA
 from ibackend.extensions import api
 
 blueprint = Blueprint('general', __name__)
+# Registered without the /api prefix for App Engine requests to /_ah/.
+warmup_blueprint = Blueprint('warmup', __name__)
 
 parser = reqparse.RequestParser()
 parser.add_argument('variables', type=list, location='json')
@@ -95,6 +100,20 @@ class GeneralSettingsRoute(Resource):
     return settings
 
 
+@blueprint.route('/metrics')
+def metrics_page():
+  # NB: the service only serves admins, see gae_ibackend.yaml.
+  return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# NB: services with basic scaling get /_ah/start instead of warmup requests.
+@warmup_blueprint.route('/_ah/warmup')
+@warmup_blueprint.route('/_ah/start')
+def warmup_page():
+  warmup.warm_up_database()
+  return '', 200
+
+
 api.add_resource(Configuration, '/configuration')
 api.add_resource(GlobalVariable, '/global_variables')
 api.add_resource(GeneralSettingsRoute, '/general_settings')
@@ -18,8 +18,10 @@ import os.path
 
 from flask import Flask
 
+from core import tracing
 from core.database import init_engine
 from core.extensions import cors, db
+from core.models import TraceSpan
 from jbackend.config import ProdConfig
 from jbackend.extensions import set_global_api_blueprint
 
@@ -43,6 +45,8 @@ def register_extensions(app):
   cors.init_app(app)
   db.init_app(app)
   init_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+  if app.config.get('TRACE_SPANS'):
+    tracing.set_exporter(TraceSpan)
   return None
 
 
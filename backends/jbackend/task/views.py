@@ -14,14 +14,24 @@
 
 """Task handler."""
 
+import cProfile
+from datetime import datetime
 import logging
 import json
+import marshal
+import time
 from flask import Blueprint
 from flask import request
 from flask_restful import Resource, reqparse
 from core import cache
+from core import database
+from core import metrics
+from core import tracing
 from core import workers
 from core.models import Job
+from core.models import TaskCheckpoint
+from core.models import TaskMetric
+from core.models import TaskProfile
 from jbackend.extensions import api
 
 logger = logging.getLogger(__name__)
@@ -32,6 +42,17 @@ parser.add_argument('job_id')
 parser.add_argument('worker_class')
 parser.add_argument('worker_params')
 parser.add_argument('task_name')
+parser.add_argument('run_id')
+parser.add_argument('eta', type=float)
+parser.add_argument('trace_id')
+parser.add_argument('parent_span_id')
+
+tasks_executed = metrics.counter(
+    'crmint_tasks_total', 'Tasks executed by worker class and status.',
+    ['worker_class', 'status'])
+task_durations = metrics.histogram(
+    'crmint_task_duration_seconds', 'Duration of tasks by worker class.',
+    ['worker_class'])
 
 
 class Task(Resource):
@@ -51,30 +72,99 @@ class Task(Resource):
     args = parser.parse_args()
     logger.debug(args)
     task_name = args['task_name']
-    job = Job.find(args['job_id'])
     worker_class = getattr(workers, args['worker_class'])
     worker_params = json.loads(args['worker_params'])
-    worker = worker_class(worker_params, job.pipeline_id, job.id)
-    if retries >= worker_class.MAX_ATTEMPTS:
-      worker.log_error('Execution canceled after %i failed attempts', retries)
-      job.task_failed(task_name)
-    elif job.status == 'stopping':
-      worker.log_warn('Execution canceled as parent job is going to stop')
-      job.task_failed(task_name)
-    else:
-      try:
-        workers_to_enqueue = worker.execute()
-      except workers.WorkerException as e:
-        worker.log_error('Execution failed: %s: %s', e.__class__.__name__, e)
+    # Bookkeeping works on the job, pipeline and related jobs loaded here,
+    # instead of lazily loading them again after every change.
+    with database.keep_loaded():
+      job = Job.find_with_task_context(args['job_id'])
+      with tracing.span('task', trace_id=args['trace_id'] or None,
+                        parent_id=args['parent_span_id'] or None,
+                        pipeline_id=job.pipeline_id, job_id=job.id,
+                        worker_class=args['worker_class'],
+                        attempt=retries + 1):
+        worker = worker_class(worker_params, job.pipeline_id, job.id,
+                              task_name)
+        self._run(worker, job, args, retries)
+    return 'OK', 200
+
+  def _run(self, worker, job, args, retries):
+    """Executes the worker, records the task metric whatever happens."""
+    task_name = args['task_name']
+    started_at = datetime.now()
+    start_time = time.time()
+    status = TaskMetric.STATUS.ERROR
+    profiler = None
+    try:
+      if retries >= worker.MAX_ATTEMPTS:
+        worker.log_error('Execution canceled after %i failed attempts',
+                         retries)
+        job.task_failed(task_name)
+        status = TaskMetric.STATUS.FAILED
+      elif job.status == 'stopping':
+        worker.log_warn('Execution canceled as parent job is going to stop')
         job.task_failed(task_name)
-      except Exception as e:
-        worker.log_error('Unexpected error: %s: %s', e.__class__.__name__, e)
-        raise e
+        status = TaskMetric.STATUS.CANCELED
       else:
-        for worker_class_name, worker_params, delay in workers_to_enqueue:
-          job.enqueue(worker_class_name, worker_params, delay)
-        job.task_succeeded(task_name)
-    return 'OK', 200
+        if retries > 0:
+          # Lets the worker resume from where the previous attempt stopped.
+          checkpoint = TaskCheckpoint.load_state(job.id, task_name)
+          if checkpoint is not None:
+            worker.restore_checkpoint(checkpoint)
+        try:
+          if TaskProfile.enabled_for(job.id, args['worker_class']):
+            profiler = cProfile.Profile()
+            workers_to_enqueue = profiler.runcall(worker.execute)
+          else:
+            workers_to_enqueue = worker.execute()
+        except workers.WorkerException as e:
+          worker.log_error('Execution failed: %s: %s', e.__class__.__name__, e)
+          # Statuses may have changed while the worker was running.
+          Job.find_with_task_context(job.id)
+          job.task_failed(task_name)
+          status = TaskMetric.STATUS.FAILED
+        except Exception as e:
+          worker.log_error('Unexpected error: %s: %s', e.__class__.__name__, e)
+          raise e
+        else:
+          Job.find_with_task_context(job.id)
+          for worker_class_name, worker_params, delay in workers_to_enqueue:
+            job.enqueue(worker_class_name, worker_params, delay)
+          job.task_succeeded(task_name)
+          status = TaskMetric.STATUS.SUCCEEDED
+    finally:
+      # Buffered log entries are written even if the task failed.
+      worker.flush_logs()
+      wall_time = time.time() - start_time
+      tasks_executed.inc(worker_class=args['worker_class'], status=status)
+      task_durations.observe(wall_time, worker_class=args['worker_class'])
+      queue_delay = None
+      if args['eta'] is not None:
+        queue_delay = max(start_time - args['eta'], 0)
+      TaskMetric.create(
+          job_id=job.id,
+          run_id=args['run_id'] or job.run_id,
+          task_name=task_name,
+          worker_class=args['worker_class'],
+          status=status,
+          started_at=started_at,
+          attempts=retries + 1,
+          trace_id=tracing.current_trace_id(),
+          queue_delay=queue_delay,
+          wall_time=wall_time,
+          **worker.counters)
+      if profiler is not None:
+        profiler.create_stats()
+        TaskProfile.create(
+            job_id=job.id,
+            run_id=args['run_id'] or job.run_id,
+            task_name=task_name,
+            worker_class=args['worker_class'],
+            stats=marshal.dumps(profiler.stats))
+      # The checkpoint is only needed while the task may be executed again.
+      if status != TaskMetric.STATUS.ERROR and (
+          retries > 0 or worker.load_checkpoint() is not None):
+        TaskCheckpoint.clear(job.id, task_name)
 
 
 api.add_resource(Task, '/task')
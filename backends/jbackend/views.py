@@ -14,6 +14,10 @@
 
 """General section."""
 from flask import Blueprint
+from flask import Response
+
+from core import metrics
+from core import warmup
 
 blueprint = Blueprint('general', __name__)
 
@@ -21,3 +25,18 @@ blueprint = Blueprint('general', __name__)
 @blueprint.route('/hello')
 def hello():
   return 'Hello JBackend!'
+
+
+@blueprint.route('/metrics')
+def metrics_page():
+  # NB: the service only serves admins, see gae_jbackend.yaml.
+  return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# NB: services with basic scaling get /_ah/start instead of warmup requests.
+@blueprint.route('/_ah/warmup')
+@blueprint.route('/_ah/start')
+def warmup_page():
+  warmup.warm_up_database()
+  warmup.warm_up_workers()
+  return '', 200
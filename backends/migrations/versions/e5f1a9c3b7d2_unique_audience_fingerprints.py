@@ -0,0 +1,45 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unique audience fingerprints
+
+Revision ID: e5f1a9c3b7d2
+Revises: d4b8f2e6a913
+Create Date: 2018-11-05 09:41:12.637205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e5f1a9c3b7d2'
+down_revision = 'd4b8f2e6a913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Keeps the latest fingerprint of duplicated audiences.
+    op.execute(
+        'DELETE f1 FROM audience_fingerprints f1 '
+        'JOIN audience_fingerprints f2 ON f1.property_id = f2.property_id '
+        'AND f1.name = f2.name AND f1.id < f2.id')
+    op.create_index('ix_audience_fingerprints_property_id_name',
+                    'audience_fingerprints', ['property_id', 'name'],
+                    unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_audience_fingerprints_property_id_name',
+                  table_name='audience_fingerprints')
@@ -0,0 +1,62 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rows per second rendered by GAAudiencesUpdater templates.
+
+Run with: python runtests.py SDK_PATH --test-pattern '*_benchmark.py'
+"""
+
+import time
+import unittest
+
+from core import workers
+
+TEMPLATE = u"""{
+  "name": "%(name)s",
+  "linkedViews": ["%(view_id)s"],
+  "linkedAdAccounts": [
+    {"type": "ADWORDS_LINKS", "linkedAccountId": "%(ads_id)s"}
+  ],
+  "audienceType": "SIMPLE",
+  "audienceDefinition": {
+    "includeConditions": {
+      "daysToLookBack": %(days)s,
+      "segment": "users::condition::ga:dimension1==%(segment)s",
+      "membershipDurationDays": 30,
+      "isSmartList": false
+    }
+  }
+}"""
+FIELDS = ['name', 'view_id', 'ads_id', 'days', 'segment']
+ROWS = 20000
+
+
+class AudienceTemplateBenchmark(unittest.TestCase):
+
+  def _rows_per_second(self, render):
+    rows = [(u'Audience %i' % i, u'123456', u'123-456-7890', 7, u'%i' % i)
+            for i in xrange(ROWS)]
+    started_at = time.time()
+    for row in rows:
+      render(row)
+    return ROWS / (time.time() - started_at)
+
+  def test_render(self):
+    template = workers._AudienceTemplate(TEMPLATE, FIELDS)
+    row = (u'a', u'1', u'2', 7, u'3')
+    self.assertEqual(template.render(row), template._render_legacy(row))
+    legacy = self._rows_per_second(template._render_legacy)
+    compiled = self._rows_per_second(template.render)
+    print '\nLegacy: %i rows/s, compiled: %i rows/s (x%.1f)' % (
+        legacy, compiled, compiled / legacy)
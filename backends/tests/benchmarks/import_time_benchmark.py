@@ -0,0 +1,99 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time to import the modules serving requests, as on a cold start.
+
+Run with: python runtests.py SDK_PATH --test-pattern '*_benchmark.py'
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import google
+
+BACKENDS = {
+    'ibackend': [
+        'ibackend.app',
+        'ibackend.views',
+        'ibackend.job.views',
+        'ibackend.pipeline.views',
+        'ibackend.stage.views',
+        'ibackend.worker.views',
+    ],
+    'jbackend': [
+        'jbackend.app',
+        'jbackend.views',
+        'jbackend.cron.views',
+        'jbackend.task.views',
+    ],
+}
+# Client libraries only imported when a worker or a log entry needs them.
+LAZY_MODULES = [
+    'apiclient',
+    'avro',
+    'cloudstorage',
+    'google.cloud.bigquery',
+    'google.cloud.logging',
+    'oauth2client',
+    'requests',
+]
+RUNS = 5
+
+# Imports modules in a fresh interpreter, with the App Engine SDK on the
+# google package path as set up by runtests.py.
+SCRIPT = """
+import json
+import sys
+import time
+import google
+google.__path__[:] = %(google_path)r
+started_at = time.time()
+for name in %(modules)r:
+  __import__(name)
+print json.dumps({
+    'seconds': time.time() - started_at,
+    'imported': [name for name in %(lazy_modules)r if name in sys.modules],
+})
+"""
+
+
+def _import_in_subprocess(modules):
+  script = SCRIPT % {
+      'google_path': list(google.__path__),
+      'modules': modules,
+      'lazy_modules': LAZY_MODULES,
+  }
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.check_output([sys.executable, '-c', script], env=env)
+  return json.loads(output.splitlines()[-1])
+
+
+class ImportTimeBenchmark(unittest.TestCase):
+
+  def _benchmark(self, backend):
+    results = [_import_in_subprocess(BACKENDS[backend])
+               for _ in xrange(RUNS)]
+    self.assertEqual(results[0]['imported'], [])
+    seconds = sorted(result['seconds'] for result in results)
+    print '\n%s imports: best %.3fs, median %.3fs' % (
+        backend, seconds[0], seconds[len(seconds) / 2])
+
+  def test_ibackend(self):
+    self._benchmark('ibackend')
+
+  def test_jbackend(self):
+    self._benchmark('jbackend')
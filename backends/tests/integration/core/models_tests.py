@@ -12,12 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+
 from google.appengine.api import taskqueue
 from google.appengine.ext import testbed
 import mock
 
 from core import cache
 from core import models
+from core import tracing
 
 from tests import utils
 
@@ -333,6 +336,16 @@ class TestJobStartedStatus(utils.ModelTestCase):
     self.assertTrue(job.start())
     self.assertEqual(job.status, models.Job.STATUS.RUNNING)
 
+  @mock.patch('time.time', return_value=1000.0)
+  def test_enqueue_passes_eta_of_task(self, patched_time):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(pipeline.get_ready())
+    self.assertTrue(job.start())
+    with mock.patch.object(taskqueue, 'add') as patched_add:
+      job.enqueue('Commenter', {}, delay=60)
+    self.assertEqual(patched_add.call_args[1]['countdown'], 60)
+    self.assertEqual(patched_add.call_args[1]['params']['eta'], 1060.0)
 
 class TestJobDestroy(utils.ModelTestCase):
 
@@ -867,3 +880,84 @@ class TestJobStartingMultipleTasks(utils.ModelTestCase):
 
     job.task_succeeded(task2.name)
     self.assertEqual(job.get_status(), models.Job.STATUS.SUCCEEDED)
+
+
+class TestTaskCheckpoint(utils.ModelTestCase):
+
+  def test_save_and_load_state(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertIsNone(models.TaskCheckpoint.load_state(job.id, 'task'))
+    models.TaskCheckpoint.save_state(job.id, 'task', {'page': 1})
+    models.TaskCheckpoint.save_state(job.id, 'task', {'page': 2})
+    self.assertEqual(models.TaskCheckpoint.where(job_id=job.id).count(), 1)
+    self.assertEqual(models.TaskCheckpoint.load_state(job.id, 'task'),
+                     {'page': 2})
+    models.TaskCheckpoint.clear(job.id, 'task')
+    self.assertIsNone(models.TaskCheckpoint.load_state(job.id, 'task'))
+
+
+class TestAudienceFingerprint(utils.ModelTestCase):
+
+  def test_save_all_upserts_fingerprints(self):
+    models.AudienceFingerprint.save_all('UA-1', {'a': ('ID_A', 'f1')})
+    models.AudienceFingerprint.save_all('UA-1', {
+        'a': ('ID_A', 'f2'),
+        'b': ('ID_B', 'f3'),
+    })
+    fingerprints = models.AudienceFingerprint.where(property_id='UA-1').all()
+    self.assertEqual(
+        sorted((f.name, f.audience_id, f.fingerprint) for f in fingerprints),
+        [('a', 'ID_A', 'f2'), ('b', 'ID_B', 'f3')])
+
+
+class TestTaskMetric(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestTaskMetric, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    self.testbed.init_app_identity_stub()
+    self.testbed.init_taskqueue_stub()
+
+  def tearDown(self):
+    super(TestTaskMetric, self).tearDown()
+    self.testbed.deactivate()
+
+  @mock.patch.object(models.TaskMetric, 'RUNS_KEPT', 2)
+  def test_pipeline_start_prunes_metrics_of_old_runs(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    other_job = models.Job.create()
+    for day in xrange(1, 4):
+      models.TraceSpan.create(trace_id='trace%d' % day, name='task')
+      for metric_job in (job, other_job):
+        models.TaskMetric.create(job_id=metric_job.id, run_id='run%d' % day,
+                                 trace_id='trace%d' % day,
+                                 started_at=datetime(2018, 10, day))
+    self.assertTrue(pipeline.start())
+    run_ids = [m.run_id for m in models.TaskMetric.where(job_id=job.id)]
+    self.assertEqual(sorted(run_ids), ['run2', 'run3'])
+    self.assertEqual(models.TaskMetric.where(job_id=other_job.id).count(), 3)
+    trace_ids = [s.trace_id for s in models.TraceSpan.all()]
+    self.assertEqual(sorted(trace_ids), ['trace2', 'trace3'])
+
+
+class TestTraceSpan(utils.ModelTestCase):
+
+  def test_loads_exported_spans_of_trace(self):
+    tracing.set_exporter(models.TraceSpan)
+    try:
+      with tracing.span('pipeline.start', pipeline_id=1) as root:
+        with tracing.span('task', job_id=2):
+          pass
+      with tracing.span('other'):
+        pass
+    finally:
+      tracing.set_exporter(None)
+    spans = models.TraceSpan.load(root.trace_id)
+    self.assertEqual([s['name'] for s in spans], ['pipeline.start', 'task'])
+    self.assertEqual(spans[0], root.to_dict())
+    self.assertEqual(spans[1]['attributes'], {'job_id': 2})
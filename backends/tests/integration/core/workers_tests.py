@@ -12,3 +12,178 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
+from apiclient.errors import HttpError
+from google.appengine.ext import testbed
+from google.cloud.bigquery.schema import SchemaField
+import mock
+
+from core import models
+from core import workers
+
+from tests import utils
+
+
+class TestGAAudiencesUpdater(utils.ModelTestCase):
+
+  def setUp(self):
+    super(TestGAAudiencesUpdater, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    patcher_logger = mock.patch('core.cloud_logging.logger')
+    self.addCleanup(patcher_logger.stop)
+    patcher_logger.start().log_struct.__name__ = 'foo'
+    self._rows = [('a', 1), ('b', 2)]
+    self._ga_audiences = [
+        {'id': 'ID_A', 'name': 'a', 'description': '1'},
+        {'id': 'ID_B', 'name': 'b', 'description': '0'},
+    ]
+    self._ga_client = mock.Mock()
+    self._ga_client.management.return_value.remarketingAudience.\
+        return_value.list.side_effect = self._list
+    self._ga_client.new_batch_http_request.side_effect = self._new_batch
+    self._list_calls = 0
+    self._missing_ids = []
+    self._table_etag = 'etag1'
+    self._batched_requests = []
+
+  def tearDown(self):
+    super(TestGAAudiencesUpdater, self).tearDown()
+    self.testbed.deactivate()
+
+  def _list(self, **kwargs):
+    self._list_calls += 1
+    request = mock.Mock()
+    request.execute.__name__ = 'execute'
+    request.execute.return_value = {
+        'totalResults': len(self._ga_audiences),
+        'items': self._ga_audiences,
+    }
+    return request
+
+  def _new_batch(self, callback):
+    batch = mock.Mock()
+    request_ids = []
+    batch.add.side_effect = lambda r, request_id: request_ids.append(
+        request_id)
+    def _execute():
+      for request_id in request_ids:
+        self._batched_requests.append(request_id)
+        if request_id in self._missing_ids:
+          callback(request_id, None, HttpError(mock.Mock(status=404), ''))
+          continue
+        audiences = dict((a['id'], a) for a in self._ga_audiences)
+        callback(request_id,
+                 audiences.get(request_id, {'id': 'NEW_%s' % request_id}),
+                 None)
+    batch.execute.side_effect = _execute
+    batch.execute.__name__ = 'execute'
+    return batch
+
+  def _run_worker(self, checkpoint=None):
+    worker = workers.GAAudiencesUpdater(
+        {
+            'property_id': 'UA-12345-1',
+            'bq_dataset_id': 'dataset',
+            'bq_table_id': 'table',
+            'template': '{"name": "%(name)s", "description": "%(value)s"}',
+        },
+        1,
+        1)
+    worker.restore_checkpoint(checkpoint)
+    table = mock.Mock(etag=self._table_etag)
+    table.schema = [SchemaField('name', 'STRING'),
+                    SchemaField('value', 'INTEGER')]
+    table.fetch_data.return_value = self._rows
+    def _bq_setup():
+      worker._table = table
+    with mock.patch.object(worker, '_bq_setup', side_effect=_bq_setup), \
+         mock.patch.object(worker, '_get_ga_client',
+                           return_value=self._ga_client):
+      worker._execute()
+    return worker
+
+  def test_unchanged_audiences_are_skipped(self):
+    self._run_worker()
+    self.assertEqual(self._list_calls, 1)
+    self.assertEqual(self._batched_requests, ['ID_A', 'ID_B', 'patch-ID_B'])
+    fingerprints = models.AudienceFingerprint.where(
+        property_id='UA-12345-1').all()
+    self.assertEqual(sorted((f.name, f.audience_id) for f in fingerprints),
+                     [('a', 'ID_A'), ('b', 'ID_B')])
+
+    self._batched_requests = []
+    self._run_worker()
+    self.assertEqual(self._list_calls, 1)
+    self.assertEqual(self._batched_requests, [])
+
+  def test_changed_audiences_are_synced(self):
+    self._run_worker()
+    self._ga_audiences[1]['description'] = '2'
+    self._rows = [('a', 1), ('b', 3), ('c', 4)]
+    self._batched_requests = []
+    self._run_worker()
+    self.assertEqual(self._list_calls, 2)
+    self.assertEqual(sorted(self._batched_requests),
+                     ['ID_B', 'insert-0', 'patch-ID_B'])
+    fingerprint = models.AudienceFingerprint.where(name='c').one()
+    self.assertEqual(fingerprint.audience_id, 'NEW_insert-0')
+
+  def test_changed_audiences_are_fetched_by_stored_id(self):
+    self._run_worker()
+    self._rows = [('a', 1), ('b', 3)]
+    self._batched_requests = []
+    self._run_worker()
+    self.assertEqual(self._list_calls, 1)
+    self.assertEqual(self._batched_requests, ['ID_B', 'patch-ID_B'])
+
+  def test_audiences_missing_from_ga_are_listed_again(self):
+    self._run_worker()
+    self._ga_audiences[1] = {'id': 'ID_B2', 'name': 'b', 'description': '0'}
+    self._missing_ids = ['ID_B']
+    self._rows = [('a', 1), ('b', 3)]
+    self._batched_requests = []
+    self._run_worker()
+    self.assertEqual(self._list_calls, 2)
+    self.assertEqual(self._batched_requests,
+                     ['ID_B', 'ID_B2', 'patch-ID_B2'])
+    fingerprint = models.AudienceFingerprint.where(name='b').one()
+    self.assertEqual(fingerprint.audience_id, 'ID_B2')
+
+  def test_retry_resumes_after_synced_rows(self):
+    self._rows = [('a', 1), ('b', 3)]
+    worker = self._run_worker({
+        'table_etag': 'etag1',
+        'synced_rows': 1,
+        'inserted': 0,
+        'patched': 1,
+        'unchanged': 0,
+    })
+    self.assertEqual(self._batched_requests, ['ID_B', 'patch-ID_B'])
+    self.assertEqual(worker.load_checkpoint(), {
+        'table_etag': 'etag1',
+        'synced_rows': 2,
+        'inserted': 0,
+        'patched': 2,
+        'unchanged': 0,
+    })
+
+  def test_retry_starts_over_if_table_has_changed(self):
+    self._rows = [('a', 1), ('b', 3)]
+    self._table_etag = 'etag2'
+    worker = self._run_worker({
+        'table_etag': 'etag1',
+        'synced_rows': 1,
+        'inserted': 0,
+        'patched': 1,
+        'unchanged': 0,
+    })
+    self.assertEqual(self._batched_requests, ['ID_A', 'ID_B', 'patch-ID_B'])
+    self.assertEqual(worker.load_checkpoint(), {
+        'table_etag': 'etag2',
+        'synced_rows': 2,
+        'inserted': 0,
+        'patched': 1,
+        'unchanged': 1,
+    })
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
 from google.appengine.ext import testbed
 
 from core import models
@@ -32,3 +34,41 @@ class TestJobList(utils.IBackendBaseTest):
     pipeline = models.Pipeline.create()
     response = self.client.get('/api/jobs?pipeline_id=%d' % pipeline.id)
     self.assertEqual(response.status_code, 200)
+
+
+class TestJobProfiles(utils.IBackendBaseTest):
+
+  def setUp(self):
+    super(TestJobProfiles, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    # Activate which service we want to stub
+    self.testbed.init_memcache_stub()
+    self.testbed.init_app_identity_stub()
+
+  def tearDown(self):
+    super(TestJobProfiles, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_list_and_download_profile(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    profile = models.TaskProfile.create(job_id=job.id, run_id='run',
+                                        task_name='task',
+                                        worker_class='Commenter',
+                                        stats='stats')
+    response = self.client.get('/api/jobs/%d/profiles' % job.id)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(json.loads(response.data)[0]['task_name'], 'task')
+    response = self.client.get(
+        '/api/jobs/%d/profiles/%d' % (job.id, profile.id))
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.data, 'stats')
+    self.assertEqual(response.headers['Content-Disposition'],
+                     'attachment; filename=task.prof')
+
+  def test_download_missing_profile(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    response = self.client.get('/api/jobs/%d/profiles/1' % job.id)
+    self.assertEqual(response.status_code, 404)
@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from datetime import datetime
+
+from google.appengine.ext import testbed
+
+from core import models
+
 from tests import utils
 
 
@@ -28,3 +34,73 @@ class TestPipelineList(utils.IBackendBaseTest):
     """
     response = self.client.get('/api/pipelines')
     self.assertEqual(response.status_code, 200)
+
+
+class TestPipelineMetrics(utils.IBackendBaseTest):
+
+  def setUp(self):
+    super(TestPipelineMetrics, self).setUp()
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+
+  def tearDown(self):
+    super(TestPipelineMetrics, self).tearDown()
+    self.testbed.deactivate()
+
+  def test_sums_up_metrics_per_job_run(self):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, name='Job')
+    other_job = models.Job.create(pipeline_id=models.Pipeline.create().id)
+    for run_id, status, wall_time, day in [('a', 'succeeded', 1.0, 1),
+                                           ('a', 'failed', 3.0, 1),
+                                           ('b', 'succeeded', 2.0, 2)]:
+      models.TaskMetric.create(
+          job_id=job.id, run_id=run_id, status=status, attempts=1,
+          started_at=datetime(2018, 10, day), queue_delay=wall_time,
+          wall_time=wall_time, rows=10, bytes=100, api_calls=2)
+    models.TaskMetric.create(job_id=other_job.id, run_id='c', wall_time=1.0)
+    response = self.client.get('/api/pipelines/%d/metrics' % pipeline.id)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual([run['run_id'] for run in response.json], ['b', 'a'])
+    run = response.json[1]
+    self.assertEqual(run['job_name'], 'Job')
+    self.assertEqual(run['tasks'], 2)
+    self.assertEqual(run['failed_tasks'], 1)
+    self.assertEqual(run['attempts'], 2)
+    self.assertEqual(run['wall_time'], 4.0)
+    self.assertEqual(run['max_wall_time'], 3.0)
+    self.assertEqual(run['avg_queue_delay'], 2.0)
+    self.assertEqual(run['rows'], 20)
+    self.assertEqual(run['bytes'], 200)
+    self.assertEqual(run['api_calls'], 4)
+
+  def test_unknown_pipeline(self):
+    response = self.client.get('/api/pipelines/123/metrics')
+    self.assertEqual(response.status_code, 404)
+
+
+class TestPipelineTrace(utils.IBackendBaseTest):
+
+  def test_renders_spans_of_trace(self):
+    pipeline = models.Pipeline.create()
+    models.TraceSpan.create(
+        trace_id='abc', span_id='1', name='pipeline.start',
+        attributes='{"pipeline_id": %d}' % pipeline.id,
+        start_time=1.0, end_time=3.0)
+    models.TraceSpan.create(
+        trace_id='abc', span_id='2', parent_id='1', name='task',
+        attributes='{"job_id": 2}', start_time=1.5, end_time=2.0)
+    response = self.client.get(
+        '/api/pipelines/%d/traces/abc' % pipeline.id)
+    self.assertEqual(response.status_code, 200)
+    events = response.json['traceEvents']
+    self.assertEqual([e['name'] for e in events], ['pipeline.start', 'task'])
+    self.assertEqual(events[1]['tid'], 2)
+    self.assertEqual(events[1]['dur'], 500000)
+
+  def test_unknown_trace(self):
+    pipeline = models.Pipeline.create()
+    response = self.client.get(
+        '/api/pipelines/%d/traces/abc' % pipeline.id)
+    self.assertEqual(response.status_code, 404)
@@ -0,0 +1,38 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from tests import utils
+
+
+class TestMetrics(utils.IBackendBaseTest):
+
+  def test_metrics_success(self):
+    self.client.get('/api/pipelines')
+    response = self.client.get('/api/metrics')
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.content_type.startswith('text/plain'))
+    self.assertIn('# TYPE crmint_db_query_duration_seconds histogram',
+                  response.data)
+
+
+class TestWarmup(utils.IBackendBaseTest):
+
+  def test_warmup_opens_db_connection(self):
+    with mock.patch('core.warmup.warm_up_workers') as patched_warm_up_workers:
+      for url in ['/_ah/warmup', '/_ah/start']:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+    patched_warm_up_workers.assert_not_called()
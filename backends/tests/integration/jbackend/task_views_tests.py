@@ -12,10 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import marshal
+
 from google.appengine.ext import testbed
 import mock
+from sqlalchemy import event
 
+from core import database
 from core import models
+from core import tracing
+from core import workers
 
 from tests import utils
 
@@ -39,6 +45,13 @@ class TestTaskCreation(utils.JBackendBaseTest):
     response = self.client.get('/hello')
     self.assertEqual(response.status_code, 200)
 
+  @mock.patch('core.warmup.warm_up_workers')
+  def test_warmup(self, patched_warm_up_workers):
+    for url in ['/_ah/warmup', '/_ah/start']:
+      response = self.client.get(url)
+      self.assertEqual(response.status_code, 200)
+    self.assertEqual(patched_warm_up_workers.call_count, 2)
+
   @mock.patch('core.cloud_logging.logger')
   def test_submit_task_success(self, patched_logger):
     # NB: patching the StackDriver logger is needed because there is no
@@ -59,3 +72,193 @@ class TestTaskCreation(utils.JBackendBaseTest):
         'X-AppEngine-TaskExecutionCount': '0'}
     response = self.client.post('/task', headers=headers, data=data)
     self.assertEqual(response.status_code, 200)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_submit_task_records_metric(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task = job.start()
+    self.assertIsNotNone(job.run_id)
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name,
+        run_id=job.run_id,
+        eta='1.5')
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '1'}
+    response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    metric = models.TaskMetric.where(job_id=job.id).one()
+    self.assertEqual(metric.run_id, job.run_id)
+    self.assertEqual(metric.task_name, task.name)
+    self.assertEqual(metric.worker_class, 'Commenter')
+    self.assertEqual(metric.status, models.TaskMetric.STATUS.SUCCEEDED)
+    self.assertEqual(metric.attempts, 2)
+    self.assertGreater(metric.queue_delay, 0)
+    self.assertGreaterEqual(metric.wall_time, 0)
+    self.assertEqual(metric.rows, 0)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_metrics_count_executed_tasks(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id,
+                           worker_class='Commenter')
+    self.assertTrue(job.get_ready())
+    task = job.start()
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0'}
+    self.client.post('/task', headers=headers, data=data)
+    response = self.client.get('/metrics')
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response.content_type.startswith('text/plain'))
+    self.assertIn(
+        'crmint_tasks_total{worker_class="Commenter",status="succeeded"}',
+        response.data)
+    self.assertIn(
+        'crmint_tasks_enqueued_total{worker_class="Commenter"}', response.data)
+    self.assertIn(
+        'crmint_task_duration_seconds_count{worker_class="Commenter"}',
+        response.data)
+    self.assertIn('crmint_memcache_gets_total{result="hit"}', response.data)
+    self.assertIn('crmint_db_query_duration_seconds_count', response.data)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_submit_task_continues_trace(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    with tracing.span('pipeline.start') as root:
+      task = job.start()
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name,
+        trace_id=root.trace_id,
+        parent_span_id=root.span_id)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0'}
+
+    def enqueue_commenter(worker):
+      worker._enqueue('Commenter', {'comment': '', 'success': True})
+
+    with mock.patch.object(workers.Commenter, '_execute', autospec=True,
+                           side_effect=enqueue_commenter):
+      with mock.patch('core.models.taskqueue.add') as patched_add:
+        response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    task_params = patched_add.call_args[1]['params']
+    self.assertEqual(task_params['trace_id'], root.trace_id)
+    self.assertNotEqual(task_params['parent_span_id'], root.span_id)
+    metric = models.TaskMetric.where(job_id=job.id).one()
+    self.assertEqual(metric.trace_id, root.trace_id)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_submit_task_profiles_enabled_worker_class(self, patched_logger):
+    models.GeneralSetting.where(name='profiled_worker_classes').one().update(
+        value='BQQueryLauncher, Commenter')
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task = job.start()
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name,
+        run_id=job.run_id)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0'}
+    response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    profile = models.TaskProfile.where(job_id=job.id).one()
+    self.assertEqual(profile.run_id, job.run_id)
+    self.assertEqual(profile.task_name, task.name)
+    stats = marshal.loads(profile.stats)
+    self.assertTrue(any(func_name == '_execute'
+                        for _, _, func_name in stats))
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_submit_task_not_profiled_by_default(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task = job.start()
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0'}
+    response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(models.TaskProfile.where(job_id=job.id).count(), 0)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_submit_task_runs_fixed_number_of_queries(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id, worker_class='Commenter')
+    dependent_job = models.Job.create(pipeline_id=pipeline.id,
+                                      worker_class='Commenter')
+    models.StartCondition.create(
+        job_id=dependent_job.id,
+        preceding_job_id=job.id,
+        condition=models.StartCondition.CONDITION.SUCCESS)
+    self.assertTrue(pipeline.start())
+    task = models.TaskEnqueued.where(
+        task_namespace=job._get_prefixed_cache_key('enqueued_tasks')).one()
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.task_name)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '0'}
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+      statements.append(statement)
+
+    event.listen(database.engine, 'before_cursor_execute', count_statement)
+    try:
+      response = self.client.post('/task', headers=headers, data=data)
+    finally:
+      event.remove(database.engine, 'before_cursor_execute', count_statement)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(dependent_job.get_status(), models.Job.STATUS.RUNNING)
+    # Task context loaded before and after the worker runs, profiling
+    # settings, task completion, 2 job status updates, dependent job params
+    # and enqueued task, pipeline jobs and task metric.
+    self.assertEqual(len(statements), 11)
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_retried_task_resumes_from_checkpoint(self, patched_logger):
+    pipeline = models.Pipeline.create()
+    job = models.Job.create(pipeline_id=pipeline.id)
+    self.assertTrue(job.get_ready())
+    task = job.start()
+    models.TaskCheckpoint.save_state(job.id, task.name, {'page': 2})
+    checkpoints = []
+    def _execute(worker):
+      checkpoints.append(worker.load_checkpoint())
+    data = dict(
+        job_id=job.id,
+        worker_class='Commenter',
+        worker_params='{"comment": "", "success": true}',
+        task_name=task.name)
+    headers = {
+        'X-AppEngine-TaskExecutionCount': '1'}
+    with mock.patch.object(workers.Commenter, '_execute', _execute):
+      response = self.client.post('/task', headers=headers, data=data)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(checkpoints, [{'page': 2}])
+    self.assertEqual(models.TaskCheckpoint.where(job_id=job.id).count(), 0)
@@ -0,0 +1,126 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+import mock
+
+from core import cloud_logging
+
+
+class TestLogBuffer(unittest.TestCase):
+
+  def setUp(self):
+    super(TestLogBuffer, self).setUp()
+    self._logger = mock.Mock()
+    self._batches = []
+    def _batch():
+      batch = mock.Mock()
+      self._batches.append(batch)
+      return batch
+    self._logger.batch.side_effect = _batch
+
+  def _written(self):
+    return [[c[0][0] for c in batch.log_struct.call_args_list]
+            for batch in self._batches if batch.commit.called]
+
+  def test_writes_nothing_until_flushed(self):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.log_struct({'message': 'a'})
+    log_buffer.log_struct({'message': 'b'})
+    self.assertEqual(self._written(), [])
+    log_buffer.flush()
+    self.assertEqual(self._written(),
+                     [[{'message': 'a'}, {'message': 'b'}]])
+    log_buffer.flush()
+    self.assertEqual(len(self._batches), 1)
+
+  def test_writes_in_order_every_max_entries(self):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.MAX_ENTRIES = 2
+    for i in xrange(5):
+      log_buffer.log_struct({'message': i})
+    log_buffer.flush()
+    written = self._written()
+    self.assertEqual([entry for batch in written for entry in batch],
+                     [{'message': i} for i in xrange(5)])
+    self.assertEqual(written[0], [{'message': 0}, {'message': 1}])
+    self.assertLessEqual(max(len(batch) for batch in written), 2)
+
+  @mock.patch('logging.warning')
+  def test_logs_without_waiting_for_slow_write(self, patched_warning):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.MAX_ENTRIES = 1
+    log_buffer.MAX_BUFFERED_ENTRIES = 3
+    written = threading.Event()
+    self._logger.batch.side_effect = None
+    self._logger.batch.return_value.commit.side_effect = written.wait
+    for i in xrange(5):
+      log_buffer.log_struct({'message': i})
+    # The first entry is being written, the next 3 ones are buffered.
+    self.assertEqual(len(log_buffer._entries), 3)
+    written.set()
+    log_buffer.flush()
+    self.assertEqual(self._logger.batch.return_value.commit.call_count, 4)
+    patched_warning.assert_called_once()
+    self.assertEqual(patched_warning.call_args[0][1], 1)
+
+  @mock.patch('time.time')
+  def test_writes_once_flush_interval_passed(self, patched_time):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    patched_time.return_value = 100
+    log_buffer.log_struct({'message': 'a'})
+    patched_time.return_value = 100 + log_buffer.FLUSH_INTERVAL
+    log_buffer.log_struct({'message': 'b'})
+    log_buffer._join_writer()
+    self.assertEqual(self._written(),
+                     [[{'message': 'a'}, {'message': 'b'}]])
+
+  def test_writes_by_timer_without_further_entries(self):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.FLUSH_INTERVAL = 0.05
+    log_buffer.log_struct({'message': 'a'})
+    timer = log_buffer._timer
+    timer.join()
+    log_buffer._join_writer()
+    self.assertEqual(self._written(), [[{'message': 'a'}]])
+    log_buffer.flush()
+    self.assertEqual(len(self._batches), 1)
+
+  def test_flush_stops_timer(self):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.log_struct({'message': 'a'})
+    timer = log_buffer._timer
+    log_buffer.flush()
+    timer.join()
+    self.assertEqual(self._written(), [[{'message': 'a'}]])
+
+  def test_entries_are_timestamped_when_logged(self):
+    log_buffer = cloud_logging.LogBuffer(self._logger)
+    log_buffer.log_struct({'message': 'a'})
+    log_buffer.flush()
+    timestamp = self._batches[0].log_struct.call_args[1]['timestamp']
+    self.assertIsNotNone(timestamp)
+
+  def test_flush_retries_and_raises_write_error(self):
+    retry = mock.Mock(side_effect=lambda func: func)
+    log_buffer = cloud_logging.LogBuffer(self._logger, retry)
+    log_buffer.MAX_ENTRIES = 1
+    self._logger.batch.side_effect = None
+    self._logger.batch.return_value.commit.side_effect = ValueError('Down')
+    log_buffer.log_struct({'message': 'a'})
+    with self.assertRaises(ValueError):
+      log_buffer.flush()
+    retry.assert_called_once()
@@ -0,0 +1,51 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from core import concurrency
+
+
+class TestThreadPool(unittest.TestCase):
+
+  def test_map_returns_results_in_order(self):
+    with concurrency.ThreadPool(3) as pool:
+      results = pool.map(lambda x: x * 2, range(10))
+    self.assertEqual(results, [x * 2 for x in range(10)])
+
+  def test_map_raises_first_error(self):
+    def _fail_on_odd(x):
+      if x % 2:
+        raise ValueError(x)
+      return x
+    with concurrency.ThreadPool(2) as pool:
+      with self.assertRaises(ValueError) as context:
+        pool.map(_fail_on_odd, range(6))
+    self.assertEqual(context.exception.args, (1,))
+
+  def test_runs_no_more_calls_than_pool_size_at_once(self):
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+    def _count_running(_):
+      with lock:
+        running[0] += 1
+        max_running[0] = max(max_running[0], running[0])
+      threading.Event().wait(0.01)
+      with lock:
+        running[0] -= 1
+    with concurrency.ThreadPool(3) as pool:
+      pool.map(_count_running, range(20))
+    self.assertLessEqual(max_running[0], 3)
@@ -0,0 +1,50 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import unittest
+
+import mock
+
+from core import lazy
+
+
+class TestLazyObject(unittest.TestCase):
+
+  def test_calls_factory_once_on_first_use(self):
+    factory = mock.Mock()
+    factory.return_value.name = 'client'
+    proxy = lazy.LazyObject(factory)
+    factory.assert_not_called()
+    self.assertEqual(proxy.name, 'client')
+    self.assertEqual(proxy.name, 'client')
+    factory.assert_called_once_with()
+
+
+class TestLazyModule(unittest.TestCase):
+
+  def setUp(self):
+    super(TestLazyModule, self).setUp()
+    sys.modules.pop('colorsys', None)
+
+  def test_imports_module_on_first_use(self):
+    colorsys = lazy.LazyModule('colorsys')
+    self.assertNotIn('colorsys', sys.modules)
+    self.assertEqual(colorsys.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+    self.assertIn('colorsys', sys.modules)
+
+  def test_sees_patched_attributes(self):
+    colorsys = lazy.LazyModule('colorsys')
+    with mock.patch('colorsys.rgb_to_hsv') as patched_rgb_to_hsv:
+      self.assertIs(colorsys.rgb_to_hsv, patched_rgb_to_hsv)
@@ -0,0 +1,76 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from core import metrics
+
+
+class TestRegistry(unittest.TestCase):
+
+  def setUp(self):
+    super(TestRegistry, self).setUp()
+    self.registry = metrics.Registry()
+
+  def test_renders_counter(self):
+    counter = self.registry.counter('tasks_total', 'Tasks.', ['status'])
+    counter.inc(status='failed')
+    counter.inc(2, status='succeeded')
+    counter.inc(status='succeeded')
+    self.assertEqual(self.registry.render(), '\n'.join([
+        '# HELP tasks_total Tasks.',
+        '# TYPE tasks_total counter',
+        'tasks_total{status="failed"} 1.0',
+        'tasks_total{status="succeeded"} 3.0',
+    ]) + '\n')
+
+  def test_renders_cumulative_histogram_buckets(self):
+    histogram = self.registry.histogram('duration_seconds', 'Durations.',
+                                        buckets=[1, 5])
+    histogram.observe(0.5)
+    histogram.observe(2)
+    histogram.observe(10)
+    self.assertEqual(self.registry.render(), '\n'.join([
+        '# HELP duration_seconds Durations.',
+        '# TYPE duration_seconds histogram',
+        'duration_seconds_bucket{le="1.0"} 1.0',
+        'duration_seconds_bucket{le="5.0"} 2.0',
+        'duration_seconds_bucket{le="+Inf"} 3.0',
+        'duration_seconds_sum 12.5',
+        'duration_seconds_count 3.0',
+    ]) + '\n')
+
+  def test_histogram_times_block_even_if_it_raises(self):
+    histogram = self.registry.histogram('duration_seconds', 'Durations.')
+    with self.assertRaises(ValueError):
+      with histogram.time():
+        raise ValueError()
+    self.assertIn('duration_seconds_count 1.0', self.registry.render())
+
+  def test_escapes_label_values(self):
+    counter = self.registry.counter('errors_total', 'Errors.', ['message'])
+    counter.inc(message='a "b"\\\n')
+    self.assertIn('errors_total{message="a \\"b\\"\\\\\\n"} 1.0',
+                  self.registry.render())
+
+  def test_returns_registered_metric(self):
+    counter = self.registry.counter('tasks_total', 'Tasks.')
+    self.assertIs(self.registry.counter('tasks_total', 'Tasks.'), counter)
+    with self.assertRaises(ValueError):
+      self.registry.histogram('tasks_total', 'Tasks.')
+
+  def test_rejects_wrong_labels(self):
+    counter = self.registry.counter('tasks_total', 'Tasks.', ['status'])
+    with self.assertRaises(ValueError):
+      counter.inc(worker_class='Commenter')
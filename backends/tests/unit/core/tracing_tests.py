@@ -0,0 +1,102 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import tracing
+
+
+class ListExporter(object):
+
+  def __init__(self):
+    self.spans = []
+
+  def export(self, span):
+    self.spans.append(span)
+
+
+class TestSpan(unittest.TestCase):
+
+  def setUp(self):
+    super(TestSpan, self).setUp()
+    self.exporter = ListExporter()
+    tracing.set_exporter(self.exporter)
+
+  def tearDown(self):
+    super(TestSpan, self).tearDown()
+    tracing.set_exporter(None)
+
+  def test_nested_spans_share_the_trace(self):
+    with tracing.span('outer') as outer:
+      with tracing.span('inner') as inner:
+        self.assertIs(tracing.current_span(), inner)
+      self.assertIs(tracing.current_span(), outer)
+    self.assertIsNone(tracing.current_span())
+    self.assertEqual(inner.trace_id, outer.trace_id)
+    self.assertEqual(inner.parent_id, outer.span_id)
+    self.assertIsNone(outer.parent_id)
+    self.assertEqual([s.name for s in self.exporter.spans], ['inner', 'outer'])
+
+  def test_continues_given_trace(self):
+    with tracing.span('task', trace_id='abc', parent_id='123', job_id=1) as s:
+      self.assertEqual(tracing.current_trace_id(), 'abc')
+    self.assertEqual(s.parent_id, '123')
+    self.assertEqual(s.attributes, {'job_id': 1})
+    self.assertGreaterEqual(s.end_time, s.start_time)
+
+  def test_span_ends_if_block_raises(self):
+    with self.assertRaises(ValueError):
+      with tracing.span('failing'):
+        raise ValueError()
+    self.assertIsNone(tracing.current_span())
+    self.assertIsNotNone(self.exporter.spans[0].end_time)
+
+  @mock.patch('logging.exception')
+  def test_failed_export_is_logged(self, patched_logging_exception):
+    exporter = mock.Mock()
+    exporter.export.side_effect = IOError()
+    tracing.set_exporter(exporter)
+    with tracing.span('span'):
+      pass
+    patched_logging_exception.assert_called_once()
+
+
+class TestTimeline(unittest.TestCase):
+
+  def setUp(self):
+    super(TestTimeline, self).setUp()
+    self.exporter = ListExporter()
+    tracing.set_exporter(self.exporter)
+
+  def tearDown(self):
+    super(TestTimeline, self).tearDown()
+    tracing.set_exporter(None)
+
+  def test_renders_exported_spans(self):
+    with tracing.span('pipeline.start', pipeline_id=1) as root:
+      with tracing.span('task', job_id=2):
+        pass
+    with tracing.span('other'):
+      pass
+    spans = [s.to_dict() for s in self.exporter.spans]
+    self.assertEqual(len(spans), 3)
+    timeline = tracing.render_timeline(spans, trace_id=root.trace_id)
+    events = timeline['traceEvents']
+    self.assertEqual([e['name'] for e in events], ['pipeline.start', 'task'])
+    self.assertEqual(events[0]['ph'], 'X')
+    self.assertEqual(events[0]['pid'], root.trace_id)
+    self.assertEqual(events[1]['tid'], 2)
+    self.assertEqual(events[1]['args']['parent_id'], root.span_id)
@@ -0,0 +1,54 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import uploads
+
+
+class TestCSVRowsUpload(unittest.TestCase):
+
+  def setUp(self):
+    super(TestCSVRowsUpload, self).setUp()
+    rows = [(u'caf\xe9', 1, None), ('b,c', 2, 0.1)] * 50
+    self._get_rows = mock.Mock(side_effect=lambda: iter(rows))
+    self._csv = 'a,b,c\n' + 'caf\xc3\xa9,1,\n"b,c",2,0.1\n' * 50
+
+  def test_getbytes_returns_consecutive_chunks(self):
+    media = uploads.CSVRowsUpload(['a', 'b', 'c'], self._get_rows, 64)
+    chunks = []
+    begin = 0
+    while True:
+      chunk = media.getbytes(begin, 64)
+      chunks.append(chunk)
+      begin += len(chunk)
+      if len(chunk) < 64:
+        break
+    self.assertEqual(''.join(chunks), self._csv)
+    self.assertEqual(self._get_rows.call_count, 1)
+    self.assertLessEqual(len(media._buffer), 64)
+
+  def test_getbytes_skips_to_resumed_offset(self):
+    media = uploads.CSVRowsUpload(['a', 'b', 'c'], self._get_rows, 64)
+    self.assertEqual(media.getbytes(500, 64), self._csv[500:564])
+    self.assertEqual(media.getbytes(540, 64), self._csv[540:604])
+    self.assertEqual(self._get_rows.call_count, 1)
+
+  def test_getbytes_reads_rows_again_for_earlier_offset(self):
+    media = uploads.CSVRowsUpload(['a', 'b', 'c'], self._get_rows, 64)
+    media.getbytes(500, 64)
+    self.assertEqual(media.getbytes(10, 64), self._csv[10:74])
+    self.assertEqual(self._get_rows.call_count, 2)
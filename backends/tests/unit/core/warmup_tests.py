@@ -0,0 +1,41 @@
+# Copyright 2018 Google Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import mock
+
+from core import warmup
+from core import workers
+
+
+class TestWarmUp(unittest.TestCase):
+
+  @mock.patch('core.workers.discovery.build')
+  @mock.patch('core.workers.get_credentials')
+  def test_warm_up_workers(self, patched_get_credentials, patched_build):
+    warmup.warm_up_workers()
+    credentials = patched_get_credentials.return_value
+    credentials.get_access_token.assert_called_once_with()
+    patched_build.assert_any_call('analytics', 'v4', credentials=credentials)
+    for module in workers.CLIENT_MODULES:
+      self.assertIsNotNone(module._object)
+
+  @mock.patch('logging.exception')
+  @mock.patch('core.database.engine')
+  def test_failed_step_is_logged(self, patched_engine, patched_exception):
+    patched_engine.connect.side_effect = IOError()
+    warmup.warm_up_database()
+    patched_exception.assert_called_once_with('Warm-up step failed: %s',
+                                              'database')
@@ -12,13 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
 import os
+import threading
 import unittest
 
 from apiclient.errors import HttpError
+from avro.datafile import DataFileWriter
+from avro.io import DatumWriter
+import avro.schema
 import cloudstorage
 from google.appengine.ext import testbed
 from google.cloud.bigquery.dataset import Dataset
+from google.cloud.bigquery.schema import SchemaField
 from google.cloud.bigquery.table import Table
 from google.cloud.exceptions import ClientError
 import mock
@@ -52,34 +59,90 @@ class TestAbstractWorker(unittest.TestCase):
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_info_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_info('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    # Entries are buffered until logs are flushed.
+    self.assertEqual(batch.commit.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'INFO')
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_warn_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_warn('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    # Entries are buffered until logs are flushed.
+    self.assertEqual(batch.commit.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'WARNING')
 
   @mock.patch('core.cloud_logging.logger')
   def test_log_error_succeeds(self, patched_logger):
-    patched_logger.log_struct.__name__ = 'foo'
+    batch = patched_logger.batch.return_value
     worker = workers.Worker({}, 1, 1)
-    self.assertEqual(patched_logger.log_struct.call_count, 0)
     worker.log_error('Hi there!')
-    self.assertEqual(patched_logger.log_struct.call_count, 1)
-    call_first_arg = patched_logger.log_struct.call_args[0][0]
+    # Entries are buffered until logs are flushed.
+    self.assertEqual(batch.commit.call_count, 0)
+    worker.flush_logs()
+    self.assertEqual(batch.log_struct.call_count, 1)
+    self.assertEqual(batch.commit.call_count, 1)
+    call_first_arg = batch.log_struct.call_args[0][0]
     self.assertEqual(call_first_arg.get('log_level'), 'ERROR')
 
+  def test_save_checkpoint_without_task_name_keeps_state_in_memory(self):
+    worker = workers.Worker({}, 1, 1)
+    self.assertIsNone(worker.load_checkpoint())
+    with mock.patch('core.models.TaskCheckpoint.save_state') as save_state:
+      worker.save_checkpoint({'page': 1})
+    self.assertEqual(worker.load_checkpoint(), {'page': 1})
+    save_state.assert_not_called()
+
+  def test_save_checkpoint_persists_state_of_task(self):
+    worker = workers.Worker({}, 1, 2, 'task')
+    with mock.patch('core.models.TaskCheckpoint.save_state') as save_state:
+      worker.save_checkpoint({'page': 1})
+    save_state.assert_called_once_with(2, 'task', {'page': 1})
+
+  @mock.patch('time.time')
+  def test_should_yield_once_time_budget_is_nearly_spent(self, patched_time):
+    patched_time.return_value = 1000
+    worker = workers.Worker({}, 1, 1)
+    patched_time.return_value += worker.TIME_BUDGET - worker.YIELD_MARGIN - 1
+    self.assertFalse(worker.should_yield())
+    patched_time.return_value += 2
+    self.assertTrue(worker.should_yield())
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_continuation_starts_from_given_state(self, patched_logger):
+    class DummyWorker(workers.Worker):
+      PARAMS = [
+        ('table', 'string', True, '', 'Description'),
+      ]
+    worker = DummyWorker({'table': 'events'}, 1, 1)
+    worker._enqueue_continuation({'page': 2})
+    [(worker_class, params, delay)] = worker._workers_to_enqueue
+    self.assertEqual(worker_class, 'DummyWorker')
+    self.assertEqual(delay, 0)
+    continuation = DummyWorker(params, 1, 1)
+    self.assertEqual(continuation.load_checkpoint(), {'page': 2})
+    self.assertEqual(continuation._params, {'table': 'events'})
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_flush_logs_doesnt_raise_write_error(self, patched_logger):
+    patched_logger.batch.return_value.commit.side_effect = ValueError('Down')
+    worker = workers.Worker({}, 1, 1)
+    worker.retry = lambda func, max_retries=0, count_calls=True: func
+    worker.log_info('Hi there!')
+    worker.flush_logs()
+    patched_logger.batch.return_value.commit.assert_called_once()
+
   @mock.patch('core.cloud_logging.logger')
   def test_execute_client_error_raises_worker_exception(self, patched_logger):
     patched_logger.log_struct.__name__ = 'foo'
@@ -115,6 +178,24 @@ class TestAbstractWorker(unittest.TestCase):
       worker.retry(fake_request)()
     self.assertGreaterEqual(fake_request.call_count, 2)
 
+  @mock.patch('time.sleep')
+  def test_retry_counts_api_calls(self, patched_time_sleep):
+    worker = workers.Worker({}, 1, 1)
+    fake_request = mock.Mock(side_effect=[ValueError('Wrong value.'), 'OK'])
+    fake_request.__name__ = 'foo'
+    self.assertEqual(worker.retry(fake_request)(), 'OK')
+    worker.count('rows', 10)
+    self.assertEqual(worker.counters,
+                     {'rows': 10, 'bytes': 0, 'api_calls': 2})
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_log_writes_are_not_counted_as_api_calls(self, patched_logger):
+    worker = workers.Worker({}, 1, 1)
+    worker.log_info('Hi there!')
+    worker.flush_logs()
+    patched_logger.batch.return_value.commit.assert_called_once()
+    self.assertEqual(worker.counters['api_calls'], 0)
+
   def test_retry_raises_error_if_bad_request_error(self):
     worker = workers.Worker({}, 1, 1)
     def _raise_value_error_exception(*args, **kwargs):
@@ -261,6 +342,656 @@ class TestStorageToBQImporter(unittest.TestCase):
     self.assertEqual(source_uris[1], 'gs://bucket/subdir/data.csv')
 
 
+class TestGAToBQImporter(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGAToBQImporter, self).setUp()
+    patcher_bq_setup = mock.patch.object(workers.GAToBQImporter, '_bq_setup')
+    self.addCleanup(patcher_bq_setup.stop)
+    patcher_bq_setup.start()
+    self._ga_client = mock.Mock()
+    patcher_get_ga_client = mock.patch.object(
+        workers.GAToBQImporter, '_get_ga_client', return_value=self._ga_client)
+    self.addCleanup(patcher_get_ga_client.stop)
+    patcher_get_ga_client.start()
+    patcher_logger = mock.patch('core.cloud_logging.logger')
+    self.addCleanup(patcher_logger.stop)
+    patched_logger = patcher_logger.start()
+    patched_logger.log_struct.__name__ = 'foo'
+
+  def _make_worker(self, **params):
+    worker_params = {
+        'view_ids': ['1', '2', '3'],
+        'start_date': '2018-01-01',
+        'end_date': '2018-01-31',
+        'day_by_day': False,
+        'metrics': ['ga:users'],
+        'dimensions': ['ga:source'],
+    }
+    worker_params.update(params)
+    worker = workers.GAToBQImporter(worker_params, 1, 1)
+    worker._table = mock.Mock()
+    worker._table.schema = [
+        SchemaField('view_id', 'STRING'),
+        SchemaField('start_date', 'STRING'),
+        SchemaField('ga_source', 'STRING'),
+        SchemaField('ga_users', 'STRING'),
+    ]
+    return worker
+
+  def _use_reports(self, pages_by_view, sampled_date_ranges=None):
+    def _batch_get(body):
+      request = body['reportRequests'][0]
+      pages = pages_by_view[request['viewId']]
+      page = int(request.get('pageToken', 0))
+      report = {
+          'columnHeader': {
+              'dimensions': ['ga:source'],
+              'metricHeader': {'metricHeaderEntries': [{'name': 'ga:users'}]},
+          },
+          'data': {},
+      }
+      date_range = request['dateRanges'][0]
+      date_range = (date_range['startDate'], date_range['endDate'])
+      if date_range in (sampled_date_ranges or {}):
+        samples_read, sampling_space = sampled_date_ranges[date_range]
+        report['data']['samplesReadCounts'] = [str(samples_read)]
+        report['data']['samplingSpaceSizes'] = [str(sampling_space)]
+      if pages[page]:
+        report['data']['rows'] = [
+            {'dimensions': [source], 'metrics': [{'values': [users]}]}
+            for source, users in pages[page]]
+      if page + 1 < len(pages):
+        report['nextPageToken'] = str(page + 1)
+      return mock.Mock(execute=lambda: {'reports': [report]})
+    self._ga_client.reports.return_value.batchGet.side_effect = _batch_get
+
+  def test_fetches_all_views_and_pages(self):
+    self._use_reports({
+        '1': [[('google', '10')], [('bing', '2')]],
+        '2': [[('direct', '5')]],
+        '3': [[]],
+    })
+    worker = self._make_worker()
+    worker._execute()
+    inserted_rows = []
+    for call in worker._table.insert_data.call_args_list:
+      inserted_rows += call[0][0]
+    self.assertEqual(sorted(inserted_rows), [
+        ('1', '2018-01-01', 'bing', '2'),
+        ('1', '2018-01-01', 'google', '10'),
+        ('2', '2018-01-01', 'direct', '5'),
+    ])
+    requested_view_ids = set(
+        c[1]['body']['reportRequests'][0]['viewId'] for c in
+        self._ga_client.reports.return_value.batchGet.call_args_list)
+    self.assertEqual(requested_view_ids, set(['1', '2', '3']))
+
+  def test_resumes_from_checkpoint(self):
+    self._use_reports({
+        '1': [[('google', '10')], [('bing', '2')]],
+        '2': [[('direct', '5')]],
+        '3': [[('yahoo', '1')]],
+    })
+    worker = self._make_worker()
+    worker.restore_checkpoint({
+        'reports': {'1_2018-01-01_2018-01-31': '1'},
+        'fetched': {'2': [['2018-01-01', '2018-01-31']]},
+    })
+    worker._execute()
+    inserted_rows = []
+    for call in worker._table.insert_data.call_args_list:
+      inserted_rows += call[0][0]
+    self.assertEqual(sorted(inserted_rows), [
+        ('1', '2018-01-01', 'bing', '2'),
+        ('3', '2018-01-01', 'yahoo', '1'),
+    ])
+    requests = [
+        c[1]['body']['reportRequests'][0] for c in
+        self._ga_client.reports.return_value.batchGet.call_args_list]
+    self.assertEqual(sorted((r['viewId'], r.get('pageToken'))
+                            for r in requests), [('1', '1'), ('3', None)])
+    self.assertEqual(worker.load_checkpoint(), {
+        'reports': {},
+        'fetched': dict((view_id, [['2018-01-01', '2018-01-31']])
+                        for view_id in ['1', '2', '3']),
+    })
+
+  def test_saves_checkpoints_from_task_thread(self):
+    self._use_reports({
+        '1': [[('google', '10')]],
+        '2': [[('direct', '5')]],
+        '3': [[]],
+    })
+    worker = self._make_worker()
+    threads = []
+    with mock.patch.object(
+        worker, 'save_checkpoint',
+        side_effect=lambda state: threads.append(threading.current_thread())):
+      worker._execute()
+    self.assertEqual(threads, [threading.current_thread()])
+
+  def test_continues_in_new_task_when_time_budget_is_spent(self):
+    self._use_reports({'1': [[('google', '10')], [('bing', '2')]]})
+    worker = self._make_worker(view_ids=['1'])
+    with mock.patch.object(worker, 'should_yield', side_effect=[False, True]):
+      worker._execute()
+    inserted_rows = []
+    for call in worker._table.insert_data.call_args_list:
+      inserted_rows += call[0][0]
+    self.assertEqual(inserted_rows, [('1', '2018-01-01', 'google', '10')])
+    [(worker_class, params, _)] = worker._workers_to_enqueue
+    self.assertEqual(worker_class, 'GAToBQImporter')
+    self.assertEqual(params['continuation'], {
+        'reports': {'1_2018-01-01_2018-01-31': '1'},
+        'fetched': {},
+    })
+
+  def test_splits_sampled_date_ranges(self):
+    self._use_reports(
+        {'1': [[('google', '10')]]},
+        sampled_date_ranges={
+            ('2018-01-01', '2018-01-31'): (400, 1000),
+            ('2018-01-12', '2018-01-21'): (500, 1000),
+        })
+    worker = self._make_worker(view_ids=['1'])
+    worker._execute()
+    requested_date_ranges = [
+        c[1]['body']['reportRequests'][0]['dateRanges'][0] for c in
+        self._ga_client.reports.return_value.batchGet.call_args_list]
+    self.assertEqual(
+        [(r['startDate'], r['endDate']) for r in requested_date_ranges], [
+            ('2018-01-01', '2018-01-31'),
+            ('2018-01-01', '2018-01-11'),
+            ('2018-01-12', '2018-01-21'),
+            ('2018-01-12', '2018-01-16'),
+            ('2018-01-17', '2018-01-21'),
+            ('2018-01-22', '2018-01-31'),
+        ])
+    inserted_rows = []
+    for call in worker._table.insert_data.call_args_list:
+      inserted_rows += call[0][0]
+    self.assertEqual(len(inserted_rows), 4)
+    # Fetched parts of the range are checkpointed as the range itself.
+    self.assertEqual(worker.load_checkpoint(), {
+        'reports': {},
+        'fetched': {'1': [['2018-01-01', '2018-01-31']]},
+    })
+
+  def test_resumes_split_date_range_after_fetched_parts(self):
+    self._use_reports(
+        {'1': [[('google', '10')]]},
+        sampled_date_ranges={('2018-01-01', '2018-01-31'): (400, 1000)})
+    worker = self._make_worker(view_ids=['1'])
+    worker.restore_checkpoint({
+        'reports': {},
+        'fetched': {'1': [['2018-01-01', '2018-01-21']]},
+    })
+    worker._execute()
+    requested_date_ranges = [
+        c[1]['body']['reportRequests'][0]['dateRanges'][0] for c in
+        self._ga_client.reports.return_value.batchGet.call_args_list]
+    self.assertEqual(
+        [(r['startDate'], r['endDate']) for r in requested_date_ranges],
+        [('2018-01-01', '2018-01-31'), ('2018-01-22', '2018-01-31')])
+
+  def test_keeps_sampled_data_if_splitting_is_disabled(self):
+    self._use_reports(
+        {'1': [[('google', '10')]]},
+        sampled_date_ranges={('2018-01-01', '2018-01-31'): (400, 1000)})
+    worker = self._make_worker(view_ids=['1'], split_sampled_ranges=False)
+    worker._execute()
+    self.assertEqual(
+        self._ga_client.reports.return_value.batchGet.call_count, 1)
+    worker._table.insert_data.assert_called_once()
+
+  def test_day_by_day_enqueues_next_day(self):
+    self._use_reports({'1': [[('google', '10')]]})
+    worker = self._make_worker(view_ids=['1'], day_by_day=True)
+    worker._execute()
+    self.assertEqual(len(worker._workers_to_enqueue), 1)
+    self.assertEqual(worker._workers_to_enqueue[0][0], 'GAToBQImporter')
+    self.assertEqual(worker._workers_to_enqueue[0][1]['start_date'],
+                     '2018-01-02')
+
+  def test_day_by_day_fetches_several_days_per_task(self):
+    self._use_reports({'1': [[('google', '10')]]})
+    worker = self._make_worker(view_ids=['1'], day_by_day=True,
+                               days_per_task=3)
+    worker._execute()
+    requested_dates = [
+        c[1]['body']['reportRequests'][0]['dateRanges'][0]['startDate']
+        for c in self._ga_client.reports.return_value.batchGet.call_args_list]
+    self.assertEqual(requested_dates,
+                     ['2018-01-01', '2018-01-02', '2018-01-03'])
+    self.assertEqual(worker._workers_to_enqueue[0][1]['start_date'],
+                     '2018-01-04')
+    # The checkpoint doesn't grow with the days fetched.
+    self.assertEqual(worker.load_checkpoint(), {
+        'reports': {},
+        'fetched': {'1': [['2018-01-01', '2018-01-03']]},
+    })
+
+  def test_day_by_day_fans_out_date_range(self):
+    worker = self._make_worker(day_by_day=True, parallel_days=3,
+                               end_date='2018-01-10')
+    worker._execute()
+    self._ga_client.reports.assert_not_called()
+    date_ranges = [(p['start_date'], p['end_date'], p['parallel_days'])
+                   for _, p, _ in worker._workers_to_enqueue]
+    self.assertEqual(date_ranges, [
+        ('2018-01-01', '2018-01-04', 1),
+        ('2018-01-05', '2018-01-07', 1),
+        ('2018-01-08', '2018-01-10', 1),
+    ])
+
+
+class TestGADataImporter(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGADataImporter, self).setUp()
+    patcher_stat = mock.patch('cloudstorage.stat')
+    self.addCleanup(patcher_stat.stop)
+    self._stat = patcher_stat.start()
+    self._stat.return_value = cloudstorage.GCSFileStat(
+        '/bucket/data.csv', 6, 'etag1', 0)
+    patcher_open = mock.patch('cloudstorage.open')
+    self.addCleanup(patcher_open.stop)
+    patcher_open.start().side_effect = lambda *a, **kw: io.BytesIO('a,b\n1,2')
+    patcher_get_ga_client = mock.patch.object(
+        workers.GADataImporter, '_get_ga_client')
+    self.addCleanup(patcher_get_ga_client.stop)
+    self._ga_client = patcher_get_ga_client.start().return_value
+    self._request = mock.Mock(resumable_uri=None, resumable_progress=0,
+                              _in_error_state=False)
+    self._ga_client.management.return_value.uploads.return_value.\
+        uploadData.return_value = self._request
+    patcher_logger = mock.patch('core.cloud_logging.logger')
+    self.addCleanup(patcher_logger.stop)
+    patcher_logger.start().log_struct.__name__ = 'foo'
+
+  def _make_worker(self, checkpoint=None):
+    worker = workers.GADataImporter(
+        {
+            'csv_uri': 'gs://bucket/data.csv',
+            'property_id': 'UA-12345-1',
+            'dataset_id': 'DATASET',
+            'max_uploads': 0,
+        },
+        1,
+        1)
+    worker.restore_checkpoint(checkpoint)
+    return worker
+
+  def _fail_after_first_chunk(self):
+    def _next_chunk():
+      if self._request.resumable_uri is None:
+        self._request.resumable_uri = 'https://upload/session'
+        self._request.resumable_progress = 4
+        return mock.Mock(progress=lambda: 0.5), None
+      raise HttpError(mock.Mock(status=503), '')
+    self._request.next_chunk.side_effect = _next_chunk
+
+  @mock.patch('time.sleep')
+  def test_retried_task_resumes_upload_session(self, _):
+    self._fail_after_first_chunk()
+    worker = self._make_worker()
+    with self.assertRaises(HttpError):
+      worker._execute()
+    self._request.resumable_uri = None
+    self._request.resumable_progress = 0
+    sessions = []
+    def _next_chunk():
+      sessions.append((self._request.resumable_uri,
+                       self._request.resumable_progress,
+                       self._request._in_error_state))
+      return None, {}
+    self._request.next_chunk.side_effect = _next_chunk
+    self._make_worker(worker.load_checkpoint())._execute()
+    self.assertEqual(sessions, [('https://upload/session', 4, True)])
+
+  @mock.patch('time.sleep')
+  def test_upload_restarts_if_file_has_changed(self, _):
+    self._fail_after_first_chunk()
+    worker = self._make_worker()
+    with self.assertRaises(HttpError):
+      worker._execute()
+    self._stat.return_value = cloudstorage.GCSFileStat(
+        '/bucket/data.csv', 6, 'etag2', 0)
+    self._request.resumable_uri = None
+    self._request.resumable_progress = 0
+    self._request.next_chunk.side_effect = None
+    self._request.next_chunk.return_value = (None, {})
+    self._make_worker(worker.load_checkpoint())._execute()
+    self.assertIsNone(self._request.resumable_uri)
+    self.assertEqual(self._request.resumable_progress, 0)
+
+  def test_adapt_chunk_size_to_throughput(self):
+    worker = self._make_worker()
+    media = mock.Mock(_chunksize=256 * 1024)
+    worker._adapt_chunk_size(media, 100 * 1024, 1.0)
+    self.assertEqual(media._chunksize, 3 * 256 * 1024)
+    worker._adapt_chunk_size(media, 10 * 1024, 5.0)
+    self.assertEqual(media._chunksize, 256 * 1024)
+    worker._adapt_chunk_size(media, 8 * 1024 * 1024, 0.5)
+    self.assertEqual(media._chunksize, 8 * 1024 * 1024)
+
+
+class TestBQToGADataImporter(unittest.TestCase):
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_uploads_table_rows_as_csv(self, patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    worker = workers.BQToGADataImporter(
+        {
+            'bq_dataset_id': 'dataset',
+            'bq_table_id': 'table',
+            'property_id': 'UA-12345-1',
+            'dataset_id': 'DATASET',
+            'max_uploads': 0,
+        },
+        1,
+        1)
+    table = mock.Mock(etag='etag')
+    table.schema = [
+        SchemaField('ga_dimension1', 'STRING'),
+        SchemaField('ga_metric1', 'INTEGER'),
+    ]
+    table.fetch_data.return_value = [('a', 1), ('b', 2)]
+    def _bq_setup():
+      worker._table = table
+    uploaded = []
+    def _upload_data(media_body, **kwargs):
+      request = mock.Mock(resumable_uri=None, resumable_progress=0)
+      def _next_chunk():
+        uploaded.append(media_body.getbytes(0, media_body.chunksize()))
+        return None, {}
+      request.next_chunk.side_effect = _next_chunk
+      return request
+    with mock.patch.object(worker, '_bq_setup', side_effect=_bq_setup), \
+         mock.patch.object(worker, '_get_ga_client') as patched_get_ga_client:
+      patched_get_ga_client.return_value.management.return_value.uploads.\
+          return_value.uploadData.side_effect = _upload_data
+      worker._execute()
+    self.assertEqual(uploaded, ['ga:dimension1,ga:metric1\na,1\nb,2\n'])
+
+
+class TestAudienceTemplate(unittest.TestCase):
+
+  def test_render_substitutes_values(self):
+    template = workers._AudienceTemplate(
+        u'{"name": "%(name)s", "days": %(days)s, "ids": [%(id)s],'
+        u' "rule": "users::condition::ga:dimension1==%(id)s 100%%"}',
+        ['name', 'days', 'id'])
+    self.assertEqual(template.render((u'Buyers', 7, 12)), {
+        u'name': u'Buyers',
+        u'days': 7,
+        u'ids': [12],
+        u'rule': u'users::condition::ga:dimension1==12 100%',
+    })
+
+  def test_render_keeps_quotes_in_values(self):
+    template = workers._AudienceTemplate(
+        u'{"name": "%(name)s", "description": "\\"%(name)s\\" buyers"}',
+        ['name'])
+    self.assertEqual(template.render((u'Say "hi"',)), {
+        u'name': u'Say "hi"',
+        u'description': u'"Say "hi"" buyers',
+    })
+
+  def test_render_returns_new_objects(self):
+    template = workers._AudienceTemplate(
+        u'{"name": "%(name)s", "filters": {"ids": [1, 2]}}', ['name'])
+    audience = template.render((u'a',))
+    audience['filters']['ids'].append(3)
+    self.assertEqual(template.render((u'b',)),
+                     {u'name': u'b', u'filters': {u'ids': [1, 2]}})
+
+  def test_render_keeps_template_text_verbatim(self):
+    template = workers._AudienceTemplate(
+        u'{"name": "%(name)s\')], __import__(\'os\')", "}{": [{}]}',
+        ['name'])
+    self.assertEqual(template.render((u'a',)), {
+        u'name': u"a')], __import__('os')",
+        u'}{': [{}],
+    })
+
+  def test_render_falls_back_to_text_substitution(self):
+    template = workers._AudienceTemplate(
+        u'{"name": "%(name)s", "days": %(sign)s%(days)s}',
+        ['name', 'sign', 'days'])
+    self.assertEqual(template.render((u'a', u'-', 7)),
+                     {u'name': u'a', u'days': -7})
+
+  def test_render_raises_worker_exception_on_invalid_json_value(self):
+    template = workers._AudienceTemplate(u'{"days": %(days)s}', ['days'])
+    with self.assertRaises(workers.WorkerException):
+      template.render((u'seven',))
+
+  def test_unknown_field_raises_worker_exception(self):
+    with self.assertRaises(workers.WorkerException):
+      workers._AudienceTemplate(u'{"name": "%(nme)s"}', ['name'])
+
+
+class TestGAAudiencesUpdater(unittest.TestCase):
+
+  def setUp(self):
+    super(TestGAAudiencesUpdater, self).setUp()
+    patcher_logger = mock.patch('core.cloud_logging.logger')
+    self.addCleanup(patcher_logger.stop)
+    self._logger = patcher_logger.start()
+    self._logger.log_struct.__name__ = 'foo'
+    patcher_sleep = mock.patch('time.sleep')
+    self.addCleanup(patcher_sleep.stop)
+    patcher_sleep.start()
+    self._worker = workers.GAAudiencesUpdater(
+        {'property_id': 'UA-12345-1'}, 1, 1)
+    self._worker._account_id = '12345'
+    self._worker._ga_client = mock.Mock()
+    self._batches = []
+    self._failures = {}
+    self._worker._ga_client.new_batch_http_request.side_effect = \
+        self._new_batch
+
+  def _new_batch(self, callback):
+    batch = mock.Mock()
+    batch.request_ids = []
+    batch.add.side_effect = lambda r, request_id: batch.request_ids.append(
+        request_id)
+    def _execute():
+      for request_id in batch.request_ids:
+        statuses = self._failures.get(request_id)
+        if statuses:
+          error = HttpError(mock.Mock(status=statuses.pop(0)), '')
+          callback(request_id, None, error)
+        else:
+          callback(request_id, {'id': request_id}, None)
+    batch.execute.side_effect = _execute
+    batch.execute.__name__ = 'execute'
+    self._batches.append(batch)
+    return batch
+
+  def _set_diff(self, inserts, patches):
+    self._worker._audiences_to_insert = [
+        {'name': 'new%i' % i} for i in xrange(inserts)]
+    self._worker._audiences_to_patch = dict(
+        ('id%i' % i, {'name': 'changed%i' % i}) for i in xrange(patches))
+    self._worker._inserted_count = 0
+    self._worker._patched_count = 0
+
+  def test_updates_audiences_in_batches(self):
+    self._set_diff(60, 10)
+    self._worker._update_ga_audiences()
+    self.assertEqual([len(b.request_ids) for b in self._batches], [50, 20])
+    self.assertEqual(self._worker._inserted_count, 60)
+    self.assertEqual(self._worker._patched_count, 10)
+
+  def test_retries_only_failed_requests(self):
+    self._set_diff(2, 1)
+    self._failures = {'patch-id0': [503, 429]}
+    self._worker._update_ga_audiences()
+    self.assertEqual([b.request_ids for b in self._batches], [
+        ['insert-0', 'insert-1', 'patch-id0'],
+        ['patch-id0'],
+        ['patch-id0'],
+    ])
+
+  def test_get_audiences_fetches_audiences_by_id(self):
+    audiences = self._worker._get_audiences(['id0', 'id1'])
+    self.assertEqual([b.request_ids for b in self._batches], [['id0', 'id1']])
+    self.assertEqual(audiences, {'id0': {'id': 'id0'}, 'id1': {'id': 'id1'}})
+
+  def test_client_error_fails_without_retries(self):
+    self._set_diff(2, 0)
+    self._failures = {'insert-1': [400]}
+    with self.assertRaises(workers.WorkerException):
+      self._worker._update_ga_audiences()
+    self.assertEqual(len(self._batches), 1)
+
+  def test_rows_are_held_one_batch_at_a_time(self):
+    class _FakeRemarketingAudience(object):
+      def list(self, start_index, max_results, **kwargs):
+        # Every other table row has its audience in GA already.
+        request = mock.Mock()
+        request.execute.__name__ = 'execute'
+        request.execute.return_value = {
+            'totalResults': 50000,
+            'items': [
+                {'id': 'ID%i' % i, 'name': 'audience%i' % i}
+                for i in xrange(2 * (start_index - 1),
+                                2 * (start_index - 1 + max_results), 2)],
+        }
+        return request
+      def get(self, remarketingAudienceId, **kwargs):
+        return remarketingAudienceId
+      def insert(self, body, **kwargs):
+        return body
+      def patch(self, remarketingAudienceId, **kwargs):
+        return remarketingAudienceId
+    class _FakeBatch(object):
+      def __init__(self, callback):
+        self._callback = callback
+        self._request_ids = []
+      def add(self, request, request_id):
+        self._request_ids.append(request_id)
+      def execute(self):
+        for request_id in self._request_ids:
+          self._callback(request_id, {'id': request_id}, None)
+    class _FakeGAClient(object):
+      def management(self):
+        return mock.Mock(**{
+            'remarketingAudience.return_value': _FakeRemarketingAudience()})
+      def new_batch_http_request(self, callback):
+        return _FakeBatch(callback)
+    table = mock.Mock()
+    table.schema = [SchemaField('name', 'STRING'),
+                    SchemaField('value', 'INTEGER')]
+    rows_read = [0]
+    def _fetch_data():
+      for i in xrange(100000):
+        rows_read[0] += 1
+        yield ('audience%i' % i, i)
+    table.fetch_data.side_effect = _fetch_data
+    worker = workers.GAAudiencesUpdater(
+        {
+            'property_id': 'UA-12345-1',
+            'template': '{"name": "%(name)s", "description": "%(value)s"}',
+        },
+        1,
+        1)
+    def _bq_setup():
+      worker._table = table
+    sync = worker._sync
+    batches = []
+    def _sync(audiences):
+      sync(audiences)
+      batches.append((rows_read[0], len(audiences),
+                      len(worker._audiences_to_insert),
+                      len(worker._audiences_to_patch)))
+    get_audiences = worker._get_audiences
+    fetched = []
+    def _get_audiences(audience_ids):
+      audiences = get_audiences(audience_ids)
+      fetched.append(len(audiences))
+      return audiences
+    with mock.patch.object(worker, '_bq_setup', _bq_setup), \
+         mock.patch.object(worker, '_get_ga_client',
+                           lambda v: _FakeGAClient()), \
+         mock.patch.object(worker, '_load_fingerprints', lambda names: {}), \
+         mock.patch.object(worker, '_save_fingerprints', lambda *args: None), \
+         mock.patch.object(worker, '_get_audiences', _get_audiences), \
+         mock.patch.object(worker, '_sync', _sync):
+      worker._execute()
+    self.assertEqual(worker._inserted_count, 50000)
+    self.assertEqual(worker._patched_count, 50000)
+    # Rows are read from the table as batches are synced, each batch holding
+    # SYNC_SIZE rows and audiences.
+    half = worker.SYNC_SIZE / 2
+    self.assertEqual(batches, [
+        ((i + 1) * worker.SYNC_SIZE, worker.SYNC_SIZE, half, half)
+        for i in xrange(200)])
+    # GA audiences are fetched and held at most BATCH_SIZE at a time.
+    self.assertEqual(sum(fetched), 50000)
+    self.assertEqual(max(fetched), worker.BATCH_SIZE)
+
+
+class TestHitEncoder(unittest.TestCase):
+
+  def test_encode_flattens_records_and_repeated_fields(self):
+    encoder = workers._HitEncoder([
+        SchemaField('cid', 'STRING'),
+        SchemaField('cd', 'STRING', mode='REPEATED'),
+        SchemaField('pr', 'RECORD', mode='REPEATED', fields=[
+            SchemaField('id', 'STRING'),
+            SchemaField('pr', 'FLOAT'),
+        ]),
+    ])
+    hit = encoder.encode((
+        u'1.2',
+        [u'a b', None, u'c&d'],
+        [{'id': u'\u00e9', 'pr': 9.5}, {'id': u'x', 'pr': None}],
+    ))
+    self.assertEqual(
+        hit, 'cd1=a+b&cd3=c%26d&cid=1.2&pr1id=%C3%A9&pr1pr=9.5&pr2id=x&v=1')
+
+  def test_encode_keeps_version_from_row(self):
+    encoder = workers._HitEncoder(
+        [SchemaField('v', 'INTEGER'), SchemaField('t', 'STRING')])
+    self.assertEqual(encoder.encode((2, None)), 'v=2')
+
+  def test_encode_defaults_null_version_to_1(self):
+    encoder = workers._HitEncoder(
+        [SchemaField('v', 'INTEGER'), SchemaField('t', 'STRING')])
+    self.assertEqual(encoder.encode((None, u'event')), 't=event&v=1')
+
+
+class TestMeasurementProtocolWorker(unittest.TestCase):
+
+  @mock.patch('core.cloud_logging.logger')
+  def test_pack_hits_fills_batches_up_to_limits(self, patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    worker = workers.MeasurementProtocolWorker({}, 1, 1)
+    hits = ['a' * 10] * 25 + ['b' * 5000] * 4 + ['c' * 9000] + ['d' * 10]
+    batches = list(worker._pack_hits(hits))
+    self.assertEqual([[len(h) for h in b] for b in batches], [
+        [10] * 20,
+        [10] * 5 + [5000] * 3,
+        [5000, 10],
+    ])
+    self.assertEqual(worker._packed_batches_bytes, [219, 15057, 5011])
+    for batch, batch_bytes in zip(batches, worker._packed_batches_bytes):
+      self.assertEqual(len('\n'.join(batch)), batch_bytes)
+    worker.flush_logs()
+    batch = patched_logger.batch.return_value
+    self.assertEqual(batch.log_struct.call_count, 1)
+    self.assertEqual(batch.log_struct.call_args[0][0]['log_level'], 'ERROR')
+
+  def test_pack_hits_respects_smaller_batch_size(self):
+    worker = workers.MeasurementProtocolWorker({}, 1, 1)
+    batches = list(worker._pack_hits(['a'] * 5, 2))
+    self.assertEqual(batches, [['a', 'a'], ['a', 'a'], ['a']])
+
+
 class TestBQToMeasurementProtocolMixin(object):
 
   def _use_query_results(self, response_json):
@@ -289,7 +1020,7 @@ class TestBQToMeasurementProtocolProcessor(TestBQToMeasurementProtocolMixin, uni
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-    patcher_requests_post = mock.patch('requests.post')
+    patcher_requests_post = mock.patch('requests.Session.post')
     self.addCleanup(patcher_requests_post.stop)
     self._patched_post = patcher_requests_post.start()
     self.maxDiff = None  # This is to see full diff when self.assertEqual fails.
@@ -663,6 +1394,213 @@ cd1=segment1&cid=35009a79-1a05-49d7-b876-2b884d0f825b&ea=action&ec=category&el=%
     # When retry stops it should log the message as an error.
     patched_logger.log_error.called_once()
 
+  @mock.patch('core.cloud_logging.logger')
+  @mock.patch('time.sleep')
+  def test_sends_batches_concurrently_and_logs_errors_in_order(
+      self, patched_time_sleep, patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 2}, 1, 1)
+    self._worker.MAX_CONCURRENT_BATCHES = 3
+    lock = threading.Lock()
+    in_flight = [0]
+    max_in_flight = [0]
+    def _post(url, headers, data):
+      with lock:
+        in_flight[0] += 1
+        max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+      threading.Event().wait(0.01)
+      with lock:
+        in_flight[0] -= 1
+      failed = 'cid=3' in data or 'cid=7' in data
+      return mock.Mock(status_code=500 if failed else 200)
+    self._patched_post.side_effect = _post
+    patched_time_sleep.side_effect = lambda delay: None
+    self._worker._process_query_results(
+        [('UA-12345-1', str(i)) for i in xrange(20)],
+        [SchemaField('tid', 'STRING'), SchemaField('cid', 'STRING')])
+    self._worker.flush_logs()
+    # 10 batches, 2 of them failing twice because of 1 retry.
+    self.assertEqual(self._patched_post.call_count, 12)
+    self.assertEqual(max_in_flight[0], 3)
+    errors = [c[0][0]['message']
+              for c in patched_logger.batch().log_struct.call_args_list
+              if c[0][0]['log_level'] == 'ERROR']
+    self.assertEqual(len(errors), 2)
+    self.assertIn('cid=3', errors[0])
+    self.assertIn('cid=7', errors[1])
+
+  @mock.patch('core.cloud_logging.logger')
+  @mock.patch('time.sleep')
+  def test_spools_hits_of_failed_batches(self, patched_time_sleep,
+                                         patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 2, 'spool_uri_prefix': 'gs://bucket/failed/'}, 1, 2)
+    self._patched_post.side_effect = lambda url, headers, data: mock.Mock(
+        status_code=500 if 'cid=3' in data else 200)
+    spool_file = io.BytesIO()
+    spool_file.close = lambda: None
+    with mock.patch('cloudstorage.open') as patched_open:
+      patched_open.return_value = spool_file
+      self._worker._process_query_results(
+          [('UA-12345-1', str(i)) for i in xrange(6)],
+          [SchemaField('tid', 'STRING'), SchemaField('cid', 'STRING')])
+    patched_open.assert_called_once()
+    self.assertTrue(
+        patched_open.call_args[0][0].startswith('/bucket/failed/1_2_'))
+    self.assertEqual(patched_open.call_args[0][1], 'w')
+    lines = spool_file.getvalue().splitlines()
+    self.assertEqual(len(lines), 1)
+    self.assertEqual(json.loads(lines[0]), {
+        'status_code': 500,
+        'hits': ['cid=2&tid=UA-12345-1&v=1', 'cid=3&tid=UA-12345-1&v=1'],
+    })
+
+  @mock.patch('core.cloud_logging.logger')
+  @mock.patch('time.sleep')
+  def test_doesnt_spool_without_spool_uri_prefix(self, patched_time_sleep,
+                                                 patched_logger):
+    patched_logger.log_struct.__name__ = 'foo'
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {'mp_batch_size': 2}, 1, 2)
+    self._patched_post.return_value = mock.Mock(status_code=500)
+    with mock.patch('cloudstorage.open') as patched_open:
+      self._worker._process_query_results(
+          [('UA-12345-1', '1')],
+          [SchemaField('tid', 'STRING'), SchemaField('cid', 'STRING')])
+    patched_open.assert_not_called()
+
+  def test_reads_row_range_by_offsets_without_reload(self):
+    self._worker = workers.BQToMeasurementProtocolProcessor(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'bq_start_index': 5,
+            'bq_batch_size': 3,
+            'bq_schema': [
+                {'name': 'tid', 'type': 'string', 'mode': 'nullable'},
+                {'name': 'cid', 'type': 'string', 'mode': 'nullable'},
+            ],
+            'mp_batch_size': 20,
+        },
+        1,
+        1)
+    page = {
+        'rows': [
+            {'f': [{'v': 'UA-12345-1'}, {'v': '1'}]},
+            {'f': [{'v': 'UA-12345-1'}, {'v': '2'}]},
+        ],
+    }
+    self._use_query_results(dict(page, jobReference={}))
+    api_request = self._client._connection.api_request
+    mock_response = mock.Mock()
+    mock_response.status_code = 200
+    self._patched_post.return_value = mock_response
+
+    self._worker._execute()
+    # Two pages of data are read, the table metadata isn't.
+    self.assertEqual(api_request.call_count, 2)
+    query_params = [c[1]['query_params'] for c in api_request.call_args_list]
+    self.assertEqual(query_params[0]['startIndex'], 5)
+    self.assertEqual(query_params[0]['maxResults'], 3)
+    self.assertEqual(query_params[1]['startIndex'], 7)
+    self.assertEqual(query_params[1]['maxResults'], 1)
+    self.assertEqual(self._patched_post.call_args[1]['data'].count('\n'), 2)
+
+  def _avro_processor(self, continuation=None):
+    params = {
+        'bq_project_id': 'BQID',
+        'bq_dataset_id': 'DTID',
+        'bq_table_id': 'table_id',
+        'avro_file': '/bucket/hits/job-000000000000.avro',
+        'bq_schema': [
+            {'name': 'tid', 'type': 'string', 'mode': 'nullable'},
+            {'name': 'cid', 'type': 'string', 'mode': 'nullable'},
+            {'name': 'ev', 'type': 'float', 'mode': 'nullable'},
+        ],
+        'mp_batch_size': 20,
+    }
+    if continuation is not None:
+      params['continuation'] = continuation
+    return workers.BQToMeasurementProtocolProcessor(params, 1, 1)
+
+  def _avro_file(self, records):
+    schema = avro.schema.parse(json.dumps({
+        'type': 'record',
+        'name': 'Root',
+        'fields': [
+            {'name': 'tid', 'type': ['null', 'string']},
+            {'name': 'cid', 'type': ['null', 'string']},
+            {'name': 'ev', 'type': ['null', 'double']},
+        ],
+    }))
+    avro_data = io.BytesIO()
+    writer = DataFileWriter(avro_data, DatumWriter(), schema)
+    for record in records:
+      writer.append(record)
+    writer.flush()
+    return io.BytesIO(avro_data.getvalue())
+
+  def test_sends_rows_of_avro_file_and_deletes_it(self):
+    self._worker = self._avro_processor()
+    avro_file = self._avro_file([
+        {'tid': u'UA-12345-1', 'cid': u'1', 'ev': 0.5},
+        {'tid': u'UA-12345-1', 'cid': u'2', 'ev': None},
+    ])
+    mock_response = mock.Mock()
+    mock_response.status_code = 200
+    self._patched_post.return_value = mock_response
+
+    with mock.patch('cloudstorage.open') as patched_open, \
+         mock.patch('cloudstorage.delete') as patched_delete:
+      patched_open.return_value = avro_file
+      self._worker._execute()
+    patched_open.assert_called_once_with('/bucket/hits/job-000000000000.avro')
+    patched_delete.assert_called_once_with(
+        '/bucket/hits/job-000000000000.avro')
+    # Rows are read from the file only.
+    self._client._connection.api_request.assert_not_called()
+    self.assertEqual(
+        self._patched_post.call_args[1]['data'],
+        'cid=1&ev=0.5&tid=UA-12345-1&v=1\ncid=2&tid=UA-12345-1&v=1')
+
+  def test_avro_file_yields_and_resumes_after_sent_records(self):
+    records = [{'tid': u'UA-12345-1', 'cid': unicode(i), 'ev': None}
+               for i in xrange(5)]
+    self._patched_post.return_value = mock.Mock(status_code=200)
+    self._worker = self._avro_processor()
+    with mock.patch('cloudstorage.open') as patched_open, \
+         mock.patch('cloudstorage.delete') as patched_delete, \
+         mock.patch.object(self._worker, 'AVRO_CHUNK_SIZE', 2), \
+         mock.patch.object(self._worker, 'should_yield', return_value=True):
+      patched_open.return_value = self._avro_file(records)
+      self._worker._execute()
+    patched_delete.assert_not_called()
+    state = {'avro_file': '/bucket/hits/job-000000000000.avro',
+             'sent_rows': 2}
+    self.assertEqual(self._worker.load_checkpoint(), state)
+    self.assertEqual(self._worker._workers_to_enqueue[0][1]['continuation'],
+                     state)
+    self.assertEqual(self._patched_post.call_args[1]['data'],
+                     'cid=0&tid=UA-12345-1&v=1\ncid=1&tid=UA-12345-1&v=1')
+
+    self._patched_post.reset_mock()
+    self._worker = self._avro_processor(continuation=state)
+    with mock.patch('cloudstorage.open') as patched_open, \
+         mock.patch('cloudstorage.delete') as patched_delete, \
+         mock.patch.object(self._worker, 'AVRO_CHUNK_SIZE', 2):
+      patched_open.return_value = self._avro_file(records)
+      self._worker._execute()
+    patched_delete.assert_called_once_with(
+        '/bucket/hits/job-000000000000.avro')
+    sent_hits = []
+    for call in self._patched_post.call_args_list:
+      sent_hits.extend(call[1]['data'].split('\n'))
+    self.assertEqual(sorted(sent_hits), [
+        'cid=%i&tid=UA-12345-1&v=1' % i for i in xrange(2, 5)])
+
 
 class TestBQToMeasurementProtocol(TestBQToMeasurementProtocolMixin, unittest.TestCase):
 
@@ -677,85 +1615,295 @@ class TestBQToMeasurementProtocol(TestBQToMeasurementProtocolMixin, unittest.Tes
     self.addCleanup(patcher_get_client.stop)
     patcher_get_client.start()
 
-  @mock.patch('time.sleep')
-  def test_success_with_spawning_new_worker(self, patched_time_sleep):
-    # Bypass the time.sleep wait
-    patched_time_sleep.return_value = 1
+  def test_success_with_spawning_new_worker(self):
     self._worker = workers.BQToMeasurementProtocol(
         {
             'bq_project_id': 'BQID',
             'bq_dataset_id': 'DTID',
             'bq_table_id': 'table_id',
-            'bq_page_token': None,
             'mp_batch_size': 20,
         },
         1,
         1)
-    self._worker.MAX_ENQUEUED_JOBS = 1
-    api_response = {
+    self._worker.MAX_ENQUEUED_JOBS = 2
+    self._use_query_results({
         'tableReference': {
             'tableId': 'mock_table',
         },
         'jobReference': {
-            'jobId': 'one-row-query',
+            'jobId': 'table',
         },
-        'pageToken': 'abc',
-        'rows': [
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.9},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-            {
-                'f': [
-                    {'v': 'UA-12345-1'},
-                    {'v': '35009a79-1a05-49d7-b876-2b884d0f825b'},
-                    {'v': 'event'},
-                    {'v': 1},
-                    {'v': 'category'},
-                    {'v': 'action'},
-                    {'v': 'label'},
-                    {'v': 0.8},
-                    {'v': 'User Agent / 1.0'},
-                ]
-            },
-        ],
+        'numRows': '2500',
         'schema': {
             'fields': [
                 {'name': 'tid', 'type': 'STRING'},
                 {'name': 'cid', 'type': 'STRING'},
-                {'name': 't', 'type': 'STRING'},
-                {'name': 'ni', 'type': 'INTEGER'},
-                {'name': 'ec', 'type': 'STRING'},
-                {'name': 'ea', 'type': 'STRING'},
-                {'name': 'el', 'type': 'STRING'},
-                {'name': 'ev', 'type': 'FLOAT'},
-                {'name': 'ua', 'type': 'STRING'},
             ]
         }
-    }
-    self._use_query_results(api_response)
+    })
+    schema = [
+        {'name': 'tid', 'type': 'string', 'mode': 'nullable'},
+        {'name': 'cid', 'type': 'string', 'mode': 'nullable'},
+    ]
 
     patcher_worker_enqueue = mock.patch.object(workers.BQToMeasurementProtocol, '_enqueue')
     self.addCleanup(patcher_worker_enqueue.stop)
     patched_enqueue = patcher_worker_enqueue.start()
-    def _remove_next_page_token(worker_name, *args, **kwargs):
-      if worker_name == 'BQToMeasurementProtocol':
-        del api_response['pageToken']
-        self._use_query_results(api_response)
-    patched_enqueue.side_effect = _remove_next_page_token
 
     self._worker._execute()
-    self.assertEqual(patched_enqueue.call_count, 2)
-    self.assertEqual(patched_enqueue.call_args_list[0][0][0], 'BQToMeasurementProtocolProcessor')
-    self.assertEqual(patched_enqueue.call_args_list[0][0][1]['bq_page_token'], None)
-    self.assertEqual(patched_enqueue.call_args_list[1][0][0], 'BQToMeasurementProtocol')
-    self.assertEqual(patched_enqueue.call_args_list[1][0][1]['bq_page_token'], 'abc')
+    # Only the table metadata is read, no rows.
+    self.assertEqual(self._client._connection.api_request.call_count, 1)
+    self.assertEqual(patched_enqueue.call_count, 3)
+    enqueued = [(c[0][0], c[0][1]) for c in patched_enqueue.call_args_list]
+    self.assertEqual(enqueued[0][0], 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(enqueued[0][1]['bq_start_index'], 0)
+    self.assertEqual(enqueued[0][1]['bq_batch_size'], 1000)
+    self.assertEqual(enqueued[0][1]['bq_schema'], schema)
+    self.assertEqual(enqueued[1][0], 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(enqueued[1][1]['bq_start_index'], 1000)
+    self.assertEqual(enqueued[2][0], 'BQToMeasurementProtocol')
+    self.assertEqual(enqueued[2][1]['bq_start_index'], 2000)
+    self.assertEqual(enqueued[2][1]['bq_num_rows'], 2500)
+    self.assertEqual(enqueued[2][1]['bq_schema'], schema)
+
+    # The spawned scheduler doesn't read the table again.
+    patched_enqueue.reset_mock()
+    self._client._connection.api_request.reset_mock()
+    workers.BQToMeasurementProtocol(enqueued[2][1], 1, 1)._execute()
+    self._client._connection.api_request.assert_not_called()
+    self.assertEqual(patched_enqueue.call_count, 1)
+    self.assertEqual(patched_enqueue.call_args[0][0],
+                     'BQToMeasurementProtocolProcessor')
+    self.assertEqual(patched_enqueue.call_args[0][1]['bq_start_index'], 2000)
+    self.assertNotIn('bq_num_rows', patched_enqueue.call_args[0][1])
+
+  def test_empty_table_enqueues_nothing(self):
+    self._worker = workers.BQToMeasurementProtocol(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'mp_batch_size': 20,
+        },
+        1,
+        1)
+    self._use_query_results({
+        'tableReference': {
+            'tableId': 'mock_table',
+        },
+        'jobReference': {
+            'jobId': 'table',
+        },
+        'numRows': '0',
+        'schema': {'fields': [{'name': 'tid', 'type': 'STRING'}]}
+    })
+    with mock.patch.object(self._worker, '_enqueue') as patched_enqueue:
+      self._worker._execute()
+    patched_enqueue.assert_not_called()
+
+  def test_avro_mode_starts_extract_and_waits_for_it(self):
+    self._worker = workers.BQToMeasurementProtocol(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'mp_batch_size': 20,
+            'avro_uri_prefix': 'gs://bucket/hits/',
+        },
+        1,
+        1)
+    self._use_query_results({
+        'tableReference': {
+            'tableId': 'mock_table',
+        },
+        'jobReference': {
+            'jobId': 'table',
+        },
+        'schema': {'fields': [{'name': 'tid', 'type': 'STRING'}]}
+    })
+    job = self._client.extract_table_to_storage.return_value
+    job.error_result = None
+    job.state = 'RUNNING'
+    with mock.patch.object(self._worker, '_enqueue') as patched_enqueue:
+      self._worker._execute()
+    job_name = self._client.extract_table_to_storage.call_args[0][0]
+    self.assertEqual(self._client.extract_table_to_storage.call_args[0][2],
+                     'gs://bucket/hits/%s-*.avro' % job_name)
+    self.assertEqual(job.destination_format, 'AVRO')
+    job.begin.assert_called_once()
+    patched_enqueue.assert_called_once()
+    worker_class, worker_params, delay = patched_enqueue.call_args[0]
+    self.assertEqual(worker_class, 'BQToMeasurementProtocol')
+    self.assertEqual(worker_params['bq_extract_job_name'], job_name)
+    self.assertEqual(worker_params['bq_schema'],
+                     [{'name': 'tid', 'type': 'string', 'mode': 'nullable'}])
+    self.assertEqual(delay,
+                     workers.BQToMeasurementProtocol.EXTRACT_CHECK_DELAY)
+
+  @mock.patch('cloudstorage.listbucket')
+  @mock.patch('google.cloud.bigquery.job._AsyncJob')
+  def test_avro_mode_enqueues_a_processor_per_file(self, patched_job,
+                                                   patched_listbucket):
+    schema = [{'name': 'tid', 'type': 'string', 'mode': 'nullable'}]
+    self._worker = workers.BQToMeasurementProtocol(
+        {
+            'bq_project_id': 'BQID',
+            'bq_dataset_id': 'DTID',
+            'bq_table_id': 'table_id',
+            'mp_batch_size': 20,
+            'avro_uri_prefix': 'gs://bucket/hits/',
+            'bq_extract_job_name': 'job',
+            'bq_schema': schema,
+        },
+        1,
+        1)
+    self._worker.MAX_ENQUEUED_JOBS = 2
+    patched_job.return_value.error_result = None
+    patched_job.return_value.state = 'DONE'
+    patched_listbucket.return_value = [
+        cloudstorage.GCSFileStat('/bucket/hits/%s' % name, 0, 'etag', 0)
+        for name in ['job-000000000002.avro', 'job-000000000000.avro',
+                     'job-000000000001.avro', 'other-000000000000.avro']]
+
+    with mock.patch.object(self._worker, '_enqueue') as patched_enqueue:
+      self._worker._execute()
+    enqueued = [c[0][:2] for c in patched_enqueue.call_args_list]
+    self.assertEqual(len(enqueued), 3)
+    self.assertEqual(enqueued[0][0], 'BQToMeasurementProtocolProcessor')
+    self.assertEqual(enqueued[0][1]['avro_file'],
+                     '/bucket/hits/job-000000000000.avro')
+    self.assertEqual(enqueued[0][1]['bq_schema'], schema)
+    self.assertNotIn('bq_extract_job_name', enqueued[0][1])
+    self.assertEqual(enqueued[1][1]['avro_file'],
+                     '/bucket/hits/job-000000000001.avro')
+    self.assertEqual(enqueued[2][0], 'BQToMeasurementProtocol')
+    self.assertEqual(enqueued[2][1]['avro_files'],
+                     ['/bucket/hits/job-000000000002.avro'])
+
+    # The spawned scheduler goes on with the remaining files.
+    patched_listbucket.reset_mock()
+    worker = workers.BQToMeasurementProtocol(enqueued[2][1], 1, 1)
+    with mock.patch.object(worker, '_enqueue') as patched_enqueue:
+      worker._execute()
+    patched_listbucket.assert_not_called()
+    patched_enqueue.assert_called_once()
+    self.assertEqual(patched_enqueue.call_args[0][1]['avro_file'],
+                     '/bucket/hits/job-000000000002.avro')
+
+
+class TestMeasurementProtocolReplayer(unittest.TestCase):
+
+  def setUp(self):
+    super(TestMeasurementProtocolReplayer, self).setUp()
+    patcher_requests_post = mock.patch('requests.Session.post')
+    self.addCleanup(patcher_requests_post.stop)
+    self._patched_post = patcher_requests_post.start()
+    patcher_listbucket = mock.patch('cloudstorage.listbucket')
+    self.addCleanup(patcher_listbucket.stop)
+    patcher_listbucket.start().return_value = [
+        cloudstorage.GCSFileStat('/bucket/failed/1_1_a.json', 0, 'etag', 0)]
+    patcher_delete = mock.patch('cloudstorage.delete')
+    self.addCleanup(patcher_delete.stop)
+    self._patched_delete = patcher_delete.start()
+    patcher_logger = mock.patch('core.cloud_logging.logger')
+    self.addCleanup(patcher_logger.stop)
+    patcher_logger.start().log_struct.__name__ = 'foo'
+    self._spool = '\n'.join([
+        json.dumps({'status_code': 500, 'hits': ['cid=1&v=1', 'cid=2&v=1']}),
+        json.dumps({'status_code': 503, 'hits': ['cid=3&v=1']}),
+    ]) + '\n'
+
+  @mock.patch('time.time')
+  @mock.patch('time.sleep')
+  def test_resends_spooled_hits_at_given_rate(self, patched_time_sleep,
+                                              patched_time):
+    patched_time.return_value = 0
+    self._patched_post.return_value = mock.Mock(status_code=200)
+    worker = workers.MeasurementProtocolReplayer({
+        'spool_uris': ['gs://bucket/failed/*.json'],
+        'max_hits_per_second': 2,
+        'mp_batch_size': 2,
+        'spool_uri_prefix': '',
+    }, 1, 1)
+    with mock.patch('cloudstorage.open') as patched_open:
+      patched_open.return_value = io.BytesIO(self._spool)
+      worker._execute()
+    patched_open.assert_called_once_with('/bucket/failed/1_1_a.json')
+    self.assertEqual(
+        [c[1]['data'] for c in self._patched_post.call_args_list],
+        ['cid=1&v=1\ncid=2&v=1', 'cid=3&v=1'])
+    # 2 hits then 1 hit at 2 hits per second.
+    self.assertEqual(
+        [c[0][0] for c in patched_time_sleep.call_args_list], [1.0, 0.5])
+    self._patched_delete.assert_called_once_with('/bucket/failed/1_1_a.json')
+
+  @mock.patch('time.sleep')
+  def test_spools_hits_failing_again(self, patched_time_sleep):
+    self._patched_post.side_effect = lambda url, headers, data: mock.Mock(
+        status_code=500 if 'cid=3' in data else 200)
+    worker = workers.MeasurementProtocolReplayer({
+        'spool_uris': ['gs://bucket/failed/*.json'],
+        'max_hits_per_second': 100,
+        'mp_batch_size': 1,
+        'spool_uri_prefix': 'gs://bucket/failed-again/',
+    }, 1, 1)
+    new_spool = io.BytesIO()
+    new_spool.close = lambda: None
+    def _open(filename, mode='r', **kwargs):
+      return new_spool if mode == 'w' else io.BytesIO(self._spool)
+    with mock.patch('cloudstorage.open') as patched_open:
+      patched_open.side_effect = _open
+      worker._execute()
+    self.assertEqual(json.loads(new_spool.getvalue()),
+                     {'status_code': 500, 'hits': ['cid=3&v=1']})
+    self._patched_delete.assert_called_once_with('/bucket/failed/1_1_a.json')
+
+  @mock.patch('time.sleep')
+  def test_spools_hits_failing_again_next_to_file_without_prefix(
+      self, patched_time_sleep):
+    self._patched_post.return_value = mock.Mock(status_code=500)
+    worker = workers.MeasurementProtocolReplayer({
+        'spool_uris': ['gs://bucket/failed/*.json'],
+        'max_hits_per_second': 100,
+        'mp_batch_size': 2,
+        'spool_uri_prefix': '',
+    }, 1, 1)
+    new_spool = io.BytesIO()
+    new_spool.close = lambda: None
+    def _open(filename, mode='r', **kwargs):
+      return new_spool if mode == 'w' else io.BytesIO(self._spool)
+    with mock.patch('cloudstorage.open') as patched_open:
+      patched_open.side_effect = _open
+      worker._execute()
+    spooled_uri = patched_open.call_args_list[-1][0][0]
+    self.assertTrue(spooled_uri.startswith('/bucket/failed/1_1_'))
+    lines = new_spool.getvalue().splitlines()
+    self.assertEqual([json.loads(line)['hits'] for line in lines],
+                     [['cid=1&v=1', 'cid=2&v=1'], ['cid=3&v=1']])
+    self._patched_delete.assert_called_once_with('/bucket/failed/1_1_a.json')
+
+  @mock.patch('time.sleep')
+  def test_continues_in_new_task_when_time_budget_is_spent(self, _):
+    self._patched_post.return_value = mock.Mock(status_code=200)
+    params = {
+        'spool_uris': ['gs://bucket/failed/*.json'],
+        'max_hits_per_second': 100,
+        'mp_batch_size': 2,
+        'spool_uri_prefix': '',
+    }
+    worker = workers.MeasurementProtocolReplayer(params.copy(), 1, 1)
+    with mock.patch('cloudstorage.open') as patched_open, \
+         mock.patch.object(worker, 'should_yield', side_effect=[False, True]):
+      patched_open.side_effect = lambda *a: io.BytesIO(self._spool)
+      worker._execute()
+    self._patched_delete.assert_not_called()
+    [(worker_class, params, _)] = worker._workers_to_enqueue
+    self.assertEqual(worker_class, 'MeasurementProtocolReplayer')
+    worker = workers.MeasurementProtocolReplayer(params, 1, 1)
+    with mock.patch('cloudstorage.open') as patched_open:
+      patched_open.side_effect = lambda *a: io.BytesIO(self._spool)
+      worker._execute()
+    self.assertEqual(
+        [c[1]['data'] for c in self._patched_post.call_args_list],
+        ['cid=1&v=1\ncid=2&v=1', 'cid=3&v=1'])
+    self._patched_delete.assert_called_once_with('/bucket/failed/1_1_a.json')
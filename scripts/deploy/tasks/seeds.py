@@ -16,7 +16,8 @@ import run_ibackend
 from core.models import GeneralSetting
 
 # SETUP SETTINGS
-settings = ['emails_for_notifications']
+settings = ['emails_for_notifications', 'profiled_job_ids',
+            'profiled_worker_classes']
 for setting in settings:
   gsetting = GeneralSetting.where(name=setting).first()
   if not gsetting: